@@ -1,6 +1,8 @@
 import java.io.IOException;
+import java.nio.file.Files;
 import java.nio.file.Paths;
 import java.util.ArrayList;
+import java.util.Arrays;
 import java.util.Comparator;
 import java.util.HashMap;
 import java.util.List;
@@ -17,9 +19,6 @@ import jdk.jfr.consumer.RecordingFile;
 
 public class JfrOverview {
 
-    private static double totalAllocated;
-    private static long firstAllocationTime = -1;
-
     static class DoubleMeasure {
 
         private int count = 0;
@@ -28,6 +27,9 @@ public class JfrOverview {
         private double value;
 
         public double getAverage() {
+            if (count == 0) {
+                return 0;
+            }
             return total / count;
         }
 
@@ -169,7 +171,7 @@ public class JfrOverview {
 
     static class Histogram {
 
-        private static final HashMap<String, LongMeasure> histogram = new HashMap<>();
+        private final HashMap<String, LongMeasure> histogram = new HashMap<>();
 
         public void add(String key, long value) {
             var measure = histogram.get(key);
@@ -204,51 +206,47 @@ public class JfrOverview {
         }
     }
 
-    private static final LongMeasure ALLOC_TOTAL = new LongMeasure();
-    private static final DoubleMeasure ALLOC_RATE = new DoubleMeasure();
-    private static final Histogram ALLOCATION_TOP_FRAME = new Histogram();
-
-    private static void onAllocationSample(RecordedEvent event, long size) {
-        String topFrame = topFrame(event.getStackTrace());
-        if (topFrame != null) {
-            ALLOCATION_TOP_FRAME.add(topFrame, size);
-        }
-        ALLOC_TOTAL.add(size);
-        long timestamp = event.getEndTime().toEpochMilli();
-        totalAllocated += size;
-        if (firstAllocationTime > 0) {
-            long elapsedTime = timestamp - firstAllocationTime;
-            if (elapsedTime > 0) {
-                double rate = 1000.0 * (totalAllocated / elapsedTime);
-                ALLOC_RATE.add(rate);
+    static class Overview {
+
+        private final DoubleMeasure machineCpu = new DoubleMeasure();
+        private final DoubleMeasure jvmSystem = new DoubleMeasure();
+        private final DoubleMeasure jvmUser = new DoubleMeasure();
+        private final LongMeasure youngGc = new LongMeasure();
+        private final LongMeasure oldGc = new LongMeasure();
+        private final LongMeasure usedHeap = new LongMeasure();
+        private final LongMeasure physicalMemory = new LongMeasure();
+        private final DoubleMeasure threads = new DoubleMeasure();
+        private final LongMeasure classes = new LongMeasure();
+        private final LongMeasure compilation = new LongMeasure();
+        private final LongMeasure initialHeap = new LongMeasure();
+        private final LongMeasure allocTotal = new LongMeasure();
+        private final DoubleMeasure allocRate = new DoubleMeasure();
+        private final Histogram allocationTopFrame = new Histogram();
+        private final Histogram executionTopFrame = new Histogram();
+        private String gcName = "Unknown";
+        private double totalAllocated;
+        private long firstAllocationTime = -1;
+
+        private void onAllocationSample(RecordedEvent event, long size) {
+            String topFrame = topFrame(event.getStackTrace());
+            if (topFrame != null) {
+                allocationTopFrame.add(topFrame, size);
+            }
+            allocTotal.add(size);
+            long timestamp = event.getEndTime().toEpochMilli();
+            totalAllocated += size;
+            if (firstAllocationTime > 0) {
+                long elapsedTime = timestamp - firstAllocationTime;
+                if (elapsedTime > 0) {
+                    double rate = 1000.0 * (totalAllocated / elapsedTime);
+                    allocRate.add(rate);
+                }
+            } else {
+                firstAllocationTime = timestamp;
             }
-        } else {
-            firstAllocationTime = timestamp;
-        }
-    }
-
-    public static void main(String[] args) throws IOException {
-        if (args.length < 1) {
-            throw new IllegalArgumentException("Path to JFR recording required");
         }
-        var recordingFile = new RecordingFile(Paths.get(args[0]));
-
-        DoubleMeasure machineCpu = new DoubleMeasure();
-        DoubleMeasure jvmSystem = new DoubleMeasure();
-        DoubleMeasure jvmUser = new DoubleMeasure();
-        LongMeasure youngGc = new LongMeasure();
-        LongMeasure oldGc = new LongMeasure();
-        LongMeasure usedHeap = new LongMeasure();
-        LongMeasure physicalMemory = new LongMeasure();
-        DoubleMeasure threads = new DoubleMeasure();
-        LongMeasure classes = new LongMeasure();
-        LongMeasure compilation = new LongMeasure();
-        LongMeasure initialHeap = new LongMeasure();
-        Histogram executionTopFrame = new Histogram();
-        String gcName = "Unknown";
 
-        while (recordingFile.hasMoreEvents()) {
-            var event = recordingFile.readEvent();
+        public void onEvent(RecordedEvent event) {
             switch (event.getEventType().getName()) {
                 case "jdk.CPULoad" -> {
                     machineCpu.add(event.getDouble("machineTotal"));
@@ -288,7 +286,9 @@ public class JfrOverview {
                 }
                 case "jdk.ExecutionSample" -> {
                     String topFrame = topFrame(event.getStackTrace());
-                    executionTopFrame.add(topFrame, 1);
+                    if (topFrame != null) {
+                        executionTopFrame.add(topFrame, 1);
+                    }
                 }
                 case "jdk.JavaThreadStatistics" -> {
                     threads.add(event.getDouble("activeCount"));
@@ -303,62 +303,133 @@ public class JfrOverview {
                 case "jdk.GCHeapConfiguration" -> {
                     initialHeap.add(event.getLong("initialSize"));
                 }
+                default -> {
+                }
             }
         }
-        String jsonResult = String.format(Locale.ENGLISH,
-            """
-            {
-                "gc": {
-                    "name": "%s",
-                    "young": {
-                        "count": %s,
-                        "max_duration_ns": %s,
-                        "avg_duration_ns": %s
+
+        private static String formatFrames(Stream<Record> records) {
+            return '[' + String.join(", ", records.map(Record::format).toArray(String[]::new)) + ']';
+        }
+
+        public String toJson(List<Window> windows) {
+            String windowsJson = '[' + String.join(
+                ", ",
+                windows.stream().map(w -> w.overview().toJson(List.of())).toArray(String[]::new)
+            ) + ']';
+            return String.format(Locale.ENGLISH,
+                """
+                {
+                    "gc": {
+                        "name": "%s",
+                        "young": {
+                            "count": %s,
+                            "max_duration_ns": %s,
+                            "avg_duration_ns": %s,
+                            "total_duration_ns": %s
+                        },
+                        "old": {
+                            "count": %s,
+                            "max_duration_ns": %s,
+                            "avg_duration_ns": %s,
+                            "total_duration_ns": %s
+                        }
                     },
-                    "old": {
-                        "count": %s,
-                        "max_duration_ns": %s,
-                        "avg_duration_ns": %s
-                    }
-                },
-                "cpu": {
-                    "system": %s,
-                    "jvm_user": %s,
-                    "jvm_system": %s
-                },
-                "heap": {
-                    "initial": %s,
-                    "used": %s
-                },
-                "alloc": {
-                    "rate": %s,
-                    "total": %s,
-                    "top_frames_by_count": %s,
-                    "top_frames_by_alloc": %s
-                },
-                "threads": %s,
-                "classes": %s
+                    "cpu": {
+                        "system": %s,
+                        "jvm_user": %s,
+                        "jvm_system": %s,
+                        "top_frames": %s
+                    },
+                    "heap": {
+                        "initial": %s,
+                        "used": %s
+                    },
+                    "alloc": {
+                        "rate": %s,
+                        "total": %s,
+                        "top_frames_by_count": %s,
+                        "top_frames_by_alloc": %s
+                    },
+                    "threads": %s,
+                    "classes": %s,
+                    "windows": %s
+                }
+                """,
+                gcName,
+                youngGc.count,
+                youngGc.max,
+                youngGc.getAverage(),
+                youngGc.total,
+                oldGc.count,
+                oldGc.max,
+                oldGc.getAverage(),
+                oldGc.total,
+                machineCpu.getAverage(),
+                jvmUser.getAverage(),
+                jvmSystem.getAverage(),
+                formatFrames(executionTopFrame.byCount()),
+                initialHeap.value,
+                usedHeap.value,
+                allocRate.value,
+                allocTotal.total,
+                formatFrames(allocationTopFrame.byCount()),
+                formatFrames(allocationTopFrame.byTotal()),
+                threads.value,
+                classes.value,
+                windowsJson
+            );
+        }
+    }
+
+    /**
+     * Time window of a single query, in epoch milliseconds.
+     * Events that start within the window are also accounted to its overview.
+     */
+    public static record Window(long start, long end, Overview overview) {
+    }
+
+    private static List<Window> readWindows(String path) throws IOException {
+        // One window per line: <start_epoch_ms> <end_epoch_ms>
+        List<Window> windows = new ArrayList<>();
+        for (String line : Files.readAllLines(Paths.get(path))) {
+            line = line.strip();
+            if (line.isEmpty()) {
+                continue;
             }
-            """,
-            gcName,
-            youngGc.count,
-            youngGc.max,
-            youngGc.getAverage(),
-            oldGc.count,
-            oldGc.max,
-            oldGc.getAverage(),
-            machineCpu.getAverage(),
-            jvmUser.getAverage(),
-            jvmSystem.getAverage(),
-            initialHeap.value,
-            usedHeap.value,
-            ALLOC_RATE.value,
-            ALLOC_TOTAL.total,
-            '[' + String.join(", ", ALLOCATION_TOP_FRAME.byCount().map(Record::format).toArray(String[]::new)) + ']',
-            '[' + String.join(", ", ALLOCATION_TOP_FRAME.byTotal().map(Record::format).toArray(String[]::new)) + ']',
-            threads.value,
-            classes.value
-        );
-        System.out.println(jsonResult);
+            String[] parts = line.split("\\s+");
+            windows.add(new Window(Long.parseLong(parts[0]), Long.parseLong(parts[1]), new Overview()));
+        }
+        return windows;
+    }
+
+    public static void main(String[] args) throws IOException {
+        if (args.length < 1) {
+            throw new IllegalArgumentException("Path to JFR recording required");
+        }
+        var recordingFile = new RecordingFile(Paths.get(args[0]));
+        List<Window> windows = args.length > 1 ? readWindows(args[1]) : List.of();
+        List<Window> sortedWindows = new ArrayList<>(windows);
+        sortedWindows.sort(Comparator.comparingLong(Window::start));
+        long[] windowStarts = sortedWindows.stream().mapToLong(Window::start).toArray();
+
+        Overview overview = new Overview();
+        while (recordingFile.hasMoreEvents()) {
+            var event = recordingFile.readEvent();
+            overview.onEvent(event);
+            if (windowStarts.length == 0) {
+                continue;
+            }
+            long time = event.getStartTime().toEpochMilli();
+            int idx = Arrays.binarySearch(windowStarts, time);
+            if (idx < 0) {
+                // insertion point - 1 is the last window starting before the event
+                idx = -idx - 2;
+            }
+            if (idx >= 0 && time <= sortedWindows.get(idx).end()) {
+                sortedWindows.get(idx).overview().onEvent(event);
+            }
+        }
+        System.out.println(overview.toJson(windows));
     }
 }
@@ -0,0 +1,268 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Script to find the first build between a good and a bad version in which a
+query of a spec became significantly slower.
+
+The builds in between are binary-searched. Each step launches the good build
+and the candidate build for a number of forks (like compare_run.py) and
+compares the pooled runtimes of the query.
+
+    ./bisect_nightlies.py --spec specs/select/hyperloglog.toml --query distinct \\
+        --good crate-5.6.0-202401100002-aaaaaaa.tar.gz \\
+        --bad crate-5.6.0-202401200002-bbbbbbb.tar.gz
+
+Downloaded tarballs and the listing of nightly builds are cached, use
+`--builds DIR` with a directory of tarballs (or `--offline`) to bisect
+without network access.
+"""
+
+import argparse
+import asyncio
+import math
+import os
+import re
+import shutil
+import tempfile
+from typing import Dict, List, NamedTuple, Optional
+from urllib import request
+
+from compare_measures import Diff, merge_stats, trim_warmup
+from compare_run import _run_spec
+from setup_cache import SetupCache
+from util import dict_from_kw_args
+
+
+NIGHTLY_BASE_URI = 'https://cdn.crate.io/downloads/releases/nightly/'
+NIGHTLY_RE = re.compile(r'.*>(?P<filename>crate-\d+\.\d+\.\d+-\d{12}-[a-z0-9]{7,}\.tar\.gz)<.*')
+BUILD_RE = re.compile(r'crate-(?P<version>\d+\.\d+\.\d+)-(?P<timestamp>\d{12})-(?P<hash>[a-z0-9]{7,})\.tar\.gz$')
+CACHE_DIR = os.path.join(
+    os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')),
+    'crate-benchmarks',
+    'nightlies'
+)
+
+
+class Step(NamedTuple):
+    build: str
+    diff: Diff
+    slower: bool
+
+
+def build_timestamp(build: str) -> str:
+    """ Return the build timestamp contained in the tarball name of a nightly
+
+    >>> build_timestamp('https://cdn.crate.io/downloads/releases/nightly/crate-5.6.0-202401151234-abc1234.tar.gz')
+    '202401151234'
+
+    >>> build_timestamp('5.6.0')
+    Traceback (most recent call last):
+        ...
+    ValueError: 5.6.0 is not a nightly build (crate-<version>-<timestamp>-<hash>.tar.gz)
+    """
+    m = BUILD_RE.search(os.path.basename(build))
+    if not m:
+        raise ValueError(f'{build} is not a nightly build (crate-<version>-<timestamp>-<hash>.tar.gz)')
+    return m.group('timestamp')
+
+
+def builds_between(builds: List[str], good: str, bad: str) -> List[str]:
+    """ Return the builds from good to bad (inclusive), ordered by build time
+
+    >>> builds = ['crate-5.6.0-202401030000-ccccccc.tar.gz',
+    ...           'crate-5.6.0-202401010000-aaaaaaa.tar.gz',
+    ...           'crate-5.6.0-202401020000-bbbbbbb.tar.gz',
+    ...           'crate-5.6.0-202401040000-ddddddd.tar.gz']
+    >>> builds_between(builds, builds[1], builds[0])
+    ['crate-5.6.0-202401010000-aaaaaaa.tar.gz', 'crate-5.6.0-202401020000-bbbbbbb.tar.gz', 'crate-5.6.0-202401030000-ccccccc.tar.gz']
+    """
+    start = build_timestamp(good)
+    end = build_timestamp(bad)
+    by_name = {os.path.basename(b): b for b in builds}
+    by_name.setdefault(os.path.basename(good), good)
+    by_name.setdefault(os.path.basename(bad), bad)
+    between = [b for name, b in by_name.items() if start <= build_timestamp(name) <= end]
+    return sorted(between, key=build_timestamp)
+
+
+def local_builds(directory: str) -> List[str]:
+    return [
+        os.path.join(directory, name)
+        for name in os.listdir(directory)
+        if BUILD_RE.search(name)
+    ]
+
+
+def nightly_builds(cache_dir: str, offline: bool = False) -> List[str]:
+    """ List the URLs of the available nightly builds
+
+    The listing is cached so that a bisect can be resumed without network
+    access.
+    """
+    listing = os.path.join(cache_dir, 'index.txt')
+    if not offline:
+        with request.urlopen(NIGHTLY_BASE_URI) as r:
+            lines = [line.decode('utf-8') for line in r]
+        uris = [NIGHTLY_BASE_URI + m.group('filename') for m in map(NIGHTLY_RE.match, lines) if m]
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(listing, 'w') as f:
+            f.write('\n'.join(uris))
+        return uris
+    with open(listing) as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def fetch_build(build: str, cache_dir: str) -> str:
+    """ Return a local path of the build tarball, downloading it if necessary """
+    if os.path.isfile(build):
+        return build
+    path = os.path.join(cache_dir, os.path.basename(build))
+    if not os.path.exists(path):
+        os.makedirs(cache_dir, exist_ok=True)
+        print(f'Downloading {build}')
+        tmp_path = path + '.part'
+        with request.urlopen(build) as r, open(tmp_path, 'wb') as f:
+            shutil.copyfileobj(r, f)
+        os.replace(tmp_path, path)
+    return path
+
+
+async def measure(builds: List[str],
+                  spec: str,
+                  query: str,
+                  forks: int,
+                  env: Dict[str, str],
+                  settings: Dict[str, str],
+                  tmpdir: str,
+                  setup_cache: Optional[SetupCache],
+                  sample_mode: str) -> List[Dict]:
+    """ Run only `query` against each build and pool the trimmed runtimes of all forks """
+    re_name = re.escape(query) + '$'
+    runtime_stats = [[] for _ in builds]
+    for fork in range(forks):
+        # Rotate the start order like compare_run does
+        for j in ((fork + k) % len(builds) for k in range(len(builds))):
+            run = await _run_spec(
+                builds[j],
+                spec,
+                None,
+                dict(env),
+                dict(settings),
+                tmpdir,
+                'http',
+                False,
+                setup_cache=setup_cache,
+                slot=f'v{j + 1}',
+                sample_mode=sample_mode,
+                proc_interval=0,
+                re_name=re_name
+            )
+            for path in run.jfr_files + [run.windows_file]:
+                os.remove(path)
+            stats = [r.runtime_stats for r in run.results if r.name == query]
+            if not stats:
+                raise SystemExit(f'No results for query "{query}" in {spec}')
+            runtime_stats[j].extend(trim_warmup(s) for s in stats)
+    return [merge_stats(stats) for stats in runtime_stats]
+
+
+async def compare_builds(good: str, candidate: str, args, tmpdir: str, setup_cache) -> Step:
+    base, other = await measure(
+        [good, candidate],
+        args.spec,
+        args.query,
+        args.forks,
+        dict_from_kw_args(args.env),
+        dict_from_kw_args(args.setting),
+        tmpdir,
+        setup_cache,
+        args.sample_mode
+    )
+    diff = Diff(base, other)
+    slower = diff.is_significant and other['mean'] > base['mean'] and diff.mean_diff >= args.min_slowdown
+    return Step(candidate, diff, slower)
+
+
+def print_step(step: Step, remaining: int):
+    prefix = '+' if step.diff.r2['mean'] > step.diff.r1['mean'] else '-'
+    verdict = 'bad' if step.slower else 'good'
+    print(f'{os.path.basename(step.build)}: {prefix}{step.diff.mean_diff:.2f}% mean, '
+          f'{step.diff.probability:.2f}% probability => {verdict} (~{remaining} steps left)')
+
+
+async def bisect(builds: List[str], args) -> Optional[Step]:
+    """ Binary search for the first build that is significantly slower than builds[0] """
+    tmpdir = tempfile.mkdtemp()
+    setup_cache = args.setup_cache and SetupCache(args.setup_cache) or None
+    try:
+        good = fetch_build(builds[0], args.cache_dir)
+        lo, hi = 0, len(builds) - 1
+        step = await compare_builds(good, fetch_build(builds[hi], args.cache_dir), args, tmpdir, setup_cache)
+        print_step(step, math.ceil(math.log2(max(hi - lo, 1))))
+        if not step.slower:
+            print('The bad build is not significantly slower than the good build')
+            return None
+        first_bad = step
+        while hi - lo > 1:
+            mid = (lo + hi) // 2
+            step = await compare_builds(good, fetch_build(builds[mid], args.cache_dir), args, tmpdir, setup_cache)
+            if step.slower:
+                hi = mid
+                first_bad = step
+            else:
+                lo = mid
+            print_step(step, math.ceil(math.log2(max(hi - lo, 1))))
+        return first_bad
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+def main():
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument('--spec', help='path to spec file', required=True)
+    p.add_argument('--query', help='name of the query in the spec', required=True)
+    p.add_argument('--good', help='nightly build (URL, path or tarball name) without the regression', required=True)
+    p.add_argument('--bad', help='nightly build (URL, path or tarball name) with the regression', required=True)
+    p.add_argument('--builds', type=str,
+                   help='Directory with nightly tarballs to bisect. Defaults to the list of nightly builds')
+    p.add_argument('--cache-dir', type=str, default=CACHE_DIR,
+                   help='Directory in which downloaded tarballs and the nightly listing are cached')
+    p.add_argument('--offline', action='store_true',
+                   help='Use the cached listing of nightly builds instead of fetching it')
+    p.add_argument('--forks', type=int, default=3,
+                   help='Number of times the nodes are launched per build and step')
+    p.add_argument('--min-slowdown', type=float, default=0.0,
+                   help='Minimum slowdown of the mean in percent for a build to count as bad')
+    p.add_argument('--sample-mode', type=str, default='all',
+                   help='cr8 sample mode: all, reservoir, reservoir:<size> or hdr (histogram of all samples)')
+    p.add_argument('--setup-cache', type=str,
+                   help='Directory used to cache the data directory of the nodes after the setup phase')
+    p.add_argument('--env', action='append',
+                   help='Environment variable for crate nodes. E.g. --env CRATE_HEAP_SIZE=2g')
+    p.add_argument('-s', '--setting', action='append',
+                   help='Crate setting. E.g. -s path.data=/tmp/c1/')
+    args = p.parse_args()
+
+    if args.builds:
+        builds = local_builds(args.builds)
+    else:
+        builds = nightly_builds(args.cache_dir, args.offline)
+    try:
+        builds = builds_between(builds, args.good, args.bad)
+    except ValueError as e:
+        raise SystemExit(str(e))
+    print(f'Bisecting {len(builds)} builds from {os.path.basename(builds[0])} to {os.path.basename(builds[-1])}')
+    try:
+        step = asyncio.run(bisect(builds, args))
+    except KeyboardInterrupt:
+        print('Exiting..')
+        return
+    if step:
+        print('')
+        print(f'First build with a significant slowdown: {step.build}')
+        print(step.diff.ptext)
+
+
+if __name__ == '__main__':
+    main()
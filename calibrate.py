@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+A/A calibration of a spec: runs the spec against a single version for a
+number of forks, estimates the variance of each query within and between
+forks and derives the iterations and forks needed to detect a given change of
+the mean.
+
+    ./calibrate.py --version 5.6.0 --spec specs/select/hyperloglog.toml --effect 3 --power 0.8
+
+The recommendations are printed as suggested `iterations` for the spec and
+written to a sidecar file (`<spec>.calibration.json`), which can be passed
+to `compare_run.py --calibration` to use the recommended number of forks.
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import os
+import shutil
+import tempfile
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+
+from cr8.bench_spec import load_spec
+from scipy import stats
+from tabulate import tabulate
+
+from compare_measures import moments, trim_warmup
+from compare_run import _run_spec
+from setup_cache import SetupCache
+from util import dict_from_kw_args
+
+
+class Recommendation(NamedTuple):
+    forks: int
+    iterations: Optional[int]  # None if the effect can't be detected with the max. number of forks
+
+
+def calibration_path(spec: str) -> str:
+    """
+    >>> calibration_path('specs/select/hyperloglog.toml')
+    'specs/select/hyperloglog.calibration.json'
+    """
+    return os.path.splitext(spec)[0] + '.calibration.json'
+
+
+def variance_components(forks: List[Tuple[int, float, float]]) -> Tuple[float, float, float]:
+    """ Grand mean, within-fork and between-fork variance (one-way random effects)
+
+    `forks` are the number of samples, mean and standard deviation of each fork.
+    The between-fork variance is the part of the variance of the fork means
+    that isn't explained by the within-fork variance.
+
+    >>> mean, within, between = variance_components([(100, 10.0, 1.0), (100, 12.0, 1.0), (100, 11.0, 1.0)])
+    >>> mean, within, round(between, 2)
+    (11.0, 1.0, 0.99)
+    >>> variance_components([(100, 10.0, 2.0)])
+    (10.0, 4.0, 0.0)
+    """
+    total = sum(n for n, _, _ in forks)
+    grand_mean = sum(n * mean for n, mean, _ in forks) / total
+    dof = sum(n - 1 for n, _, _ in forks)
+    within = sum((n - 1) * sd ** 2 for n, _, sd in forks) / dof if dof else 0.0
+    if len(forks) < 2:
+        return grand_mean, within, 0.0
+    means = [mean for _, mean, _ in forks]
+    mean_of_means = sum(means) / len(means)
+    var_means = sum((m - mean_of_means) ** 2 for m in means) / (len(means) - 1)
+    avg_n = len(forks) / sum(1 / n for n, _, _ in forks)
+    return grand_mean, within, max(0.0, var_means - within / avg_n)
+
+
+def recommend(mean: float,
+              within: float,
+              between: float,
+              effect: float,
+              alpha: float = 0.01,
+              power: float = 0.8,
+              max_forks: int = 20,
+              max_iterations: int = 100_000) -> Recommendation:
+    """ Smallest number of forks (and iterations per fork) to detect a change of `effect` percent
+
+    Two versions with f forks of n iterations each, compared with a two-sided
+    test at level `alpha`, detect a difference of the means of `delta` with
+    probability `power` if
+
+        (z_alpha + z_power) * sqrt(2 * (between / f + within / (f * n))) <= delta
+
+    >>> recommend(10.0, 1.0, 0.0, 3.0)
+    Recommendation(forks=1, iterations=260)
+    >>> recommend(10.0, 1.0, 0.01, 3.0)
+    Recommendation(forks=3, iterations=642)
+    >>> recommend(10.0, 1.0, 1.0, 3.0, max_forks=5)
+    Recommendation(forks=5, iterations=None)
+    """
+    delta = mean * effect / 100
+    z = stats.norm.ppf(1 - alpha / 2) + stats.norm.ppf(power)
+    # Max. variance of the difference of the means of a single version
+    target = (delta / z) ** 2 / 2
+    for forks in range(1, max_forks + 1):
+        remaining = forks * target - between
+        if remaining <= 0:
+            continue
+        iterations = max(1, math.ceil(within / remaining))
+        if iterations <= max_iterations:
+            return Recommendation(forks, iterations)
+    return Recommendation(max_forks, None)
+
+
+async def run_forks(args, tmpdir: str) -> Dict[Tuple[str, int], Dict[str, Any]]:
+    """ Run the spec `args.forks` times and collect the runtime stats of every fork per query """
+    setup_cache = args.setup_cache and SetupCache(args.setup_cache) or None
+    by_query = {}
+    for fork in range(args.forks):
+        run = await _run_spec(
+            args.version,
+            args.spec,
+            None,
+            dict_from_kw_args(args.env),
+            dict_from_kw_args(args.setting),
+            tmpdir,
+            'http',
+            False,
+            setup_cache=setup_cache,
+            sample_mode=args.sample_mode,
+            proc_interval=0
+        )
+        for path in run.jfr_files + [run.windows_file]:
+            os.remove(path)
+        for r in run.results:
+            query = by_query.setdefault((r.statement, r.concurrency), {'name': r.name, 'forks': []})
+            query['forks'].append(trim_warmup(r.runtime_stats))
+    return by_query
+
+
+def calibrate(by_query: Dict[Tuple[str, int], Dict[str, Any]], spec: str, args) -> List[Dict[str, Any]]:
+    spec_queries = {(q['statement'], q.get('concurrency', 1)): q for q in load_spec(spec).queries}
+    queries = []
+    for (statement, concurrency), query in by_query.items():
+        mean, within, between = variance_components([moments(r)[:3] for r in query['forks']])
+        rec = recommend(mean, within, between, args.effect, args.alpha, args.power,
+                        args.max_forks, args.max_iterations)
+        spec_query = spec_queries.get((statement, concurrency), {})
+        queries.append({
+            'name': query['name'],
+            'statement': statement,
+            'concurrency': concurrency,
+            'mean': mean,
+            'within_stdev': math.sqrt(within),
+            'between_stdev': math.sqrt(between),
+            'current_iterations': spec_query.get('iterations'),
+            'current_duration': spec_query.get('duration'),
+            'iterations': rec.iterations,
+            'forks': rec.forks,
+        })
+    return queries
+
+
+def print_recommendations(queries: List[Dict[str, Any]], args):
+    print('')
+    print(f'# Iterations and forks to detect a change of {args.effect:.2f}% of the mean '
+          f'(power {args.power:.2f}, alpha {args.alpha:g}, {args.forks} forks measured)')
+    rows = [
+        (
+            (q['name'] or q['statement'])[:60],
+            q['concurrency'],
+            q['mean'],
+            q['within_stdev'],
+            q['between_stdev'],
+            q['current_iterations'] or (q['current_duration'] and f"{q['current_duration']}s"),
+            q['iterations'] or f"> {args.max_iterations}",
+            q['forks'],
+        )
+        for q in queries
+    ]
+    headers = ('Query', 'C', 'Mean ms', 'Stdev within', 'Stdev between', 'Iterations now', 'Iterations', 'Forks')
+    print(tabulate(rows, headers=headers, floatfmt='.3f'))
+    undetectable = [q for q in queries if q['iterations'] is None]
+    if undetectable:
+        print('')
+        print(f'{len(undetectable)} queries vary too much between forks to detect the change with '
+              f'{args.max_forks} forks')
+
+
+def main():
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument('--version', help='cr8 version identifier or path to tarball (tar.gz)', required=True)
+    p.add_argument('--spec', help='path to spec file', required=True)
+    p.add_argument('--forks', type=int, default=3,
+                   help='Number of times the node is launched and the spec re-run. At least 2 are needed '
+                        'to estimate the variance between forks')
+    p.add_argument('--effect', type=float, default=3.0,
+                   help='Change of the mean in percent which should be detected. Defaults to 3')
+    p.add_argument('--power', type=float, default=0.8,
+                   help='Probability to detect a change of --effect. Defaults to 0.8')
+    p.add_argument('--alpha', type=float, default=0.01,
+                   help='Significance level of the (two-sided) test. Defaults to 0.01 like compare_run')
+    p.add_argument('--max-forks', type=int, default=20)
+    p.add_argument('--max-iterations', type=int, default=100_000)
+    p.add_argument('--output', type=str,
+                   help='Path of the sidecar file with the recommendations. Defaults to <spec>.calibration.json')
+    p.add_argument('--sample-mode', type=str, default='all',
+                   help='cr8 sample mode: all, reservoir, reservoir:<size> or hdr')
+    p.add_argument('--setup-cache', type=str,
+                   help='Directory used to cache the data directory of the node after the setup phase')
+    p.add_argument('--env', action='append',
+                   help='Environment variable for crate nodes. E.g. --env CRATE_HEAP_SIZE=2g')
+    p.add_argument('-s', '--setting', action='append',
+                   help='Crate setting. E.g. -s path.data=/tmp/c1/')
+    args = p.parse_args()
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        by_query = asyncio.run(run_forks(args, tmpdir))
+    except KeyboardInterrupt:
+        print('Exiting..')
+        return
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+    queries = calibrate(by_query, args.spec, args)
+    print_recommendations(queries, args)
+    output = args.output or calibration_path(args.spec)
+    with open(output, 'w') as f:
+        json.dump({
+            'spec': args.spec,
+            'version': args.version,
+            'effect': args.effect,
+            'power': args.power,
+            'alpha': args.alpha,
+            'forks_measured': args.forks,
+            # Queries which can't reach the effect with --max-forks don't dictate the forks of a run
+            'forks': max((q['forks'] for q in queries if q['iterations']), default=args.max_forks),
+            'queries': queries,
+        }, f, indent=2)
+    print('')
+    print(f'Recommendations written to {output}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+
+"""
+Launch a local CrateDB cluster consisting of one or more nodes.
+
+A single node cluster behaves exactly like a plain `CrateNode`. With more
+nodes every node gets its own ports and data directory and the nodes
+discover each other via unicast on localhost.
+"""
+
+import socket
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional
+
+from cr8.run_crate import CrateNode
+from crate.client import connect
+
+
+def free_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def node_settings(settings: Dict[str, Any],
+                  num_nodes: int,
+                  transport_ports: List[int],
+                  data_paths: Optional[List[str]] = None) -> List[Dict[str, Any]]:
+    """ Derive the settings of every node of a cluster
+
+    >>> for s in node_settings({'cluster.name': 'c'}, 2, [4300, 4301]):
+    ...     print(sorted(s.items()))
+    [('cluster.initial_master_nodes', 'node-0,node-1'), ('cluster.name', 'c'), ('discovery.seed_hosts', '127.0.0.1:4300,127.0.0.1:4301'), ('node.name', 'node-0'), ('transport.port', 4300)]
+    [('cluster.initial_master_nodes', 'node-0,node-1'), ('cluster.name', 'c'), ('discovery.seed_hosts', '127.0.0.1:4300,127.0.0.1:4301'), ('node.name', 'node-1'), ('transport.port', 4301)]
+
+    >>> node_settings({'cluster.name': 'c'}, 1, [])
+    [{'cluster.name': 'c'}]
+    """
+    if num_nodes == 1:
+        settings = dict(settings)
+        if data_paths:
+            settings['path.data'] = data_paths[0]
+        return [settings]
+    names = [f'node-{i}' for i in range(num_nodes)]
+    seed_hosts = ','.join(f'127.0.0.1:{port}' for port in transport_ports)
+    result = []
+    for i, name in enumerate(names):
+        s = dict(settings)
+        s['node.name'] = name
+        s['transport.port'] = transport_ports[i]
+        s['discovery.seed_hosts'] = seed_hosts
+        s['cluster.initial_master_nodes'] = ','.join(names)
+        if data_paths:
+            s['path.data'] = data_paths[i]
+        result.append(s)
+    return result
+
+
+def wait_for_nodes(http_url: str, num_nodes: int, timeout: int = 120):
+    deadline = time.monotonic() + timeout
+    with connect(http_url) as conn:
+        cursor = conn.cursor()
+        while True:
+            cursor.execute('SELECT count(*) FROM sys.nodes')
+            if cursor.fetchone()[0] >= num_nodes:
+                break
+            if time.monotonic() > deadline:
+                raise TimeoutError(f'Cluster did not reach {num_nodes} nodes in time')
+            time.sleep(0.5)
+        cursor.close()
+
+
+class CrateCluster:
+    """ Starts and stops the nodes of a local cluster together
+
+    Exposes the attributes of `CrateNode` that are used by the benchmark
+    scripts; they refer to the first node unless noted otherwise.
+    """
+
+    def __init__(self,
+                 crate_dir: str,
+                 settings: Dict[str, Any],
+                 env: Optional[Dict[str, Any]] = None,
+                 num_nodes: int = 1,
+                 data_paths: Optional[List[str]] = None):
+        transport_ports = [free_port() for _ in range(num_nodes)] if num_nodes > 1 else []
+        self.nodes = [
+            CrateNode(crate_dir=crate_dir, settings=s, env=dict(env or {}))
+            for s in node_settings(settings, num_nodes, transport_ports, data_paths)
+        ]
+
+    def start(self):
+        """ Start all nodes at once and wait until they formed a cluster
+
+        The nodes must start concurrently, a single node of a cluster can't
+        elect a master and would never become ready.
+        """
+        with ThreadPoolExecutor(max_workers=len(self.nodes)) as executor:
+            list(executor.map(CrateNode.start, self.nodes))
+        if len(self.nodes) > 1:
+            wait_for_nodes(self.http_url, len(self.nodes))
+
+    def stop(self):
+        with ThreadPoolExecutor(max_workers=len(self.nodes)) as executor:
+            list(executor.map(CrateNode.stop, self.nodes))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *ex):
+        self.stop()
+
+    @property
+    def http_url(self) -> str:
+        return self.nodes[0].http_url
+
+    @property
+    def http_hosts(self) -> str:
+        """ HTTP urls of all nodes, cr8 distributes requests across them """
+        return ','.join(n.http_url for n in self.nodes)
+
+    @property
+    def addresses(self):
+        return self.nodes[0].addresses
+
+    @property
+    def cluster_name(self) -> str:
+        return self.nodes[0].cluster_name
+
+    @property
+    def pids(self) -> List[int]:
+        return [n.process.pid for n in self.nodes]
+
+    @property
+    def data_paths(self) -> List[str]:
+        return [n.data_path for n in self.nodes]
+
+    @property
+    def keep_data(self) -> bool:
+        return self.nodes[0].keep_data
+
+    @keep_data.setter
+    def keep_data(self, keep_data: bool):
+        for n in self.nodes:
+            n.keep_data = keep_data
+
+    def pin(self, cmd_prefix):
+        """ Apply `cmd_prefix` (e.g. `pinned_cmd` of a CPU set) to the command of every node """
+        for n in self.nodes:
+            n.cmd = cmd_prefix(n.cmd)
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -9,10 +9,16 @@ The measures files should contain 1 number per line
 """
 
 import argparse
+import functools
+import itertools
+import math
 import numpy as np
 import json
+from typing import List, NamedTuple, Optional, Tuple
 from scipy import stats
 from cr8 import metrics
+from tabulate import tabulate
+from hdr import HdrHistogram, merge_hdr_stats
 from util import perc_diff
 import plotext as plt
 
@@ -21,31 +27,425 @@ import plotext as plt
 # See also: http://stattrek.com/statistics/dictionary.aspx?definition=critical_value
 CRITICAL_VALUE = stats.norm.ppf([0.99])[0]
 
+# Percentiles compared by `tail_diffs`
+TAIL_PERCENTILES = (95, 99, 99.9)
+# Min. number of samples above a tail percentile for it to be checked for regressions
+MIN_TAIL_SAMPLES = 10
+
+# Engines used by `Diff` to decide whether two sets of samples differ:
+#   ttest:  Student's t-test of the means
+#   robust: Mann-Whitney U test, bootstrap CIs of the median and p99 ratio and
+#           the Hodges-Lehmann shift. Doesn't assume normally distributed samples
+STATS_ENGINES = ('ttest', 'robust')
+
+
+def mser_truncation(samples, batch_size=5):
+    """ Number of leading samples that belong to the warm-up (MSER-5)
+
+    Picks the truncation point that minimizes the marginal standard error of
+    the remaining batch means. Only the first half is considered as a
+    truncation point.
+
+    >>> mser_truncation([50.0, 40.0, 30.0, 20.0, 15.0] * 4 + [10.0, 11.0] * 100)
+    20
+
+    >>> mser_truncation([10.0, 11.0] * 100)
+    0
+    """
+    x = np.asarray(samples, dtype=float)
+    m = len(x) // batch_size
+    if m < 4:
+        return 0
+    batch_means = x[:m * batch_size].reshape(m, batch_size).mean(axis=1)
+    # sums over batch_means[d:] for every truncation point d
+    suffix_sum = np.cumsum(batch_means[::-1])[::-1]
+    suffix_sq_sum = np.cumsum(batch_means[::-1] ** 2)[::-1]
+    remaining = np.arange(m, 0, -1)
+    sse = suffix_sq_sum - suffix_sum ** 2 / remaining
+    mser = sse / remaining ** 2
+    return int(np.argmin(mser[:m // 2 + 1])) * batch_size
+
+
+def trim_warmup(runtime_stats):
+    """ Return the stats without the samples of the warm-up phase
+
+    The result contains a `warmup` entry with the number of trimmed samples
+    and their total duration.
+    Samples must be in execution order; with reservoir sampling that's only
+    the case until the reservoir is full. Stats with more iterations than
+    samples are returned untrimmed.
+
+    >>> stats = {'n': 5000, 'mean': 1.0, 'samples': [9.0] * 50 + [1.0] * 950}
+    >>> trim_warmup(stats) is stats
+    True
+    """
+    samples = runtime_stats.get('samples')
+    if not samples or runtime_stats.get('n', len(samples)) > len(samples):
+        return runtime_stats
+    n = mser_truncation(samples)
+    if n == 0:
+        trimmed = dict(runtime_stats)
+    else:
+        trimmed = metrics.Stats(metrics.All)
+        for sample in samples[n:]:
+            trimmed.measure(sample)
+        trimmed = trimmed.get()
+    trimmed['warmup'] = {'n': n, 'duration': float(sum(samples[:n]))}
+    return trimmed
+
+
+def mean_diff_ci(samples1, samples2, confidence=0.95):
+    """ Confidence interval of the difference of the means (Welch)
+
+    The interval is in percent relative to the mean of `samples1`.
+
+    >>> lo, hi = mean_diff_ci(np.array([10.0, 11.0, 9.0, 10.0]), np.array([12.0, 13.0, 11.0, 12.0]))
+    >>> round(lo, 2), round(hi, 2)
+    (5.87, 34.13)
+    """
+    n1, n2 = len(samples1), len(samples2)
+    if n1 < 2 or n2 < 2:
+        return (-math.inf, math.inf)
+    return _welch_ci(n1, samples1.mean(), samples1.std(ddof=1),
+                     n2, samples2.mean(), samples2.std(ddof=1),
+                     confidence)
+
+
+def _welch_ci(n1, mean1, sd1, n2, mean2, sd2, confidence=0.95):
+    if n1 < 2 or n2 < 2:
+        return (-math.inf, math.inf)
+    var1 = sd1 ** 2 / n1
+    var2 = sd2 ** 2 / n2
+    se = math.sqrt(var1 + var2)
+    if se == 0 or mean1 == 0:
+        diff = 0.0 if mean1 == 0 else float((mean2 - mean1) * 100 / mean1)
+        return (diff, diff)
+    df = (var1 + var2) ** 2 / (var1 ** 2 / (n1 - 1) + var2 ** 2 / (n2 - 1))
+    t = stats.t.ppf((1 + confidence) / 2, df)
+    diff = mean2 - mean1
+    return (float((diff - t * se) * 100 / mean1), float((diff + t * se) * 100 / mean1))
+
+
+def sorted_samples(runtime_stats):
+    """ Sorted sample values and their weights
+
+    Weights are None for plain samples. For histograms (`hdr`) the values are
+    the buckets and the weights their counts.
+    """
+    if 'hdr' in runtime_stats:
+        return HdrHistogram.decode(runtime_stats['hdr']).buckets()
+    samples = runtime_stats['samples'] if 'samples' in runtime_stats else [runtime_stats['mean']]
+    return np.sort(np.asarray(samples, dtype=float)), None
+
+
+def moments(runtime_stats):
+    """ Number of samples, mean and standard deviation (ddof=1) """
+    if 'hdr' in runtime_stats:
+        h = HdrHistogram.decode(runtime_stats['hdr'])
+        return h.count, h.mean, h.stdev
+    samples = np.array(runtime_stats.get('samples', [runtime_stats['mean']]))
+    return len(samples), samples.mean(), samples.std(ddof=1)
+
+
+class RobustDiff(NamedTuple):
+    median_ratio_ci: Tuple[float, float]  # change of the median in percent
+    p99_ratio_ci: Tuple[float, float]  # change of the 99th percentile in percent
+    mw_pvalue: float
+    hl_shift: float  # Hodges-Lehmann estimate, in the unit of the samples
+
+
+@functools.lru_cache(maxsize=1024)
+def _order_stat_cdf(n, q):
+    # The q-quantile of a bootstrap resample is its k-th order statistic and
+    # P(x*_(k) <= x_(j)) = P(Binomial(n, j/n) >= k)
+    k = max(1, math.ceil(q * n - 1e-9))
+    cdf = stats.binom.sf(k - 1, n, np.arange(1, n + 1) / n)
+    cdf[-1] = 1.0
+    return cdf
+
+
+def _weighted_order_stat_cdf(weights, q):
+    n = int(weights.sum())
+    k = max(1, math.ceil(q * n - 1e-9))
+    cdf = stats.binom.sf(k - 1, n, np.cumsum(weights) / n)
+    cdf[-1] = 1.0
+    return cdf
+
+
+def bootstrap_quantile(values, q, u, weights=None):
+    """ Bootstrap replicates of the q-quantile of the sorted values
+
+    The replicates are drawn from the exact bootstrap distribution of the
+    order statistic instead of resampling, so the cost is independent of the
+    number of samples. `u` are uniform random numbers, one per replicate.
+    `weights` are the number of occurrences of each value (histogram counts).
+
+    >>> bootstrap_quantile(np.array([1.0, 2.0, 3.0]), 0.5, np.array([0.1, 0.5, 0.99]))
+    array([1., 2., 3.])
+    >>> bootstrap_quantile(np.array([1.0, 2.0]), 0.5, np.array([0.1, 0.5, 0.99]), np.array([1000, 1]))
+    array([1., 1., 1.])
+    """
+    if weights is None:
+        cdf = _order_stat_cdf(len(values), q)
+    else:
+        cdf = _weighted_order_stat_cdf(weights, q)
+    return values[np.searchsorted(cdf, u, side='left')]
+
+
+def _kth_pairwise_diff(x, y, k, wx, wy, max_candidates=1000):
+    # k-th smallest (1-based) of all y_j - x_i (each weighted by wx_i * wy_j),
+    # with x and y sorted. Bisection on the value until few pairs remain in
+    # (lo, hi], the differences below a value are counted with a binary
+    # search per y_j.
+    n = len(x)
+    # cum_x[i]: weight of x[:i]
+    cum_x = np.concatenate([[0], np.cumsum(wx)])
+    lo, hi = float(y[0] - x[-1]) - 1.0, float(y[-1] - x[0])
+    below_lo = 0
+    pairs_lo, pairs_hi = 0, n * len(y)
+    while pairs_hi - pairs_lo > max_candidates:
+        mid = (lo + hi) / 2
+        if mid <= lo or mid >= hi:
+            break
+        idx = np.searchsorted(x, y - mid, side='left')
+        pairs = int((n - idx).sum())
+        count = float(((cum_x[-1] - cum_x[idx]) * wy).sum())
+        if count >= k:
+            hi, pairs_hi = mid, pairs
+        else:
+            lo, pairs_lo, below_lo = mid, pairs, count
+    # Gather the differences in (lo, hi]: x_i in [y_j - hi, y_j - lo)
+    starts = np.searchsorted(x, y - hi, side='left')
+    ends = np.searchsorted(x, y - lo, side='left')
+    lengths = ends - starts
+    rows = np.repeat(np.arange(len(y)), lengths)
+    cols = starts[rows] + np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    candidates = y[rows] - x[cols]
+    order = np.argsort(candidates, kind='stable')
+    weights = np.cumsum((wy[rows] * wx[cols])[order]) + below_lo
+    return float(candidates[order][min(np.searchsorted(weights, k, side='left'), len(order) - 1)])
+
+
+def hodges_lehmann(x, y, wx=None, wy=None):
+    """ Hodges-Lehmann estimate of the shift from x to y
+
+    The median of all pairwise differences y_j - x_i, computed without
+    materializing the n * m differences. `wx` and `wy` are optional weights
+    (histogram counts) of the values.
+
+    >>> hodges_lehmann(np.array([1.0, 2.0, 3.0]), np.array([2.0, 3.0, 4.0]))
+    1.0
+    >>> hodges_lehmann(np.array([10.0, 11.0, 12.0, 50.0]), np.array([12.0, 13.0, 14.0, 60.0]))
+    2.0
+    >>> hodges_lehmann(np.array([1.0, 2.0]), np.array([2.0, 3.0]), np.array([1, 3]), np.array([2, 1]))
+    0.5
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    wx = np.ones(len(x)) if wx is None else np.asarray(wx, dtype=float)
+    wy = np.ones(len(y)) if wy is None else np.asarray(wy, dtype=float)
+    order_x, order_y = np.argsort(x), np.argsort(y)
+    x, wx, y, wy = x[order_x], wx[order_x], y[order_y], wy[order_y]
+    total = int(wx.sum() * wy.sum())
+    lower = _kth_pairwise_diff(x, y, (total + 1) // 2, wx, wy)
+    if total % 2:
+        return lower
+    return (lower + _kth_pairwise_diff(x, y, total // 2 + 1, wx, wy)) / 2
+
+
+def _mann_whitney_weighted(x, wx, y, wy):
+    # Two-sided Mann-Whitney U test (normal approximation with tie and
+    # continuity correction) of values occurring wx/wy times, x and y sorted
+    n1, n2 = wx.sum(), wy.sum()
+    cum_y = np.concatenate([[0], np.cumsum(wy)])
+    below = cum_y[np.searchsorted(y, x, side='left')]
+    equal = cum_y[np.searchsorted(y, x, side='right')] - below
+    u = float((wx * (below + equal / 2)).sum())
+    _, inverse = np.unique(np.concatenate([x, y]), return_inverse=True)
+    ties = np.bincount(inverse, np.concatenate([wx, wy]).astype(float))
+    total = n1 + n2
+    var = n1 * n2 / 12 * ((total + 1) - (ties ** 3 - ties).sum() / (total * (total - 1)))
+    if var <= 0:
+        return 1.0
+    z = (abs(u - n1 * n2 / 2) - 0.5) / math.sqrt(var)
+    return float(min(1.0, 2 * stats.norm.sf(max(z, 0.0))))
+
+
+def _ratio_ci(q1, q2, confidence):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratios = q2 / q1
+    lo, hi = np.percentile(ratios, [(1 - confidence) / 2 * 100, (1 + confidence) / 2 * 100])
+    return (float((lo - 1) * 100), float((hi - 1) * 100))
+
+
+def robust_diffs(pairs, confidence=0.95, n_boot=2000, seed=42) -> List[RobustDiff]:
+    """ Compare many (r1, r2) runtime stats pairs at once
+
+    All pairs share the same random numbers, which keeps the results
+    reproducible and the bootstrap a handful of vectorized operations per pair.
+
+    >>> d, = robust_diffs([({'samples': [10.0, 11.0, 10.5, 10.2] * 10},
+    ...                     {'samples': [12.0, 13.0, 12.5, 12.2] * 10})])
+    >>> round(d.median_ratio_ci[0], 2), d.mw_pvalue < 0.01, d.hl_shift
+    (16.19, True, 2.0)
+    """
+    rng = np.random.default_rng(seed)
+    u1, u2 = rng.random((2, n_boot))
+    result = []
+    for r1, r2 in pairs:
+        x, wx = sorted_samples(r1)
+        y, wy = sorted_samples(r2)
+        median_ci = _ratio_ci(bootstrap_quantile(x, 0.5, u1, wx), bootstrap_quantile(y, 0.5, u2, wy), confidence)
+        p99_ci = _ratio_ci(bootstrap_quantile(x, 0.99, u1, wx), bootstrap_quantile(y, 0.99, u2, wy), confidence)
+        if (x[0] == x[-1] == y[0] == y[-1]):
+            pvalue = 1.0  # identical constant samples
+        elif wx is None and wy is None:
+            pvalue = float(stats.mannwhitneyu(x, y, alternative='two-sided').pvalue)
+        else:
+            pvalue = _mann_whitney_weighted(
+                x, np.ones(len(x)) if wx is None else wx,
+                y, np.ones(len(y)) if wy is None else wy)
+        result.append(RobustDiff(median_ci, p99_ci, pvalue, hodges_lehmann(x, y, wx, wy)))
+    return result
+
+
+class TailDiff(NamedTuple):
+    percentile: float
+    base: float  # value of the percentile of the baseline
+    value: float
+    diff: float  # change in percent
+    ci: Tuple[float, float]  # confidence interval of the change in percent
+    tail_samples: int  # samples above the percentile, the smaller number of both sides
+
+
+def quantile(values, q, weights=None):
+    """ q-quantile (nearest rank) of sorted values, optionally weighted
+
+    >>> quantile(np.array([1.0, 2.0, 3.0, 4.0]), 0.5)
+    2.0
+    >>> quantile(np.array([1.0, 2.0]), 0.99, np.array([99, 2]))
+    2.0
+    """
+    if weights is None:
+        return float(values[max(1, math.ceil(q * len(values) - 1e-9)) - 1])
+    cum = np.cumsum(weights)
+    return float(values[np.searchsorted(cum, max(1, math.ceil(q * cum[-1] - 1e-9)), side='left')])
+
+
+def tail_diffs(pairs, percentiles=TAIL_PERCENTILES, confidence=0.95, n_boot=2000, seed=42) -> List[List[TailDiff]]:
+    """ Compare the tail percentiles of many (r1, r2) runtime stats pairs at once
+
+    The confidence intervals are bootstrapped like in `robust_diffs`.
+
+    >>> tails, = tail_diffs([({'samples': list(range(1, 1001))},
+    ...                       {'samples': list(range(1, 1001)) + [2000] * 100})])
+    >>> [(t.percentile, t.base, t.value, round(t.diff, 2)) for t in tails]
+    [(95, 950.0, 2000.0, 110.53), (99, 990.0, 2000.0, 102.02), (99.9, 999.0, 2000.0, 100.2)]
+    >>> tails[0].ci[0] > 0
+    True
+    >>> [t.tail_samples for t in tails]
+    [50, 10, 1]
+    """
+    rng = np.random.default_rng(seed)
+    u1, u2 = rng.random((2, n_boot))
+    result = []
+    for r1, r2 in pairs:
+        x, wx = sorted_samples(r1)
+        y, wy = sorted_samples(r2)
+        n = min(len(x) if wx is None else wx.sum(), len(y) if wy is None else wy.sum())
+        tails = []
+        for p in percentiles:
+            q = p / 100
+            base = quantile(x, q, wx)
+            value = quantile(y, q, wy)
+            diff = (value / base - 1) * 100 if base else 0.0
+            ci = _ratio_ci(bootstrap_quantile(x, q, u1, wx), bootstrap_quantile(y, q, u2, wy), confidence)
+            tails.append(TailDiff(p, base, value, diff, ci, int(n * (1 - q) + 1e-9)))
+        result.append(tails)
+    return result
+
+
+def tail_regressions(tails: List[TailDiff], threshold: float) -> List[TailDiff]:
+    """ Tail percentiles that are slower by more than `threshold` percent,
+    with the whole confidence interval above the threshold
+
+    Percentiles with less than MIN_TAIL_SAMPLES samples above them are skipped:
+
+    >>> tail_regressions([TailDiff(99, 5.0, 6.0, 20.0, (20.0, 20.0), 0),
+    ...                   TailDiff(95, 5.0, 6.0, 20.0, (15.0, 25.0), 50)], 5)
+    [TailDiff(percentile=95, base=5.0, value=6.0, diff=20.0, ci=(15.0, 25.0), tail_samples=50)]
+    """
+    return [t for t in tails if t.tail_samples >= MIN_TAIL_SAMPLES and t.ci[0] > threshold]
+
+
+def print_tails(labels, tails, baseline=0):
+    """ Print the tail percentiles of each version and their change relative to the baseline
+
+    `tails` are the `tail_diffs` of the `matrix_pairs`.
+    """
+    first = tails[0]
+    print('| Version |' + ''.join(f"{'p' + format(t.percentile, 'g'):>10} {'Δ (95% CI)':^27} |" for t in first))
+    tails = iter(tails)
+    for i, label in enumerate(labels):
+        if i == baseline:
+            print(f'| {label:^7} |' + ''.join(f'{t.base:10.3f} {"baseline":^27} |' for t in first))
+            continue
+        row = ''
+        for t in next(tails):
+            if t.tail_samples < MIN_TAIL_SAMPLES:
+                row += f'{t.value:10.3f} {"insufficient samples":^27} |'
+                continue
+            ci = f'{t.ci[0]:+.2f}% .. {t.ci[1]:+.2f}%'
+            row += f'{t.value:10.3f} {t.diff:+7.2f}% {ci:>18} |'
+        print(f'| {label:^7} |' + row)
+
 
 class Diff:
-    def __init__(self, r1, r2):
+    def __init__(self, r1, r2, engine='ttest', robust: Optional[RobustDiff] = None):
         self.r1 = r1
         self.r2 = r2
-        r1_samples = np.array(r1.get('samples', [r1['mean']]))
-        r2_samples = np.array(r2.get('samples', [r2['mean']]))
-        ind = stats.ttest_ind(r1_samples, r2_samples)
-        self.r1_ci = stats.norm.interval(0.95, loc=r1_samples.mean(), scale=r1_samples.std(ddof=1))
-        self.r2_ci = stats.norm.interval(0.95, loc=r2_samples.mean(), scale=r2_samples.std(ddof=1))
+        n1, mean1, sd1 = moments(r1)
+        n2, mean2, sd2 = moments(r2)
+        ind = stats.ttest_ind_from_stats(mean1, sd1, n1, mean2, sd2, n2)
+        self.r1_ci = stats.norm.interval(0.95, loc=mean1, scale=sd1)
+        self.r2_ci = stats.norm.interval(0.95, loc=mean2, scale=sd2)
         self.mean_diff = perc_diff(r1['mean'], r2['mean'])
-        if 'percentile' not in r1 and len(r1_samples) == 1:
+        self.mean_diff_ci = _welch_ci(n1, mean1, sd1, n2, mean2, sd2)
+        if 'percentile' not in r1 and n1 == 1:
             r1['percentile'] = {
-                '50': r1_samples[0],
-                '75': r1_samples[0],
+                '50': mean1,
+                '75': mean1,
             }
-        if 'percentile' not in r2 and len(r2_samples) == 1:
+        if 'percentile' not in r2 and n2 == 1:
             r2['percentile'] = {
-                '50': r2_samples[0],
-                '75': r2_samples[0],
+                '50': mean2,
+                '75': mean2,
             }
         self.median_diff = perc_diff(r1['percentile']['50'], r2['percentile']['50'])
-        probability = (1 - ind.pvalue) * 100.0
-        self.ptext = f'There is a {probability:.2f}% probability that the observed difference is not random, and the best estimate of that difference is {self.mean_diff:.2f}%'
-        if abs(ind.statistic) >= CRITICAL_VALUE:
+        self.engine = engine
+        self.robust = None
+        if engine == 'robust':
+            self.robust = robust = robust or robust_diffs([(r1, r2)])[0]
+            lo, hi = robust.median_ratio_ci
+            self.pvalue = robust.mw_pvalue
+            self.probability = probability = (1 - robust.mw_pvalue) * 100.0
+            self.ptext = (f'There is a {probability:.2f}% probability (Mann-Whitney U) that the samples differ, '
+                          f'the median changed by {lo:+.2f}% to {hi:+.2f}% (95% CI) '
+                          f'and the best estimate of the shift is {robust.hl_shift:+.3f} (Hodges-Lehmann)')
+            self.is_significant = bool(robust.mw_pvalue < 0.01 and (lo > 0 or hi < 0))
+            # Relative change of the median
+            median1 = r1['percentile']['50']
+            self.effect = (r2['percentile']['50'] / median1 - 1) * 100 if median1 else 0.0
+            self.effect_ci = robust.median_ratio_ci
+        else:
+            self.pvalue = float(ind.pvalue)
+            self.probability = probability = (1 - ind.pvalue) * 100.0
+            self.ptext = f'There is a {probability:.2f}% probability that the observed difference is not random, and the best estimate of that difference is {self.mean_diff:.2f}%'
+            self.is_significant = bool(abs(ind.statistic) >= CRITICAL_VALUE)
+            # Relative change of the mean
+            self.effect = (mean2 / mean1 - 1) * 100 if mean1 else 0.0
+            self.effect_ci = self.mean_diff_ci
+        if self.is_significant:
             self.significance = 'The test has statistical significance'
         else:
             self.significance = 'The test has no statistical significance'
@@ -64,32 +464,219 @@ def print_diff(diff, show_plot=False):
     print(f"|               {mean_prefix}{diff.mean_diff:7.2f}%                           {median_prefix}{diff.median_diff:7.2f}%   ")
     print(f'{diff.ptext}')
     print(f'{diff.significance}')
+    if diff.robust:
+        print_robust(['V2'], [diff.robust])
+    if 'warmup' in diff.r1 and 'warmup' in diff.r2:
+        print_warmup(['V1', 'V2'], [diff.r1, diff.r2])
     print('')
     if show_plot:
         plt.subplots(2, 1)
         plt.subplot(1, 1)
-        plt.scatter(diff.r1.get('samples', diff.r1['mean']), label='v1')
+        plot_samples(diff.r1, 'v1')
         plt.subplot(2, 1)
-        plt.scatter(diff.r2.get('samples', diff.r2['mean']), label='v2')
+        plot_samples(diff.r2, 'v2')
         plt.show()
 
 
-def main(path_old, path_new):
-    r1 = metrics.Stats()
-    r2 = metrics.Stats()
-    with open(path_old) as f:
-        for l in f:
-            r1.measure(float(l))
-    with open(path_new) as f:
-        for l in f:
-            r2.measure(float(l))
-    print_diff(Diff(r1.get(), r2.get()))
+def plot_samples(runtime_stats, label):
+    """ Scatter plot of the samples, or the distribution if the stats contain a histogram """
+    if 'hdr' in runtime_stats:
+        values, counts = HdrHistogram.decode(runtime_stats['hdr']).buckets()
+        plt.plot(values.tolist(), counts.tolist(), label=label)
+        plt.xlabel('ms')
+    else:
+        plt.scatter(runtime_stats.get('samples', runtime_stats['mean']), label=label)
+
+
+def merge_stats(runtime_stats):
+    """ Combine the samples of several runs into a single stats dict
+
+    If any of the runs only has a histogram (`hdr`), the result is a histogram too.
+    """
+    if any('hdr' in r for r in runtime_stats):
+        return merge_hdr_stats(runtime_stats)
+    merged = metrics.Stats(metrics.All)
+    for r in runtime_stats:
+        for sample in r.get('samples', [r['mean']]):
+            merged.measure(sample)
+    return merged.get()
+
+
+def matrix_pairs(runtime_stats, baseline=0):
+    """ The (baseline, other) pairs compared by `print_matrix` """
+    base = runtime_stats[baseline]
+    return [(base, r) for i, r in enumerate(runtime_stats) if i != baseline]
+
+
+def matrix_diffs(runtime_stats, baseline=0, engine='ttest', robust=None):
+    """ `Diff` of each version to the baseline (None for the baseline itself) """
+    base = runtime_stats[baseline]
+    if engine == 'robust' and robust is None:
+        robust = robust_diffs(matrix_pairs(runtime_stats, baseline))
+    robust = iter(robust or [])
+    return [None if i == baseline else Diff(base, r, engine, next(robust, None))
+            for i, r in enumerate(runtime_stats)]
+
+
+def print_matrix(labels, runtime_stats, baseline=0, show_plot=False, engine='ttest', robust=None):
+    """ Print the runtime stats of several versions, each compared to the baseline
+
+    `robust` are the precomputed `robust_diffs` of the `matrix_pairs`. They
+    are computed on the fly if the robust engine is used without them.
+    Returns the `Diff` of each version (None for the baseline).
+    """
+    base = runtime_stats[baseline]
+    diffs = matrix_diffs(runtime_stats, baseline, engine, robust)
+    print('| Version |         Mean ±    Stdev |        Min |     Median |         Q3 |        Max |    Δ Mean |  Δ Median | P(not random) |')
+    for label, r, diff in zip(labels, runtime_stats, diffs):
+        row = f"| {label:^7} |   {r['mean']:10.3f} ± {r['stdev']:8.3f} | {r['min']:10.3f} | {r['percentile']['50']:10.3f} | {r['percentile']['75']:10.3f} | {r['max']:10.3f} |"
+        if diff is None:
+            print(row + '  baseline |           |               |')
+            continue
+        mean_prefix = '+' if base['mean'] < r['mean'] else '-'
+        median_prefix = '+' if base['percentile']['50'] < r['percentile']['50'] else '-'
+        marker = '*' if diff.is_significant else ' '
+        print(row + f" {mean_prefix}{diff.mean_diff:7.2f}% | {median_prefix}{diff.median_diff:7.2f}% |     {diff.probability:6.2f}% {marker} |")
+    if any(d and d.is_significant for d in diffs):
+        print('* statistically significant difference to the baseline')
+    if engine == 'robust':
+        print_robust([label for label, d in zip(labels, diffs) if d], [d.robust for d in diffs if d])
+    if all('warmup' in r for r in runtime_stats):
+        print_warmup(labels, runtime_stats, baseline)
+    print('')
+    if show_plot:
+        plt.subplots(len(runtime_stats), 1)
+        for i, (label, r) in enumerate(zip(labels, runtime_stats), start=1):
+            plt.subplot(i, 1)
+            plot_samples(r, label)
+        plt.show()
+    return diffs
+
+
+def benjamini_hochberg(pvalues):
+    """ Adjust p-values for the false discovery rate (Benjamini-Hochberg)
+
+    A comparison is significant at FDR `alpha` if its adjusted value is below `alpha`.
+
+    >>> benjamini_hochberg([0.01, 0.04, 0.03, 0.5]).round(4).tolist()
+    [0.04, 0.0533, 0.0533, 0.5]
+    """
+    p = np.nan_to_num(np.asarray(pvalues, dtype=float), nan=1.0)
+    n = len(p)
+    if not n:
+        return p
+    order = np.argsort(p)
+    ranked = p[order] * n / np.arange(1, n + 1)
+    adjusted = np.empty(n)
+    adjusted[order] = np.minimum(np.minimum.accumulate(ranked[::-1])[::-1], 1.0)
+    return adjusted
+
+
+class Finding(NamedTuple):
+    key: Tuple[str, int]  # (statement, concurrency)
+    label: str
+    effect: float  # change in percent (mean or median, depending on the engine)
+    effect_ci: Tuple[float, float]
+    pvalue: float
+    qvalue: float
+
+
+def summarize_diffs(diffs, alpha=0.05, min_effect=2.0):
+    """ Select the regressions and improvements of a whole spec
+
+    `diffs` are (key, label, Diff) tuples of all compared queries and
+    versions. The p-values are adjusted with Benjamini-Hochberg and a
+    difference only counts if it's significant at FDR `alpha`, its effect is
+    at least `min_effect` percent and its confidence interval excludes 0.
+    Returns (regressions, improvements), each ranked by the size of the effect.
+
+    >>> from types import SimpleNamespace as D
+    >>> diffs = [(('select 1', 1), 'V2', D(pvalue=0.001, effect=10.0, effect_ci=(5.0, 15.0))),
+    ...          (('select 2', 1), 'V2', D(pvalue=0.02, effect=1.0, effect_ci=(0.5, 1.5))),
+    ...          (('select 3', 1), 'V2', D(pvalue=0.03, effect=-8.0, effect_ci=(-12.0, -1.0))),
+    ...          (('select 4', 1), 'V2', D(pvalue=0.9, effect=30.0, effect_ci=(-10.0, 70.0)))]
+    >>> regressions, improvements = summarize_diffs(diffs)
+    >>> [(f.key[0], f.effect, round(f.qvalue, 3)) for f in regressions + improvements]
+    [('select 1', 10.0, 0.004), ('select 3', -8.0, 0.04)]
+    >>> [f.key[0] for f in summarize_diffs(diffs, alpha=0.01)[0]]
+    ['select 1']
+    """
+    qvalues = benjamini_hochberg([d.pvalue for _, _, d in diffs])
+    findings = [
+        Finding(key, label, d.effect, tuple(d.effect_ci), d.pvalue, float(q))
+        for (key, label, d), q in zip(diffs, qvalues)
+        if q < alpha and abs(d.effect) >= min_effect
+    ]
+    regressions = [f for f in findings if f.effect > 0 and f.effect_ci[0] > 0]
+    improvements = [f for f in findings if f.effect < 0 and f.effect_ci[1] < 0]
+    return (sorted(regressions, key=lambda f: f.effect, reverse=True),
+            sorted(improvements, key=lambda f: f.effect))
+
+
+def print_summary(diffs, alpha=0.05, min_effect=2.0):
+    """ Print the ranked regressions and improvements selected by `summarize_diffs` """
+    regressions, improvements = summarize_diffs(diffs, alpha, min_effect)
+    print(f'# Summary: {len(regressions)} regressions and {len(improvements)} improvements of at least '
+          f'{min_effect:.2f}% in {len(diffs)} comparisons (Benjamini-Hochberg, FDR {alpha:g})')
+    headers = ('Statement', 'C', 'Version', 'Δ %', '95% CI', 'q-value')
+    for title, findings in (('Regressions', regressions), ('Improvements', improvements)):
+        if not findings:
+            continue
+        rows = [
+            (f.key[0][:60], f.key[1], f.label, f.effect, f'{f.effect_ci[0]:+.2f}% .. {f.effect_ci[1]:+.2f}%', f.qvalue)
+            for f in findings
+        ]
+        print('')
+        print(title)
+        print(tabulate(rows, headers=headers, floatfmt=('', '', '', '+.2f', '', '.2g')))
+    print('')
+    return regressions, improvements
+
+
+def print_robust(labels, robust):
+    for label, r in zip(labels, robust):
+        print(f'{label}: median {r.median_ratio_ci[0]:+.2f}% .. {r.median_ratio_ci[1]:+.2f}%, '
+              f'p99 {r.p99_ratio_ci[0]:+.2f}% .. {r.p99_ratio_ci[1]:+.2f}% (95% CI), '
+              f'Hodges-Lehmann shift {r.hl_shift:+.3f}, Mann-Whitney p={r.mw_pvalue:.4f}')
+
+
+def print_warmup(labels, runtime_stats, baseline=0):
+    base = runtime_stats[baseline]['warmup']
+    parts = []
+    for i, (label, r) in enumerate(zip(labels, runtime_stats)):
+        warmup = r['warmup']
+        part = f"{label} {warmup['n']} samples ({warmup['duration']:.3f} ms)"
+        if i != baseline and base['duration']:
+            prefix = '+' if warmup['duration'] >= base['duration'] else '-'
+            part += f" {prefix}{perc_diff(base['duration'], warmup['duration']):.2f}%"
+        parts.append(part)
+    print('Warm-up (trimmed): ' + ', '.join(parts))
+
+
+def read_measures(path, chunk_size=100_000):
+    """ Read a measures file into a histogram, in chunks to keep memory bounded """
+    h = HdrHistogram()
+    with open(path) as f:
+        while True:
+            lines = list(itertools.islice(f, chunk_size))
+            if not lines:
+                break
+            h.record(np.array([float(l) for l in lines if l.strip()]))
+    return h
+
+
+def main(path_old, path_new, engine='ttest'):
+    r1 = read_measures(path_old)
+    r2 = read_measures(path_new)
+    print_diff(Diff(r1.stats(), r2.stats(), engine))
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description=__doc__)
     parser.add_argument('--old', type=str, help='Path to file with old measures')
     parser.add_argument('--new', type=str, help='Path to file with new measures')
+    parser.add_argument('--stats-engine', choices=STATS_ENGINES, default='ttest',
+                        help='Statistics used to compare the measures')
 
     args = parser.parse_args()
-    main(args.old, args.new)
+    main(args.old, args.new, args.stats_engine)
@@ -1,37 +1,306 @@
 #!/usr/bin/env python3
 
 """
-Compare two JSONL files containing the results from cr8 runs (run-spec, timeit..)
+Compare the results from cr8 runs (run-spec, run-track, timeit..) of two
+versions.
+
+`--old` and `--new` are JSONL files, directories (all `*.jsonl` files within,
+recursively) or glob patterns. Results are matched by spec (`meta.name`), query
+name, statement, concurrency and bulk size; results of the same query in
+several files are pooled.
 """
 
 import argparse
-import json
-from compare_measures import Diff, print_diff
+import math
+import os
+import sys
+from glob import glob
+from typing import Any, Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+import orjson
+from tabulate import tabulate
+
+from compare_measures import (
+    STATS_ENGINES,
+    Diff,
+    merge_stats,
+    print_diff,
+    print_summary,
+    print_tails,
+    quantile,
+    robust_diffs,
+    sorted_samples,
+    tail_diffs,
+    tail_regressions,
+    trim_warmup,
+)
+
+
+class ResultKey(NamedTuple):
+    spec: Optional[str]
+    name: Optional[str]
+    statement: str
+    concurrency: int
+    bulk_size: Optional[int]
+
+
+def result_files(path: str) -> List[str]:
+    """ JSONL files of a file, directory or glob pattern """
+    if os.path.isdir(path):
+        files = glob(os.path.join(path, '**', '*.jsonl'), recursive=True)
+    else:
+        files = glob(path)
+    if not files:
+        raise SystemExit(f'No result files found for {path}')
+    return sorted(files)
+
+
+def iter_results(paths: List[str]) -> Iterator[Dict[str, Any]]:
+    for path in paths:
+        with open(path, 'rb') as f:
+            for line in f:
+                if line.strip():
+                    yield orjson.loads(line)
+
+
+def result_key(result: Dict[str, Any]) -> ResultKey:
+    """
+    >>> result_key({'statement': 'select 1', 'concurrency': 2, 'meta': {'name': 'select.toml'}, 'name': 'one'})
+    ResultKey(spec='select.toml', name='one', statement='select 1', concurrency=2, bulk_size=None)
+    """
+    meta = result.get('meta') or {}
+    return ResultKey(
+        meta.get('name'),
+        result.get('name'),
+        result['statement'],
+        result.get('concurrency', 1),
+        result.get('bulk_size')
+    )
+
+
+def query_label(k: ResultKey) -> str:
+    """
+    >>> query_label(ResultKey('select.toml', 'one', 'select 1', 1, None))
+    'select.toml: one'
+    >>> query_label(ResultKey(None, None, 'select 1', 1, None))
+    'select 1'
+    """
+    label = k.name or k.statement
+    return f'{k.spec}: {label}' if k.spec else label
+
+
+def read_results(path: str, trim: bool = True) -> Dict[ResultKey, Dict[str, Any]]:
+    """ Read the runtime stats of all results, pooling the stats of results with the same key """
+    by_key = {}
+    for result in iter_results(result_files(path)):
+        stats = result['runtime_stats']
+        by_key.setdefault(result_key(result), []).append(trim_warmup(stats) if trim else stats)
+    return {k: stats[0] if len(stats) == 1 else merge_stats(stats) for k, stats in by_key.items()}
+
+
+def speedup(stats_old: Dict[str, Any], stats_new: Dict[str, Any], engine: str = 'ttest') -> float:
+    """ Ratio of the old to the new runtime, > 1 if the new version is faster
+
+    The median is used for the robust engine, the mean otherwise. The median
+    is taken from the samples (or histogram), cr8 leaves it out for results
+    with a single sample; without samples the mean is used.
+
+    >>> speedup({'mean': 10.0, 'samples': [8.0, 8.0, 14.0]}, {'mean': 5.0, 'samples': [8.0, 2.0, 5.0]})
+    2.0
+    >>> speedup({'mean': 10.0, 'samples': [8.0, 8.0, 14.0]}, {'mean': 5.0, 'samples': [8.0, 2.0, 5.0]}, 'robust')
+    1.6
+    >>> speedup({'n': 1, 'mean': 6.0}, {'n': 1, 'mean': 3.0}, 'robust')
+    2.0
+    """
+    if engine == 'robust':
+        old, new = _median(stats_old), _median(stats_new)
+    else:
+        old, new = stats_old['mean'], stats_new['mean']
+    if not new:
+        return math.nan
+    return old / new
+
+
+def _median(runtime_stats: Dict[str, Any]) -> float:
+    values, weights = sorted_samples(runtime_stats)
+    return quantile(values, 0.5, weights)
+
+
+def geometric_mean(values: List[float]) -> float:
+    """
+    >>> geometric_mean([2.0, 0.5, 1.0])
+    1.0
+    >>> geometric_mean([4.0, 1.0, math.nan])
+    2.0
+    """
+    values = [v for v in values if v > 0]
+    if not values:
+        return math.nan
+    return math.exp(sum(math.log(v) for v in values) / len(values))
+
+
+def print_missing(title: str, keys: List[ResultKey]):
+    if not keys:
+        return
+    print(f'# {title}')
+    print(tabulate([(k.spec, k.name, k.statement[:60], k.concurrency, k.bulk_size) for k in sorted(keys, key=str)],
+                   headers=('Spec', 'Name', 'Statement', 'C', 'Bulk size')))
+    print('')
+
+
+def print_speedups(speedups: List[Tuple[Optional[str], float]], missing: Dict[Optional[str], int]):
+    """ Print the geometric mean speedup of every spec and of all results (the track) """
+    by_spec = {}
+    for spec, value in speedups:
+        by_spec.setdefault(spec, []).append(value)
+    for spec in missing:
+        by_spec.setdefault(spec, [])
+    rows = [
+        (spec, len(values), missing.get(spec, 0), geometric_mean(values), min(values, default=None),
+         max(values, default=None))
+        for spec, values in sorted(by_spec.items(), key=lambda x: str(x[0]))
+    ]
+    values = [v for _, v in speedups]
+    if values:
+        rows.append(('Total', len(values), sum(missing.values()), geometric_mean(values), min(values), max(values)))
+    print('# Speedup (old / new runtime, geometric mean)')
+    print(tabulate(rows, headers=('Spec', 'Queries', 'Missing', 'Speedup', 'Min', 'Max'), floatfmt='.3f'))
+    print('')
+
+
+def write_record(path: str, path_old: str, path_new: str, pairs: List[Tuple[ResultKey, Dict, Dict]]):
+    """ Write the compared queries in the record format of `compare_run.py --output-json` """
+    record = {
+        'kind': 'compare',
+        'fork': 0,
+        'labels': ['V1', 'V2'],
+        'baseline': 0,
+        'versions': [path_old, path_new],
+        'queries': [
+            {
+                'spec': k.spec,
+                'name': k.name,
+                'statement': k.statement,
+                'concurrency': k.concurrency,
+                'bulk_size': k.bulk_size,
+                'runtime_stats': [stats_old, stats_new],
+            }
+            for k, stats_old, stats_new in pairs
+        ],
+    }
+    with open(path, 'wb') as f:
+        f.write(orjson.dumps(record, option=orjson.OPT_SERIALIZE_NUMPY) + b'\n')
+
 
+def compare(path_old,
+            path_new,
+            trim=True,
+            engine='ttest',
+            tail_threshold=None,
+            fdr=0.05,
+            min_effect=2.0,
+            summary_only=False,
+            output_json=None):
+    """ Print the comparison of all queries
 
-def read_results(path):
-    with open(path, 'r') as f:
-        return [json.loads(l) for l in f]
+    Returns the number of queries with a tail percentile that regressed by
+    more than `tail_threshold` percent. With `output_json` the compared
+    runtime stats are written to a file for html_report.py.
+    """
+    results_old = read_results(path_old, trim)
+    results_new = read_results(path_new, trim)
+    pairs = [(k, stats_old, results_new[k]) for k, stats_old in results_old.items() if k in results_new]
+    only_old = [k for k in results_old if k not in results_new]
+    only_new = [k for k in results_new if k not in results_old]
+    # The robust engine compares all queries in one batch
+    robust = engine == 'robust' and robust_diffs([(old, new) for _, old, new in pairs]) or [None] * len(pairs)
+    tails = tail_diffs([(old, new) for _, old, new in pairs])
+    regressions = []
+    diffs = []
+    speedups = []
+    for (k, stats_old, stats_new), r, query_tails in zip(pairs, robust, tails):
+        diff = Diff(stats_old, stats_new, engine, r)
+        diffs.append(((query_label(k), k.concurrency), 'V2', diff))
+        speedups.append((k.spec, speedup(stats_old, stats_new, engine)))
+        tail_regression = tail_threshold is not None and tail_regressions(query_tails, tail_threshold)
+        regressions.extend(
+            (query_label(k)[:60], k.concurrency, f'p{t.percentile:g}', t.base, t.value, t.diff,
+             f'{t.ci[0]:+.2f}% .. {t.ci[1]:+.2f}%')
+            for t in tail_regression or []
+        )
+        if summary_only:
+            continue
+        if k.spec:
+            print(f'Spec: {k.spec}')
+        if k.name:
+            print(f'Name: {k.name}')
+        print(f'Q: {k.statement}')
+        print(f'C: {k.concurrency}')
+        if k.bulk_size:
+            print(f'Bulk size: {k.bulk_size}')
+        print_diff(diff)
+        print_tails(['V1', 'V2'], [query_tails])
+        if tail_regression:
+            print(f'Tail latency regression of more than {tail_threshold:.2f}%')
+        print('')
+    print_missing('Only in old results', only_old)
+    print_missing('Only in new results', only_new)
+    missing = {}
+    for k in only_old + only_new:
+        missing[k.spec] = missing.get(k.spec, 0) + 1
+    print_speedups(speedups, missing)
+    print_summary(diffs, fdr, min_effect)
+    if tail_threshold is not None:
+        print_tail_regressions(regressions, tail_threshold)
+    if output_json:
+        write_record(output_json, path_old, path_new, pairs)
+    return len({(query, c) for query, c, *_ in regressions})
 
 
-def compare(path_old, path_new):
-    results_old = {(r['statement'], r['concurrency']): r
-                   for r in read_results(path_old)}
-    results_new = {(r['statement'], r['concurrency']): r
-                   for r in read_results(path_new)}
-    for k, result_old in results_old.items():
-        result_new = results_new[k]
-        print(f'Q: {k[0]}')
-        print(f'C: {k[1]}')
-        print_diff(Diff(result_old['runtime_stats'], result_new['runtime_stats']))
+def print_tail_regressions(rows: List[tuple], threshold: float):
+    print('')
+    if rows:
+        print(f'# Tail latency regressions of more than {threshold:.2f}%')
+        headers = ('Query', 'C', 'Percentile', 'Old', 'New', 'Δ %', '95% CI')
+        print(tabulate(rows, headers=headers, floatfmt='.3f'))
+    else:
+        print(f'No tail latency regressions of more than {threshold:.2f}%')
 
 
 def main():
-    parser = argparse.ArgumentParser(description=__doc__)
-    parser.add_argument('--old', type=str, help='Path to file with "old" results')
-    parser.add_argument('--new', type=str, help='Path to file with "new" results')
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--old', type=str, required=True,
+                        help='File, directory or glob pattern with the "old" results')
+    parser.add_argument('--new', type=str, required=True,
+                        help='File, directory or glob pattern with the "new" results')
+    parser.add_argument('--trim-warmup', action=argparse.BooleanOptionalAction, default=True,
+                        help='Exclude the warm-up phase (detected with MSER-5) from the statistics. '
+                        'Results with fewer samples than iterations (reservoir sampling) are not trimmed')
+    parser.add_argument('--stats-engine', choices=STATS_ENGINES, default='ttest',
+                        help='Statistics used to compare the results. '
+                        'robust: Mann-Whitney U, bootstrap CIs of median and p99, Hodges-Lehmann shift')
+    parser.add_argument('--fail-on-tail-regression', type=float, metavar='PERCENT',
+                        help='Exit with 1 if the p95, p99 or p99.9 of a query is slower by more than PERCENT '
+                        'with 95%% confidence. Percentiles with less than 10 samples above them are not checked')
+    parser.add_argument('--fdr', type=float, default=0.05,
+                        help='False discovery rate (Benjamini-Hochberg) across all queries used for the summary')
+    parser.add_argument('--min-effect', type=float, default=2.0,
+                        help='Minimum change in percent for a difference to be listed in the summary')
+    parser.add_argument('--summary-only', action='store_true',
+                        help='Only print the summary of regressions and improvements')
+    parser.add_argument('--output-json', type=str,
+                        help='Write the compared runtime stats to this file. Used by html_report.py')
     args = parser.parse_args()
-    compare(args.old, args.new)
+    if compare(args.old,
+               args.new,
+               args.trim_warmup,
+               args.stats_engine,
+               args.fail_on_tail_regression,
+               args.fdr,
+               args.min_effect,
+               args.summary_only,
+               args.output_json):
+        sys.exit(1)
 
 
 if __name__ == "__main__":
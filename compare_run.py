@@ -2,352 +2,996 @@
 # -*- coding: utf-8 -*-
 
 """
-Script to launch two different crate nodes, run a spec against both nodes and
-compare the results
+Script to launch crate nodes of two or more different versions, run a spec
+against each of them and compare the results
 """
 
 import argparse
 import json
-import os
+import math
 import shutil
-import subprocess
+import sys
 import tempfile
+import time
 import asyncio
+from concurrent.futures import ProcessPoolExecutor
 from functools import partial
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, List, NamedTuple
 from uuid import uuid4
 
+import numpy as np
 from cr8.log import Logger
-from cr8.run_crate import get_crate, CrateNode
+from cr8.run_crate import get_crate
+from cr8.bench_spec import load_spec
 from cr8.run_spec import do_run_spec
-
-from compare_measures import Diff, print_diff
-from indexing_stats import report_indexing_stats, collect_indexing_metrics
-from util import dict_from_kw_args
-
-
-def compare_results(results_v1,
-                    metrics_v1,
-                    stat_resultv1: Dict[str, Any],
-                    indexing_metrics_v1: Dict[str, Any],
-                    results_v2,
-                    metrics_v2,
-                    stat_resultv2: Dict[str, Any],
-                    indexing_metrics_v2: Dict[str, Any],
-                    show_plot):
+from tabulate import tabulate
+
+from cluster import CrateCluster
+from compare_measures import (
+    STATS_ENGINES,
+    matrix_diffs,
+    matrix_pairs,
+    mean_diff_ci,
+    merge_stats,
+    mser_truncation,
+    print_matrix,
+    print_summary,
+    print_tails,
+    robust_diffs,
+    tail_diffs,
+    tail_regressions,
+    trim_warmup,
+)
+from cpu_layout import CpuSet, numa_topology, partition_cpus, pinned_cmd, describe_cpuset, describe_machine
+from hdr import HDR_SAMPLE_MODE, install_hdr_sampler
+from proc_sampler import ProcSampler, print_proc_stats, run_series, summarize, window_series
+from indexing_stats import (
+    IndexingSampler,
+    collect_indexing_metrics,
+    indexing_timeline,
+    print_indexing_timeline,
+    report_indexing_stats,
+)
+from profiling import (
+    init_worker,
+    jfr_diff,
+    jfr_extract_metrics,
+    jfr_overview_cmd,
+    jfr_start,
+    jfr_stop,
+    jfr_write_windows,
+    merge_jfr_metrics,
+    merge_perf_stats,
+    parse_perf_stat,
+    perf_counter,
+    perf_stat,
+    perf_stat_output,
+    PerfQueryStat,
+)
+from setup_cache import SetupCache, wait_for_recovery
+from util import dict_from_kw_args, indexed_kw_args, perc_diff
+
+
+class SpecRun(NamedTuple):
+    results: List[Any]
+    jfr_files: List[str]  # one per node
+    perf_outputs: List[str]  # one per node
+    indexing_metrics: Dict[str, Any]
+    windows_file: Optional[str] = None
+    proc_samples: Optional[List[Any]] = None
+    perf_queries: Optional[Dict[Any, Dict[str, Any]]] = None
+    indexing_samples: Optional[List[Any]] = None
+
+
+class VersionReport(NamedTuple):
+    label: str
+    results: List[Any]
+    metrics: Dict[str, Any]
+    perf_stats: Dict[str, Any]
+    indexing_metrics: Dict[str, Any]
+    cpuset: Optional[CpuSet] = None
+    proc_samples: Optional[List[Any]] = None
+    perf_queries: Optional[Dict[Any, Dict[str, Any]]] = None
+    node_metrics: Optional[List[Dict[str, Any]]] = None
+    node_perf_stats: Optional[List[Dict[str, Any]]] = None
+    indexing_samples: Optional[List[Any]] = None
+
+
+def _jvm_metrics_row(label: str, m: Dict[str, Any], width: int) -> str:
+    ns_to_ms = 0.000001
+    byte_to_mb = 0.000001
+    gcy_cnt = m['gc']['young']['count']
+    gcy_avg = m['gc']['young']['avg_duration_ns'] * ns_to_ms
+    gcy_max = m['gc']['young']['max_duration_ns'] * ns_to_ms
+    gco_cnt = m['gc']['old']['count']
+    gco_avg = m['gc']['old']['avg_duration_ns'] * ns_to_ms
+    gco_max = m['gc']['old']['max_duration_ns'] * ns_to_ms
+    heap_used = m['heap']['used'] * byte_to_mb
+    heap_init = m['heap']['initial'] * byte_to_mb
+    alloc_rate = m['alloc']['rate'] * byte_to_mb
+    alloc_total = m['alloc']['total'] * byte_to_mb
+    return f' {label:>{width}} | {gcy_cnt:4.0f} {gcy_avg:8.2f} {gcy_max:8.2f} | {gco_cnt:4.0f} {gco_avg:8.2f} {gco_max:8.2f} | {heap_init:8.0f} {heap_used:8.0f} | {alloc_rate:8.2f} {alloc_total:10.0f}'
+
+
+def _diffs_by_query(diff_fn, runtime_stats_by_query, baseline: int) -> Dict[Any, List]:
+    """ Apply a batched diff function (robust_diffs, tail_diffs) to the pairs of all queries at once """
+    pairs = {k: matrix_pairs(stats, baseline) for k, stats in runtime_stats_by_query.items()}
+    diffs = iter(diff_fn([pair for k_pairs in pairs.values() for pair in k_pairs]))
+    return {k: [next(diffs) for _ in k_pairs] for k, k_pairs in pairs.items()}
+
+
+def compare_results(reports: List[VersionReport],
+                    baseline: int,
+                    show_plot,
+                    layout: Optional[str] = None,
+                    trim: bool = True,
+                    engine: str = 'ttest',
+                    fdr: float = 0.05,
+                    min_effect: float = 2.0,
+                    summary_only: bool = False):
+    labels = [r.label for r in reports]
     print('')
     print('')
     print('# Results (server side duration in ms)')
-    v1 = results_v1[0].version_info
-    v2 = results_v2[0].version_info
-    print(f"V1: {v1['number']}-{v1['hash']}")
-    print(f"V2: {v2['number']}-{v2['hash']}")
+    for i, report in enumerate(reports):
+        v = report.results[0].version_info
+        cpus = report.cpuset and f' [{describe_cpuset(report.cpuset)}]' or ''
+        marker = ' (baseline)' if i == baseline else ''
+        print(f"{report.label}: {v['number']}-{v['hash']}{cpus}{marker}")
+    if layout:
+        print(f"Machine: {layout}")
     print('')
 
-    results_v1 = {(r.statement, r.concurrency): r for r in results_v1}
-    results_v2 = {(r.statement, r.concurrency): r for r in results_v2}
-    for k, result_v1 in results_v1.items():
-        result_v2 = results_v2[k]
+    results = [{(r.statement, r.concurrency): r for r in report.results} for report in reports]
+    windows = [
+        {(r.statement, r.concurrency): w for r, w in zip(report.results, report.metrics.get('windows', []))}
+        for report in reports
+    ]
+    runtime_stats_by_query = {}
+    for k in results[baseline]:
+        if all(k in r for r in results):
+            runtime_stats = [r[k].runtime_stats for r in results]
+            if trim:
+                runtime_stats = [trim_warmup(stats) for stats in runtime_stats]
+            runtime_stats_by_query[k] = runtime_stats
+    robust = engine == 'robust' and _diffs_by_query(robust_diffs, runtime_stats_by_query, baseline) or {}
+    tails = _diffs_by_query(tail_diffs, runtime_stats_by_query, baseline)
+    summary_diffs = []
+    for k in results[baseline]:
+        if summary_only:
+            if k in runtime_stats_by_query:
+                diffs = matrix_diffs(runtime_stats_by_query[k], baseline, engine, robust.get(k))
+                summary_diffs.extend((k, label, d) for label, d in zip(labels, diffs) if d)
+            continue
+        missing = [label for label, r in zip(labels, results) if k not in r]
         print(f'Q: {k[0]}')
         print(f'C: {k[1]}')
-        print_diff(Diff(result_v1.runtime_stats, result_v2.runtime_stats), show_plot)
-
-    ns_to_ms = 0.000001
-    v1_gcy_cnt = metrics_v1['gc']['young']['count']
-    v2_gcy_cnt = metrics_v2['gc']['young']['count']
-    v1_gcy_avg = metrics_v1['gc']['young']['avg_duration_ns'] * ns_to_ms
-    v2_gcy_avg = metrics_v2['gc']['young']['avg_duration_ns'] * ns_to_ms
-    v1_gcy_max = metrics_v1['gc']['young']['max_duration_ns'] * ns_to_ms
-    v2_gcy_max = metrics_v2['gc']['young']['max_duration_ns'] * ns_to_ms
-
-    v1_gco_cnt = metrics_v1['gc']['old']['count']
-    v2_gco_cnt = metrics_v2['gc']['old']['count']
-    v1_gco_avg = metrics_v1['gc']['old']['avg_duration_ns'] * ns_to_ms
-    v2_gco_avg = metrics_v2['gc']['old']['avg_duration_ns'] * ns_to_ms
-    v1_gco_max = metrics_v1['gc']['old']['max_duration_ns'] * ns_to_ms
-    v2_gco_max = metrics_v2['gc']['old']['max_duration_ns'] * ns_to_ms
-
-    byte_to_mb = 0.000001
-    v1_heap_used = metrics_v1['heap']['used'] * byte_to_mb
-    v2_heap_used = metrics_v2['heap']['used'] * byte_to_mb
-    v1_heap_init = metrics_v1['heap']['initial'] * byte_to_mb
-    v2_heap_init = metrics_v2['heap']['initial'] * byte_to_mb
-
-    v1_alloc_rate = metrics_v1['alloc']['rate'] * byte_to_mb
-    v2_alloc_rate = metrics_v2['alloc']['rate'] * byte_to_mb
-    v1_alloc_total = metrics_v1['alloc']['total'] * byte_to_mb
-    v2_alloc_total = metrics_v2['alloc']['total'] * byte_to_mb
+        if missing:
+            print(f'Skipped, no results for {", ".join(missing)}')
+            print('')
+            continue
+        diffs = print_matrix(labels, runtime_stats_by_query[k], baseline, show_plot, engine, robust.get(k))
+        summary_diffs.extend((k, label, d) for label, d in zip(labels, diffs) if d)
+        print_tails(labels, tails[k], baseline)
+        print('')
+        if all(k in w for w in windows):
+            print_query_profile(labels, [w[k] for w in windows])
+            print('')
+        if all(report.proc_samples for report in reports):
+            series = [window_series(report.proc_samples, r[k].started, r[k].ended)
+                      for report, r in zip(reports, results)]
+            if all(series):
+                print_proc_stats(labels, series)
+                print('')
+        if all(report.indexing_samples for report in reports):
+            timelines = [indexing_timeline(report.indexing_samples, r[k].started, r[k].ended)
+                         for report, r in zip(reports, results)]
+            if all(timelines):
+                print_indexing_timeline(labels, timelines)
+                print('')
+        if all(report.perf_queries and k in report.perf_queries for report in reports):
+            print_perf_query_stats(labels, [report.perf_queries[k] for report in reports], baseline)
+            print('')
+
+    print_summary(summary_diffs, fdr, min_effect)
+    if summary_only:
+        return
+
+    # With several nodes per version each node gets its own row below the cluster total
+    rows = []
+    for report in reports:
+        rows.append((report.label, report.metrics))
+        if report.node_metrics and len(report.node_metrics) > 1:
+            rows.extend((f'{report.label} n{i}', m) for i, m in enumerate(report.node_metrics))
+    width = max(len(label) for label, _ in rows)
+    pad = ' ' * (width + 2)
     print(f'''
 System/JVM Metrics (durations in ms, byte-values in MB)
-    |    YOUNG GC            |       OLD GC           |      HEAP         |     ALLOC     
-    |  cnt      avg      max |  cnt      avg      max |  initial     used |     rate      total
- V1 | {v1_gcy_cnt:4.0f} {v1_gcy_avg:8.2f} {v1_gcy_max:8.2f} | {v1_gco_cnt:4.0f} {v1_gco_avg:8.2f} {v1_gco_max:8.2f} | {v1_heap_init:8.0f} {v1_heap_used:8.0f} | {v1_alloc_rate:8.2f} {v1_alloc_total:10.0f}
- V2 | {v2_gcy_cnt:4.0f} {v2_gcy_avg:8.2f} {v2_gcy_max:8.2f} | {v2_gco_cnt:4.0f} {v2_gco_avg:8.2f} {v2_gco_max:8.2f} | {v2_heap_init:8.0f} {v2_heap_used:8.0f} | {v2_alloc_rate:8.2f} {v2_alloc_total:10.0f}
-    ''')
+{pad}|    YOUNG GC            |       OLD GC           |      HEAP         |     ALLOC     
+{pad}|  cnt      avg      max |  cnt      avg      max |  initial     used |     rate      total''')
+    for label, m in rows:
+        print(_jvm_metrics_row(label, m, width))
+    print('')
     print('Top allocation frames')
-    print('  V1')
-    for frame in metrics_v1['alloc']['top_frames_by_alloc']:
-        print('    ' + frame)
-    print('  V2')
-    for frame in metrics_v2['alloc']['top_frames_by_alloc']:
-        print('    ' + frame)
+    for report in reports:
+        print(f'  {report.label}')
+        for frame in report.metrics['alloc']['top_frames_by_alloc']:
+            print('    ' + frame)
 
     print('')
     print('Top frames (by count)')
-    print('  V1')
-    for frame in metrics_v1['alloc']['top_frames_by_count']:
-        print('    ' + frame)
-    print('  V2')
-    for frame in metrics_v2['alloc']['top_frames_by_count']:
-        print('    ' + frame)
-
-    if stat_resultv1:
+    for report in reports:
+        print(f'  {report.label}')
+        for frame in report.metrics['alloc']['top_frames_by_count']:
+            print('    ' + frame)
+
+    proc_series = [(r.label, run_series(r.proc_samples)) for r in reports]
+    proc_series = [(label, series) for label, series in proc_series if series]
+    if proc_series:
+        print('')
+        print('Process metrics (/proc, CPU in % of a core)')
+        print_proc_stats([label for label, _ in proc_series], [series for _, series in proc_series])
+
+    if all(r.perf_stats for r in reports):
         print("")
         print("perf stat")
-        print("  v1")
-        max_digits = max(
-            len(str(int(float(x.get("metric-value", x.get("counter-value", 0))))))
-            for x in stat_resultv1.values()
-        )
-        max_keylen = max(
-            len(x)
-            for x in stat_resultv1.keys()
-        )
-        for k, v in stat_resultv1.items():
-            print("    " + format_perf_stat_value(k, v, max_digits, max_keylen))
-        print("  v2")
-        for k, v in stat_resultv2.items():
-            print("    " + format_perf_stat_value(k, v, max_digits, max_keylen))
-
-    if indexing_metrics_v1:
-        report_indexing_stats(indexing_metrics_v1, indexing_metrics_v2)
+        print_perf_stat_matrix([r.perf_stats for r in reports], labels, baseline)
+        node_perf_stats = [r.node_perf_stats or [] for r in reports]
+        if all(len(stats) > 1 for stats in node_perf_stats):
+            for i, stats in enumerate(zip(*node_perf_stats)):
+                print('')
+                print(f'perf stat (node-{i})')
+                print_perf_stat_matrix(list(stats), labels, baseline)
+
+    if reports[baseline].indexing_metrics:
+        report_indexing_stats([r.indexing_metrics for r in reports], labels)
+        for node in reports[baseline].indexing_metrics.get('nodes', {}):
+            report_indexing_stats(
+                [r.indexing_metrics.get('nodes', {}).get(node, {}) for r in reports],
+                labels,
+                f'Indexing statistics of the primary shards on {node}'
+            )
 
 
-def format_perf_stat_value(k: str, v: Dict[str, Any], max_digits: int, max_keylen: int) -> str:
-    max_digits += 4
-    parts = [
-        f"{k:<{max_keylen}}: "
-    ]
-    if "metric-value" in v:
-        parts.append(f"{float(v["metric-value"]): {max_digits}.2f}")
-    elif "counter-value" in v:
-        parts.append(f"{float(v["counter-value"]): {max_digits}.2f}")
-    unit = v.get("unit", "")
-    if unit:
-        parts.append(unit)
-    return "".join(parts)
-
-
-def jfr_start(pid, tmpdir):
-    java_home = os.environ.get('JAVA_HOME')
-    jcmd = java_home and os.path.join(java_home, 'bin', 'jcmd') or 'jcmd'
-    filename = os.path.join(tmpdir, str(uuid4()) + '.jfr')
-    subprocess.check_call([
-        jcmd,
-        str(pid),
-        'JFR.start',
-        f'filename="{filename}"',
-        'name=rec',
-        'settings=profile',
-        'maxsize=50m',
-        'maxage=10m'
-    ])
-    return filename
-
-
-def jfr_stop(pid):
-    java_home = os.environ.get('JAVA_HOME')
-    jcmd = java_home and os.path.join(java_home, 'bin', 'jcmd') or 'jcmd'
-    subprocess.check_call([jcmd, str(pid), 'JFR.stop', 'name=rec'])
-
-
-def jfr_extract_metrics(filename) -> Dict[str, Any]:
-    java_home = os.environ.get('JAVA_HOME')
-    java = java_home and os.path.join(java_home, 'bin', 'java') or 'java'
-    cmd = [java, 'JfrOverview.java', filename]
-    output = subprocess.check_output(cmd, universal_newlines=True)
-    return json.loads(output)
-
-
-def perf_stat(pid: int) -> Optional[subprocess.Popen]:
-    cmd = [
-        "perf",
-        "stat",
-        "-j",
-        "-d",
-        "-e", "branches,cache-misses,instructions,faults,context-switches",
-        "-p", str(pid)
+def report_record(fork: int, reports: List[VersionReport], baseline: int, trim: bool = True) -> Dict[str, Any]:
+    """ JSON serializable results and metrics of a fork, as written by --output-json and read by html_report.py """
+    queries = {}
+    for i, report in enumerate(reports):
+        for r in report.results:
+            query = queries.setdefault((r.statement, r.concurrency), {
+                'name': r.name,
+                'statement': r.statement,
+                'concurrency': r.concurrency,
+                'bulk_size': r.bulk_size,
+                'runtime_stats': [None] * len(reports),
+                'indexing_timeline': [None] * len(reports),
+            })
+            query['runtime_stats'][i] = trim_warmup(r.runtime_stats) if trim else r.runtime_stats
+            if report.indexing_samples:
+                query['indexing_timeline'][i] = indexing_timeline(report.indexing_samples, r.started, r.ended)
+    return {
+        'kind': 'compare',
+        'fork': fork,
+        'labels': [r.label for r in reports],
+        'baseline': baseline,
+        'versions': [r.results and r.results[0].version_info or None for r in reports],
+        'queries': list(queries.values()),
+        'jvm': [{k: v for k, v in r.metrics.items() if k != 'windows'} for r in reports],
+        'proc': [
+            summarize(series) if series else None
+            for series in (run_series(r.proc_samples) for r in reports)
+        ],
+        'indexing': [r.indexing_metrics for r in reports],
+    }
+
+
+def print_query_profile(labels: List[str], windows: List[Dict[str, Any]]):
+    """ Print the JFR metrics recorded while a single query ran """
+    ns_to_ms = 0.000001
+    byte_to_mb = 0.000001
+    rows = []
+    for label, w in zip(labels, windows):
+        young = w['gc']['young']
+        old = w['gc']['old']
+        rows.append([
+            label,
+            (w['cpu']['jvm_user'] + w['cpu']['jvm_system']) * 100,
+            young['count'],
+            young['total_duration_ns'] * ns_to_ms,
+            old['count'],
+            old['total_duration_ns'] * ns_to_ms,
+            w['alloc']['rate'] * byte_to_mb,
+        ])
+    print(tabulate(
+        rows,
+        headers=['', 'JVM CPU %', 'Young GC', 'Young ms', 'Old GC', 'Old ms', 'Alloc MB/s'],
+        floatfmt='.2f'
+    ))
+    print('Hot frames')
+    for label, w in zip(labels, windows):
+        # frames are formatted as "<method> total=<n>, count=<n>"
+        frames = [f.split(' total=')[0] for f in w['cpu']['top_frames'][:3]]
+        print(f'  {label}: {", ".join(frames) or "-"}')
+
+
+def print_perf_query_stats(labels: List[str], perf_queries: List[Dict[str, Any]], baseline: int):
+    """ Print CPU efficiency metrics of a single query based on perf counters """
+    rows = []
+    per_execution = []
+    for label, q in zip(labels, perf_queries):
+        events = q['events']
+        executions = q['executions'] or 1
+        cycles = perf_counter(events, 'cycles')
+        instructions = perf_counter(events, 'instructions')
+        cache_refs = perf_counter(events, 'cache-references')
+        cache_misses = perf_counter(events, 'cache-misses')
+        branches = perf_counter(events, 'branches')
+        branch_misses = perf_counter(events, 'branch-misses')
+        per_execution.append(instructions and instructions / executions)
+        rows.append([
+            label,
+            cycles and instructions and instructions / cycles,
+            cache_refs and cache_misses is not None and cache_misses / cache_refs * 100,
+            branches and branch_misses is not None and branch_misses / branches * 100,
+            per_execution[-1],
+            cycles and cycles / executions,
+        ])
+    base = per_execution[baseline]
+    for i, row in enumerate(rows):
+        value = per_execution[i]
+        if i == baseline:
+            row.append('baseline')
+        elif base and value:
+            row.append(f'{"+" if value >= base else "-"}{perc_diff(base, value):.2f}%')
+        else:
+            row.append('')
+    print(tabulate(
+        rows,
+        headers=['', 'IPC', 'Cache miss %', 'Branch miss %', 'Instr/exec', 'Cycles/exec', 'Δ Instr/exec'],
+        floatfmt='.2f',
+        missingval='-'
+    ))
+
+
+def _perf_stat_value(v: Dict[str, Any]) -> float:
+    return float(v.get("metric-value", v.get("counter-value", 0)))
+
+
+def print_perf_stat_matrix(perf_stats: List[Dict[str, Any]], labels: List[str], baseline: int):
+    base = perf_stats[baseline]
+    max_digits = max(
+        len(str(int(_perf_stat_value(x))))
+        for stats in perf_stats
+        for x in stats.values()
+    ) + 4
+    max_keylen = max(len(x) for x in base.keys())
+    header = ''.join(f' {label:>{max_digits + 3}}' for label in labels)
+    print(f"  {'':<{max_keylen}} {header}")
+    for k, v in base.items():
+        parts = [f"  {k:<{max_keylen}}:"]
+        base_value = _perf_stat_value(v)
+        for i, stats in enumerate(perf_stats):
+            if k not in stats:
+                parts.append(f" {'-':>{max_digits + 3}}")
+                continue
+            value = _perf_stat_value(stats[k])
+            parts.append(f" {value:{max_digits + 3}.2f}")
+        parts.append(' ' + v.get("unit", ""))
+        diffs = [
+            f'{labels[i]} {"+" if _perf_stat_value(stats[k]) >= base_value else "-"}{perc_diff(base_value, _perf_stat_value(stats[k])):.2f}%'
+            for i, stats in enumerate(perf_stats)
+            if i != baseline and k in stats
+        ]
+        if diffs:
+            parts.append(f"  ({', '.join(diffs)})")
+        print("".join(parts))
+
+
+def pool_runtime_stats(pool: Dict[Any, List[List[Dict[str, Any]]]], runs: List[SpecRun], trim: bool):
+    """ Add the runtime stats of a fork to `pool`, grouped by query and version """
+    for i, run in enumerate(runs):
+        for r in run.results:
+            per_version = pool.setdefault((r.statement, r.concurrency), [[] for _ in runs])
+            per_version[i].append(trim_warmup(r.runtime_stats) if trim else r.runtime_stats)
+
+
+def report_tail_regressions(labels: List[str],
+                            baseline: int,
+                            pool: Dict[Any, List[List[Dict[str, Any]]]],
+                            threshold: float) -> List[tuple]:
+    """ Print and return the tail percentiles of the pooled forks that regressed by more than `threshold` percent """
+    pooled = {k: [merge_stats(stats) for stats in per_version] for k, per_version in pool.items() if all(per_version)}
+    tails = _diffs_by_query(tail_diffs, pooled, baseline)
+    others = [label for i, label in enumerate(labels) if i != baseline]
+    rows = [
+        (k[0][:60], k[1], label, f'p{t.percentile:g}', t.base, t.value, t.diff, f'{t.ci[0]:+.2f}% .. {t.ci[1]:+.2f}%')
+        for k, per_version in tails.items()
+        for label, query_tails in zip(others, per_version)
+        for t in tail_regressions(query_tails, threshold)
     ]
-    try:
-        return subprocess.Popen(
-            cmd,
-            text=True,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE
-        )
-    except FileNotFoundError:
-        return None
-
-
-def perf_stat_results(proc: subprocess.Popen) -> Dict[str, Any]:
-    # perf stat -j returns json lines like:
-    # {"counter-value" : "0.445654", "unit" : "msec", "event" : "task-clock", "event-runtime" : 445654, "pcnt-running" : 100.00, "metric-value" : "0.575812", "metric-unit" : "CPUs utilized"}
-    stdout, stderr = proc.communicate()
-    metrics = {}
-    for line in stderr.split("\n"):
-        if line:
-            event_metrics = json.loads(line)
-            metrics[event_metrics["event"]] = event_metrics
-    return metrics
-
-
-async def _run_spec(version, spec, result_hosts, env, settings, tmpdir, protocol, report_indexing):
+    print('')
+    if rows:
+        print(f'# Tail latency regressions of more than {threshold:.2f}% (pooled over all forks)')
+        headers = ('Statement', 'C', 'Version', 'Percentile', labels[baseline], 'Value', 'Δ %', '95% CI')
+        print(tabulate(rows, headers=headers, floatfmt='.3f'))
+    else:
+        print(f'No tail latency regressions of more than {threshold:.2f}%')
+    return rows
+
+
+class SequentialTest:
+    """ Pools the samples of each query across forks and tracks whether the
+    confidence interval of the mean difference to the baseline is narrow enough
+
+    The interval is a t-interval over the per-fork means, so that it includes
+    the between-fork variance. It is infinite with less than two forks.
+
+    >>> test = SequentialTest(['V1', 'V2'], 0, 5.0)
+    >>> test.runtime_stats[('select 1', 1)] = [
+    ...     [{'n': 1000, 'mean': 10.0}, {'n': 1000, 'mean': 11.0}, {'n': 1000, 'mean': 10.5}],
+    ...     [{'n': 1000, 'mean': 10.2}, {'n': 1000, 'mean': 11.1}, {'n': 1000, 'mean': 10.8}],
+    ... ]
+    >>> round(test.ci_width(('select 1', 1)), 2)
+    20.77
+    """
+
+    def __init__(self,
+                 labels: List[str],
+                 baseline: int,
+                 target_ci_width: float,
+                 trim: bool = True,
+                 engine: str = 'ttest'):
+        self.labels = labels
+        self.trim = trim
+        self.engine = engine
+        self.baseline = baseline
+        self.target_ci_width = target_ci_width
+        self.runtime_stats = {}
+        self.converged_at = {}
+
+    def add(self, forks: int, runs: List[SpecRun]):
+        pool_runtime_stats(self.runtime_stats, runs, self.trim)
+        for key in self.runtime_stats:
+            if key not in self.converged_at and self.ci_width(key) <= self.target_ci_width:
+                self.converged_at[key] = forks
+
+    def pooled(self, key) -> List[Dict[str, Any]]:
+        return [merge_stats(stats) for stats in self.runtime_stats[key]]
+
+    def ci_width(self, key) -> float:
+        if not all(self.runtime_stats[key]):
+            return math.inf
+        fork_means = [np.array([r['mean'] for r in forks]) for forks in self.runtime_stats[key]]
+        base = fork_means[self.baseline]
+        widths = [
+            hi - lo
+            for i, means in enumerate(fork_means) if i != self.baseline
+            for lo, hi in (mean_diff_ci(base, means),)
+        ]
+        return max(widths)
+
+    @property
+    def done(self) -> bool:
+        return len(self.converged_at) == len(self.runtime_stats)
+
+    def report(self, forks: int):
+        print('')
+        print(f'# Pooled results over {forks} forks (server side duration in ms)')
+        print('')
+        rows = []
+        for key in self.runtime_stats:
+            pooled = self.pooled(key)
+            print(f'Q: {key[0]}')
+            print(f'C: {key[1]}')
+            if all(self.runtime_stats[key]):
+                print_matrix(self.labels, pooled, self.baseline, engine=self.engine)
+            converged_at = self.converged_at.get(key)
+            rows.append((
+                key[0][:60],
+                key[1],
+                converged_at or f'> {forks}',
+                self.ci_width(key),
+                *(r.get('n', 0) for r in pooled)
+            ))
+        print(f'Forks needed to reach a CI width (95%) of the mean difference of {self.target_ci_width:.2f}%')
+        headers = ('Statement', 'C', 'Forks', 'CI width %', *(f'n {label}' for label in self.labels))
+        print(tabulate(rows, headers=headers, floatfmt='.2f'))
+
+
+def _benchmark_hosts(cluster: CrateCluster, protocol: str) -> str:
+    if protocol == 'pg':
+        pg_address = cluster.addresses['psql']
+        return f'asyncpg://{pg_address.host}:{pg_address.port}'
+    return cluster.http_url
+
+
+async def _run_spec(version,
+                    spec,
+                    result_hosts,
+                    env,
+                    settings,
+                    tmpdir,
+                    protocol,
+                    report_indexing,
+                    cpuset: Optional[CpuSet] = None,
+                    setup_cache: Optional[SetupCache] = None,
+                    slot: str = 'v1',
+                    sample_mode: str = 'reservoir',
+                    proc_interval: float = 0.1,
+                    perf_per_query: bool = False,
+                    num_nodes: int = 1,
+                    re_name: Optional[str] = None,
+                    trim: bool = True,
+                    indexing_interval: float = 1.0):
     crate_dir = get_crate(version)
     settings.setdefault('cluster.name', str(uuid4()))
     results = []
-    with Logger() as log, CrateNode(crate_dir=crate_dir, settings=settings, env=env) as n:
-        n.start()
-        benchmark_hosts = n.http_url
-        if protocol == 'pg':
-            pg_address = n.addresses['psql']
-            benchmark_hosts = f'asyncpg://{pg_address.host}:{pg_address.port}'
+    cache_keys = None
+    cached = None
+    data_paths = None
+    cluster_settings = settings
+    if setup_cache and 'path.data' not in settings:
+        # One cache entry per node, the setup is only restored if all nodes have one
+        cache_keys = [
+            setup_cache.key(spec, crate_dir, settings, num_nodes > 1 and f'{slot}-{num_nodes}-{i}' or slot)
+            for i in range(num_nodes)
+        ]
+        cluster_settings = dict(settings)
+        data_paths = [tempfile.mkdtemp(dir=tmpdir) for _ in range(num_nodes)]
+        if all(setup_cache.contains(key) for key in cache_keys):
+            restored = []
+            for key, path in zip(cache_keys, data_paths):
+                restored.append(setup_cache.restore(key, path))
+            cached = restored[0]
+            cluster_settings['cluster.name'] = cached['cluster_name']
+    with Logger() as log, CrateCluster(crate_dir, cluster_settings, env, num_nodes, data_paths) as cluster:
+        if cpuset:
+            cluster.pin(partial(pinned_cmd, cpuset=cpuset))
+        # Blocking calls are moved to threads so that nodes of a parallel
+        # run can start and be profiled concurrently
+        await asyncio.to_thread(cluster.start)
+        benchmark_hosts = _benchmark_hosts(cluster, protocol)
+        if cached:
+            log.info(f'# Restored setup from cache entries {", ".join(cache_keys)}')
+            await asyncio.to_thread(wait_for_recovery, cluster.http_url)
+        else:
+            await do_run_spec(
+                spec=spec,
+                benchmark_hosts=benchmark_hosts,
+                log=log,
+                result_hosts=result_hosts,
+                sample_mode='reservoir',
+                action='setup'
+            )
+            if cache_keys:
+                # The nodes must be stopped to get a consistent copy of the
+                # data directories; all forks then start from the same state
+                log.info(f'# Storing setup in cache entries {", ".join(cache_keys)}')
+                cluster.keep_data = True
+                await asyncio.to_thread(cluster.stop)
+                for key, path in zip(cache_keys, cluster.data_paths):
+                    setup_cache.store(key, path, cluster.cluster_name)
+                cluster.keep_data = False
+                await asyncio.to_thread(cluster.start)
+                await asyncio.to_thread(wait_for_recovery, cluster.http_url)
+                benchmark_hosts = _benchmark_hosts(cluster, protocol)
         print(f'Running benchmark using protocol={protocol}, benchmark_hosts={benchmark_hosts}')
-        await do_run_spec(
-            spec=spec,
-            benchmark_hosts=benchmark_hosts,
-            log=log,
-            result_hosts=result_hosts,
-            sample_mode='reservoir',
-            action='setup'
+        pids = cluster.pids
+        jfr_files = await asyncio.gather(*(asyncio.to_thread(jfr_start, pid, tmpdir) for pid in pids))
+        # A per-query perf process would compete with the whole-run one for counters
+        perf_procs = [] if perf_per_query else [perf_stat(pid) for pid in pids]
+        sampler = proc_interval and ProcSampler(pids, proc_interval).start() or None
+        indexing_sampler = (
+            report_indexing and indexing_interval and IndexingSampler(cluster.http_url, indexing_interval).start()
+            or None
         )
-        jfr_file = jfr_start(n.process.pid, tmpdir)
-        perf_proc = perf_stat(n.process.pid)
         log.result = results.append
+        if sample_mode == HDR_SAMPLE_MODE:
+            # The samples are recorded into a histogram as they arrive, the
+            # warm-up is detected on the first samples in execution order
+            install_hdr_sampler(mser_truncation if trim else None)
+        perf_queries = None
+        if perf_per_query:
+            warmups = {(q['statement'], q.get('concurrency', 1)): q.get('warmup', 0) for q in load_spec(spec).queries}
+            perf_queries = await PerfQueryStat(pids, tmpdir, warmups).start()
+            perf_queries.hook(log)
         await do_run_spec(
             spec=spec,
-            benchmark_hosts=n.http_url,
+            benchmark_hosts=cluster.http_hosts,
             log=log,
             result_hosts=result_hosts,
-            sample_mode='reservoir',
-            action=['queries', 'load_data']
+            sample_mode=sample_mode,
+            action=['queries', 'load_data'],
+            re_name=re_name
         )
-        jfr_stop(n.process.pid)
-        indexing_metrics = collect_indexing_metrics(benchmark_hosts, report_indexing)
+        perf_query_stats = perf_queries and await perf_queries.stop()
+        proc_samples = sampler and await sampler.stop() or None
+        indexing_samples = indexing_sampler and await indexing_sampler.stop() or None
+        await asyncio.gather(*(asyncio.to_thread(jfr_stop, pid) for pid in pids))
+        windows_file = jfr_write_windows(jfr_files[0], results)
+        indexing_metrics = await asyncio.to_thread(
+            collect_indexing_metrics, benchmark_hosts, report_indexing, num_nodes > 1)
         await do_run_spec(
             spec=spec,
-            benchmark_hosts=n.http_url,
+            benchmark_hosts=cluster.http_hosts,
             log=log,
             result_hosts=result_hosts,
             sample_mode='reservoir',
             action='teardown'
         )
-    return (results, jfr_file, perf_proc and perf_stat_results(perf_proc) or {}, indexing_metrics)
+    return SpecRun(results, jfr_files, [perf_stat_output(p) for p in perf_procs], indexing_metrics,
+                   windows_file, proc_samples, perf_query_stats, indexing_samples)
+
+
+async def _report_fork(fork,
+                       previous_report: Optional[asyncio.Task],
+                       pool: ProcessPoolExecutor,
+                       overview_cmd,
+                       runs: List[SpecRun],
+                       labels: List[str],
+                       cpusets: List[Optional[CpuSet]],
+                       baseline: int,
+                       show_plot,
+                       layout,
+                       diff_jfr: bool,
+                       trim: bool,
+                       engine: str,
+                       fdr: float,
+                       min_effect: float,
+                       summary_only: bool,
+                       output_json: Optional[str] = None):
+    """ Extract the profiling metrics of a fork in the worker pool and report them
+
+    Runs while the next fork is benchmarking; reports are printed in fork order.
+    """
+    loop = asyncio.get_running_loop()
+    extraction = asyncio.gather(
+        asyncio.gather(*(
+            asyncio.gather(*(
+                loop.run_in_executor(pool, jfr_extract_metrics, jfr_file, overview_cmd, run.windows_file)
+                for jfr_file in run.jfr_files
+            ))
+            for run in runs
+        )),
+        asyncio.gather(*(
+            asyncio.gather(*(loop.run_in_executor(pool, parse_perf_stat, output) for output in run.perf_outputs))
+            for run in runs
+        )),
+    )
+    diffs = None
+    if diff_jfr:
+        # Diffs are only generated for the first node of a cluster
+        base_file = runs[baseline].jfr_files[0]
+        base_label = labels[baseline].lower()
+        diffs = asyncio.gather(*(
+            loop.run_in_executor(pool, jfr_diff, a, b, f"diff-{fork}-{name}.html")
+            for i, run in enumerate(runs) if i != baseline
+            for a, b, name in (
+                (base_file, run.jfr_files[0], f'{base_label}-{labels[i].lower()}'),
+                (run.jfr_files[0], base_file, f'{labels[i].lower()}-{base_label}'),
+            )
+        ))
+    node_metrics, node_perf_stats = await extraction
+    metrics = [merge_jfr_metrics(m) for m in node_metrics]
+    perf_stats = [
+        (len(p) == 1 and p[0] or merge_perf_stats(p))
+        or run.perf_queries and merge_perf_stats([q['events'] for q in run.perf_queries.values()])
+        or {}
+        for p, run in zip(node_perf_stats, runs)
+    ]
+    if previous_report:
+        await previous_report
+    reports = [
+        VersionReport(label, run.results, m, p, run.indexing_metrics, cpuset, run.proc_samples, run.perf_queries,
+                      nm, node_perf, run.indexing_samples)
+        for label, run, m, p, cpuset, nm, node_perf in zip(labels, runs, metrics, perf_stats, cpusets,
+                                                            node_metrics, node_perf_stats)
+    ]
+    compare_results(
+        reports,
+        baseline,
+        show_plot,
+        layout,
+        trim,
+        engine,
+        fdr,
+        min_effect,
+        summary_only
+    )
+    if output_json:
+        # Reports are serialized in fork order, so are the records
+        with open(output_json, 'a') as f:
+            f.write(json.dumps(report_record(fork, reports, baseline, trim)) + '\n')
+    if diffs:
+        await diffs
 
 
 async def run_compare(
-        v1,
-        v2,
+        versions: List[str],
         spec,
         result_hosts,
         forks,
-        env_v1,
-        env_v2,
-        settings_v1,
-        settings_v2,
+        envs: List[Dict[str, str]],
+        settings: List[Dict[str, str]],
         show_plot,
         protocol,
         report_indexing,
-        diff_jfr: bool):
+        diff_jfr: bool,
+        baseline: int = 0,
+        parallel: bool = False,
+        setup_cache_dir: Optional[str] = None,
+        extraction_workers: int = 2,
+        trim: bool = True,
+        sample_mode: str = 'reservoir',
+        proc_interval: float = 0.1,
+        perf_per_query: bool = False,
+        num_nodes: int = 1,
+        engine: str = 'ttest',
+        tail_threshold: Optional[float] = None,
+        fdr: float = 0.05,
+        min_effect: float = 2.0,
+        summary_only: bool = False,
+        target_ci_width: Optional[float] = None,
+        max_forks: int = 50,
+        time_budget: Optional[float] = None,
+        output_json: Optional[str] = None,
+        indexing_interval: float = 1.0):
+    if output_json:
+        # Each fork appends a record
+        open(output_json, 'w').close()
     tmpdir = tempfile.mkdtemp()
-    run_v1 = partial(_run_spec, v1, spec, result_hosts, env_v1, settings_v1, tmpdir, protocol, report_indexing)
-    run_v2 = partial(_run_spec, v2, spec, result_hosts, env_v2, settings_v2, tmpdir, protocol, report_indexing)
+    setup_cache = setup_cache_dir and SetupCache(setup_cache_dir) or None
+    labels = [f'V{i + 1}' for i in range(len(versions))]
+    sequential = target_ci_width and SequentialTest(labels, baseline, target_ci_width, trim, engine) or None
+    tail_pool = {}
+    regressions = []
+    cpusets = [None] * len(versions)
+    layout = None
+    if parallel:
+        topology = numa_topology()
+        cpusets = partition_cpus(len(versions), topology)
+        layout = describe_machine(topology)
+    runners = [
+        partial(_run_spec, version, spec, result_hosts, env, version_settings, tmpdir,
+                protocol, report_indexing, cpuset, setup_cache, label.lower(), sample_mode, proc_interval,
+                perf_per_query, num_nodes, trim=trim, indexing_interval=indexing_interval)
+        for version, env, version_settings, cpuset, label in zip(versions, envs, settings, cpusets, labels)
+    ]
+    report = None
     try:
-        for i in range(forks):
-            results_v1, jfr_file1, stat_result1, indexing_metrics1 = await run_v1()
-            results_v2, jfr_file2, stat_result2, indexing_metrics2 = await run_v2()
-            compare_results(
-                results_v1,
-                jfr_extract_metrics(jfr_file1),
-                stat_result1,
-                indexing_metrics1,
-                results_v2,
-                jfr_extract_metrics(jfr_file2),
-                stat_result2,
-                indexing_metrics2,
-                show_plot
-            )
-            if diff_jfr:
-                subprocess.check_output(["jfrconv", "--diff", jfr_file1, jfr_file2, f"diff-{i}.html"])
-                subprocess.check_output(["jfrconv", "--diff", jfr_file2, jfr_file1, f"diff-{i}-reverse.html"])
-
+        overview_cmd = await asyncio.to_thread(jfr_overview_cmd, tmpdir)
+        with ProcessPoolExecutor(max_workers=max(1, extraction_workers), initializer=init_worker) as pool:
+            started = time.monotonic()
+            i = 0
+            while True:
+                if parallel:
+                    runs = await asyncio.gather(*(run() for run in runners))
+                else:
+                    # Rotate the start order per fork so that no version
+                    # always runs first (or last) on a freshly idle machine
+                    order = [(i + j) % len(runners) for j in range(len(runners))]
+                    runs = [None] * len(runners)
+                    for j in order:
+                        runs[j] = await runners[j]()
+                report = asyncio.create_task(_report_fork(
+                    i,
+                    report,
+                    pool,
+                    overview_cmd,
+                    runs,
+                    labels,
+                    cpusets,
+                    baseline,
+                    show_plot,
+                    layout,
+                    diff_jfr,
+                    trim,
+                    engine,
+                    fdr,
+                    min_effect,
+                    summary_only,
+                    output_json
+                ))
+                if extraction_workers == 0:
+                    await report
+                i += 1
+                if tail_threshold is not None:
+                    pool_runtime_stats(tail_pool, runs, trim)
+                if not sequential:
+                    if i >= forks:
+                        break
+                    continue
+                sequential.add(i, runs)
+                elapsed = time.monotonic() - started
+                if i >= forks and sequential.done:
+                    break
+                if i >= max_forks:
+                    break
+                if time_budget and elapsed + elapsed / i > time_budget:
+                    print(f'Stopping after {i} forks, another fork would exceed the time budget')
+                    break
+            await report
+            if sequential:
+                sequential.report(i)
+            if tail_threshold is not None:
+                regressions = report_tail_regressions(labels, baseline, tail_pool, tail_threshold)
     finally:
         shutil.rmtree(tmpdir, True)
+    return regressions
+
+
+def _version_args(args) -> List[str]:
+    versions = [v for v in (args.v1, args.v2) if v] + (args.version or [])
+    if len(versions) < 2:
+        raise SystemExit('At least two versions are required. Use --version (or --v1 and --v2)')
+    return versions
 
 
 def main():
     p = argparse.ArgumentParser(description=__doc__)
+    p.add_argument(
+        '--version',
+        action='append',
+        help='cr8 version identifier or path to tarball (tar.gz). '
+             'Can be repeated to compare more than two versions. '
+             'Versions are numbered (V1, V2, ..) in the order they are given, starting after --v1/--v2'
+    )
     p.add_argument(
         '--v1',
-        help='cr8 version identifier or path to tarball (tar.gz)',
-        required=True
+        help='cr8 version identifier or path to tarball (tar.gz). Same as the first --version'
     )
     p.add_argument(
         '--v2',
-        help='cr8 version identifier or path to tarball (tar.gz)',
-        required=True
+        help='cr8 version identifier or path to tarball (tar.gz). Same as the second --version'
     )
+    p.add_argument('--baseline', type=int, default=1,
+                   help='Number of the version the other versions are compared against. Defaults to 1')
     p.add_argument('--spec', help='path to spec file', required=True)
     p.add_argument('--result-hosts', type=str)
     p.add_argument('--forks', type=int, default=5,
-                   help='Number of times the nodes are launched and the spec re-run')
+                   help='Number of times the nodes are launched and the spec re-run. '
+                        'With --target-ci-width this is the minimum number of forks')
+    p.add_argument('--calibration', type=str,
+                   help='Sidecar file written by calibrate.py. Overrides --forks with the recommended number of forks')
+    p.add_argument('--target-ci-width', type=float,
+                   help='Keep adding forks until the 95%% confidence interval of the mean difference '
+                        'to the baseline (t-interval over the per-fork means) is narrower than this (in percent) '
+                        'for every query')
+    p.add_argument('--max-forks', type=int, default=50,
+                   help='Upper limit for the number of forks if --target-ci-width is used')
+    p.add_argument('--time-budget', type=float,
+                   help='Time in seconds after which no new forks are started if --target-ci-width is used')
     p.add_argument('--env', action='append',
                    help='Environment variable for crate nodes. E.g. --env CRATE_HEAP_SIZE=2g')
     p.add_argument('--env-v1', action='append',
                    help='Like --env but only applied to v1')
     p.add_argument('--env-v2', action='append',
                    help='Like --env but only applied to v2')
+    p.add_argument('--env-version', action='append',
+                   help='Like --env but only applied to the version with the given number. E.g. --env-version 3:CRATE_HEAP_SIZE=2g')
     p.add_argument('-s', '--setting', action='append',
                    help='Crate setting. E.g. -s path.data=/tmp/c1/')
     p.add_argument('--setting-v1', action='append',
                    help='Crate setting. Only applied to v1')
     p.add_argument('--setting-v2', action='append',
                    help='Crate setting. Only applied to v2')
+    p.add_argument('--setting-version', action='append',
+                   help='Crate setting. Only applied to the version with the given number. E.g. --setting-version 3:stats.enabled=false')
     p.add_argument('--show-plot', type=bool, default=False)
     p.add_argument('--protocol', type=str, default='http',
                    help='Define which protocol to use, choices are (http, pg). Defaults to: http')
     p.add_argument('--report-indexing', action='store_true',
                    help='Whether to report shard indexing statistics. Mostly useful when running indexing benchmarks. Disabled by default.')
+    p.add_argument('--indexing-interval', type=float, default=1.0,
+                   help='Interval in seconds in which segment, shard, thread pool and circuit breaker statistics are '
+                        'polled while the queries run, with --report-indexing. Reported as timeline per query. '
+                        '0 disables the polling')
     p.add_argument("--diff-jfr", action="store_true",
-                   help="Uses the `jfrconv` CLI to generate a diff from the two profiles")
+                   help="Uses the `jfrconv` CLI to generate diffs between the profiles of the baseline and the other versions")
+    p.add_argument('--parallel', action='store_true',
+                   help='Run all versions at the same time, each pinned to its own disjoint set of CPUs and NUMA nodes')
+    p.add_argument('--setup-cache', type=str,
+                   help='Directory used to cache the data directory of the nodes after the setup phase. '
+                        'Forks start from the cached data instead of running the setup again. '
+                        'Entries are keyed by spec content, CrateDB build and settings.')
+    p.add_argument('--extraction-workers', type=int, default=2,
+                   help='Number of worker processes that extract JFR/perf metrics in the background '
+                        'while the next fork is running. 0 extracts and reports each fork before the next one starts.')
+    p.add_argument('--trim-warmup', action=argparse.BooleanOptionalAction, default=True,
+                   help='Detect the warm-up phase of each query (MSER-5) and exclude it from the statistics. '
+                        'Only applies to queries with all samples in execution order: with --sample-mode reservoir '
+                        'queries with more iterations than the reservoir holds are not trimmed. Enabled by default')
+    p.add_argument('--stats-engine', choices=STATS_ENGINES, default='ttest',
+                   help='Statistics used to compare the versions. ttest: t-test of the means. '
+                        'robust: Mann-Whitney U test, bootstrap confidence intervals of the median and p99 ratio '
+                        'and Hodges-Lehmann shift; doesn\'t assume normally distributed runtimes')
+    p.add_argument('--fdr', type=float, default=0.05,
+                   help='False discovery rate (Benjamini-Hochberg) across all queries of a fork used for the '
+                        'summary of regressions and improvements. Defaults to 0.05')
+    p.add_argument('--min-effect', type=float, default=2.0,
+                   help='Minimum change in percent for a significant difference to be listed in the summary. '
+                        'Defaults to 2')
+    p.add_argument('--summary-only', action='store_true',
+                   help='Only print the summary of regressions and improvements instead of the tables of every query')
+    p.add_argument('--fail-on-tail-regression', type=float, metavar='PERCENT',
+                   help='Exit with 1 if the p95, p99 or p99.9 of a query, pooled over all forks, is slower than '
+                        'the baseline by more than PERCENT with 95%% confidence. Percentiles with less than 10 '
+                        'samples above them are not checked')
+    p.add_argument('--sample-mode', type=str, default='reservoir',
+                   help='cr8 sample mode: all, reservoir, reservoir:<size> or hdr. Warm-up detection relies on the '
+                        'execution order of the samples, which reservoir sampling only keeps until the reservoir is full. '
+                        'hdr records the samples of a query into a histogram (1 µs resolution, 3 significant '
+                        'digits) as they arrive, which bounds the memory of long runs and many forks. The warm-up '
+                        'is detected on the first 10000 samples')
+    p.add_argument('--proc-interval', type=float, default=0.1,
+                   help='Interval in seconds in which CPU, memory, IO and context switches of the node are '
+                        'sampled from /proc while the queries run. 0 disables the sampling')
+    p.add_argument('--perf-per-query', action='store_true',
+                   help='Count perf events separately for each query (a single `perf stat` toggled via its '
+                        'control FIFO) and report IPC, '
+                        'cache-miss rate and instructions per execution per query. '
+                        'Replaces the whole-run perf stat, which is then the sum of the queries')
+    p.add_argument('--nodes', type=int, default=1,
+                   help='Number of nodes of the local cluster launched per version. JFR, perf and indexing '
+                        'metrics are reported for the whole cluster and for each node')
+    p.add_argument('--output-json', type=str,
+                   help='Append the results and metrics of every fork as JSON line to this file. '
+                        'Used by html_report.py')
     args = p.parse_args()
+    versions = _version_args(args)
+    if args.calibration:
+        with open(args.calibration) as f:
+            calibration = json.load(f)
+        args.forks = calibration['forks']
+        print(f"Using {args.forks} forks recommended by {args.calibration} to detect a change of "
+              f"{calibration['effect']}% with power {calibration['power']}")
+    if not 1 <= args.baseline <= len(versions):
+        raise SystemExit(f'--baseline must be between 1 and {len(versions)}')
     env = dict_from_kw_args(args.env)
-    env_v1 = env.copy()
-    env_v1.update(dict_from_kw_args(args.env_v1))
-    env_v2 = env.copy()
-    env_v2.update(dict_from_kw_args(args.env_v2))
+    version_envs = indexed_kw_args(args.env_version)
+    version_envs.setdefault(1, {}).update(dict_from_kw_args(args.env_v1))
+    version_envs.setdefault(2, {}).update(dict_from_kw_args(args.env_v2))
     settings = dict_from_kw_args(args.setting)
-    settings_v1 = settings.copy()
-    settings_v1.update(dict_from_kw_args(args.setting_v1))
-    settings_v2 = settings.copy()
-    settings_v2.update(dict_from_kw_args(args.setting_v2))
+    version_settings = indexed_kw_args(args.setting_version)
+    version_settings.setdefault(1, {}).update(dict_from_kw_args(args.setting_v1))
+    version_settings.setdefault(2, {}).update(dict_from_kw_args(args.setting_v2))
     try:
-        asyncio.run(run_compare(
-            args.v1,
-            args.v2,
+        regressions = asyncio.run(run_compare(
+            versions,
             args.spec,
             args.result_hosts,
             forks=max(1, args.forks),
-            env_v1=env_v1,
-            env_v2=env_v2,
-            settings_v1=settings_v1,
-            settings_v2=settings_v2,
+            envs=[{**env, **version_envs.get(i, {})} for i in range(1, len(versions) + 1)],
+            settings=[{**settings, **version_settings.get(i, {})} for i in range(1, len(versions) + 1)],
             show_plot=args.show_plot,
             protocol=args.protocol,
             report_indexing=args.report_indexing,
             diff_jfr=args.diff_jfr,
+            baseline=args.baseline - 1,
+            parallel=args.parallel,
+            setup_cache_dir=args.setup_cache,
+            extraction_workers=args.extraction_workers,
+            target_ci_width=args.target_ci_width,
+            max_forks=args.max_forks,
+            time_budget=args.time_budget,
+            trim=args.trim_warmup,
+            sample_mode=args.sample_mode,
+            proc_interval=args.proc_interval,
+            perf_per_query=args.perf_per_query,
+            num_nodes=max(1, args.nodes),
+            engine=args.stats_engine,
+            tail_threshold=args.fail_on_tail_regression,
+            fdr=args.fdr,
+            min_effect=args.min_effect,
+            summary_only=args.summary_only,
+            output_json=args.output_json,
+            indexing_interval=args.indexing_interval,
         ))
     except KeyboardInterrupt:
         print('Exiting..')
+        return
+    if regressions:
+        sys.exit(1)
 
 
 if __name__ == "__main__":
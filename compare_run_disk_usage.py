@@ -1,19 +1,23 @@
 #!/usr/bin/env python3
 
 """
-Script to launch two different CrateDB nodes, run the setup of a spec file and
-compare the disk space requirements.
+Script to launch two different CrateDB nodes (or clusters), run the setup of a
+spec file and compare the disk space requirements.
 """
 
 import argparse
 import asyncio
+import json
+from collections import defaultdict
+from typing import Dict, List
 from uuid import uuid4
-from cr8.run_crate import get_crate, CrateNode
+from cr8.run_crate import get_crate
 from cr8.run_spec import do_run_spec
 from cr8.log import Logger
 from crate.client import connect
 from tabulate import tabulate
 
+from cluster import CrateCluster
 from util import dict_from_kw_args, perc_diff, human_readable_byte_size
 from lucene_disk_usage import gather_sizes
 
@@ -33,21 +37,35 @@ WHERE
         cursor.execute(f'optimize table "{schema}"."{table}" with (flush = true, max_num_segments = 1)')
 
 
-async def run(version, spec, env, settings):
+def sum_sizes(sizes: List[Dict[str, int]]) -> Dict[str, int]:
+    """ Sum up the sizes per file extension of several nodes
+
+    >>> dict(sum_sizes([{'si': 1, 'fdt': 10}, {'fdt': 5}]))
+    {'si': 1, 'fdt': 15}
+    """
+    total = defaultdict(int)
+    for node_sizes in sizes:
+        for ext, size in node_sizes.items():
+            total[ext] += size
+    return total
+
+
+async def run(version, spec, env, settings, num_nodes=1) -> List[Dict[str, int]]:
+    """ Run the setup of the spec and return the sizes of the data directory of each node """
     crate_dir = get_crate(version)
     settings.setdefault('cluster.name', str(uuid4()))
-    with Logger() as log, CrateNode(crate_dir=crate_dir, settings=settings, env=env) as n:
-        n.start()
+    with Logger() as log, CrateCluster(crate_dir, settings, env, num_nodes) as cluster:
+        cluster.start()
         await do_run_spec(
             spec=spec,
             log=log,
             sample_mode='reservoir',
-            benchmark_hosts=n.http_url,
+            benchmark_hosts=cluster.http_hosts,
             action='setup'
         )
-        with connect(n.http_url) as conn:
+        with connect(cluster.http_url) as conn:
             optimize_tables(conn.cursor())
-        return gather_sizes(n.data_path)
+        return [gather_sizes(path) for path in cluster.data_paths]
 
 
 async def run_comparison(version1,
@@ -57,9 +75,13 @@ async def run_comparison(version1,
                          env_v1,
                          env_v2,
                          settings_v1,
-                         settings_v2):
-    v1 = await run(version1, spec, env_v1, settings_v1)
-    v2 = await run(version2, spec, env_v2, settings_v2)
+                         settings_v2,
+                         num_nodes=1,
+                         output_json=None):
+    v1_nodes = await run(version1, spec, env_v1, settings_v1, num_nodes)
+    v2_nodes = await run(version2, spec, env_v2, settings_v2, num_nodes)
+    v1 = sum_sizes(v1_nodes)
+    v2 = sum_sizes(v2_nodes)
     print(f'Version1: {version1}')
     print(f'Version2: {version2}')
     headers = ('Description', 'Version 1', 'Unit', 'Version 2', 'Unit', 'Diff')
@@ -100,8 +122,26 @@ async def run_comparison(version1,
     v2_sum_size, v2_sum_unit = human_readable_byte_size(v2_sum)
     sum_diff = ('Total', v1_sum_size, v1_sum_unit, v2_sum_size, v2_sum_unit, perc_diff(v1_sum, v2_sum))
     rows.append(sum_diff)
+    if num_nodes > 1:
+        for i, (n1, n2) in enumerate(zip(v1_nodes, v2_nodes)):
+            n1_sum = sum(n1.values())
+            n2_sum = sum(n2.values())
+            n1_size, n1_unit = human_readable_byte_size(n1_sum)
+            n2_size, n2_unit = human_readable_byte_size(n2_sum)
+            rows.append((f'Total (node-{i})', n1_size, n1_unit, n2_size, n2_unit, perc_diff(n1_sum, n2_sum)))
 
     print(tabulate(rows, headers=headers, floatfmt=".2f"))
+    if output_json:
+        # Read by html_report.py
+        with open(output_json, 'w') as f:
+            json.dump({
+                'kind': 'disk_usage',
+                'labels': ['V1', 'V2'],
+                'versions': [version1, version2],
+                'sizes': [v1, v2],
+                'node_sizes': [v1_nodes, v2_nodes],
+            }, f)
+            f.write('\n')
 
 
 def main():
@@ -130,6 +170,10 @@ def main():
                    help='Crate setting. Only applied to v1')
     p.add_argument('--setting-v2', action='append',
                    help='Crate setting. Only applied to v2')
+    p.add_argument('--nodes', type=int, default=1,
+                   help='Number of nodes of the local cluster launched per version')
+    p.add_argument('--output-json', type=str,
+                   help='Write the sizes per file type to this file. Used by html_report.py')
     args = p.parse_args()
 
     env = dict_from_kw_args(args.env)
@@ -152,7 +196,9 @@ def main():
         env_v1=env_v1,
         env_v2=env_v2,
         settings_v1=settings_v1,
-        settings_v2=settings_v2
+        settings_v2=settings_v2,
+        num_nodes=max(1, args.nodes),
+        output_json=args.output_json
     ))
 
 
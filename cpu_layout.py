@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+
+"""
+Helpers to split the CPUs and NUMA nodes of the machine into disjoint sets so
+that several CrateDB nodes can be benchmarked at the same time without
+competing for the same cores.
+"""
+
+import os
+import shutil
+from glob import glob
+from typing import NamedTuple, Optional
+
+
+NODE_ROOT = '/sys/devices/system/node'
+
+
+class CpuSet(NamedTuple):
+    cpus: list[int]
+    numa_nodes: list[int]
+
+
+def parse_cpulist(cpulist: str) -> list[int]:
+    """ Parse a cpulist as used in /sys and by taskset
+
+    >>> parse_cpulist('0-3,8,10-11')
+    [0, 1, 2, 3, 8, 10, 11]
+
+    >>> parse_cpulist('')
+    []
+    """
+    cpus = []
+    for part in cpulist.strip().split(','):
+        if not part:
+            continue
+        if '-' in part:
+            start, end = part.split('-')
+            cpus.extend(range(int(start), int(end) + 1))
+        else:
+            cpus.append(int(part))
+    return cpus
+
+
+def format_cpulist(cpus: list[int]) -> str:
+    """ Format CPU ids as compact cpulist
+
+    >>> format_cpulist([0, 1, 2, 3, 8, 10, 11])
+    '0-3,8,10-11'
+
+    >>> format_cpulist([5])
+    '5'
+    """
+    parts = []
+    cpus = sorted(cpus)
+    start = prev = cpus[0]
+    for cpu in cpus[1:] + [None]:
+        if cpu is not None and cpu == prev + 1:
+            prev = cpu
+            continue
+        parts.append(str(start) if start == prev else f'{start}-{prev}')
+        start = prev = cpu
+    return ','.join(parts)
+
+
+def numa_topology() -> dict[int, list[int]]:
+    """ Return the CPUs usable by this process grouped by NUMA node
+
+    Falls back to a single node `0` if the kernel doesn't expose NUMA
+    information.
+    """
+    available = os.sched_getaffinity(0)
+    topology = {}
+    for node_dir in glob(os.path.join(NODE_ROOT, 'node[0-9]*')):
+        node = int(os.path.basename(node_dir)[len('node'):])
+        with open(os.path.join(node_dir, 'cpulist')) as f:
+            cpus = [c for c in parse_cpulist(f.read()) if c in available]
+        if cpus:
+            topology[node] = cpus
+    return topology or {0: sorted(available)}
+
+
+def node_memory_mb(node: int) -> Optional[float]:
+    meminfo = os.path.join(NODE_ROOT, f'node{node}', 'meminfo')
+    try:
+        with open(meminfo) as f:
+            for line in f:
+                # Node 0 MemTotal:       32768000 kB
+                if 'MemTotal:' in line:
+                    return int(line.split()[-2]) / 1024
+    except FileNotFoundError:
+        pass
+    return None
+
+
+def partition_cpus(count: int, topology: dict[int, list[int]]) -> list[CpuSet]:
+    """ Split the CPUs into `count` disjoint sets
+
+    Whole NUMA nodes are handed out if there are enough of them, otherwise the
+    CPUs are split into contiguous chunks of equal size.
+
+    >>> partition_cpus(2, {0: [0, 1, 2, 3], 1: [4, 5, 6, 7]})
+    [CpuSet(cpus=[0, 1, 2, 3], numa_nodes=[0]), CpuSet(cpus=[4, 5, 6, 7], numa_nodes=[1])]
+
+    >>> partition_cpus(2, {0: [0, 1, 2, 3, 4]})
+    [CpuSet(cpus=[0, 1], numa_nodes=[0]), CpuSet(cpus=[2, 3], numa_nodes=[0])]
+
+    >>> partition_cpus(2, {0: [0]})
+    Traceback (most recent call last):
+        ...
+    ValueError: Cannot split 1 CPUs into 2 disjoint sets
+    """
+    nodes = sorted(topology)
+    if len(nodes) >= count:
+        sets = []
+        for i in range(count):
+            assigned = nodes[i::count]
+            cpus = sorted(c for n in assigned for c in topology[n])
+            sets.append(CpuSet(cpus, assigned))
+        return sets
+    cpu_to_node = {c: n for n, cpus in topology.items() for c in cpus}
+    cpus = sorted(cpu_to_node)
+    per_set = len(cpus) // count
+    if per_set == 0:
+        raise ValueError(f'Cannot split {len(cpus)} CPUs into {count} disjoint sets')
+    sets = []
+    for i in range(count):
+        chunk = cpus[i * per_set:(i + 1) * per_set]
+        sets.append(CpuSet(chunk, sorted({cpu_to_node[c] for c in chunk})))
+    return sets
+
+
+def pinned_cmd(cmd: list[str], cpuset: CpuSet) -> list[str]:
+    """ Prefix `cmd` so that the process only runs on the given CPU set
+
+    Uses numactl to also bind memory allocations to the NUMA nodes of the set
+    if it is available, otherwise falls back to taskset.
+    """
+    cpulist = format_cpulist(cpuset.cpus)
+    if shutil.which('numactl'):
+        nodes = ','.join(str(n) for n in cpuset.numa_nodes)
+        return ['numactl', f'--physcpubind={cpulist}', f'--membind={nodes}'] + cmd
+    return ['taskset', '-c', cpulist] + cmd
+
+
+def describe_cpuset(cpuset: CpuSet) -> str:
+    """ Describe a CPU set for reports
+
+    >>> describe_cpuset(CpuSet([0, 1, 2, 3], [0]))
+    'cpus 0-3 (4), numa node 0'
+    """
+    nodes = ','.join(str(n) for n in cpuset.numa_nodes)
+    return f'cpus {format_cpulist(cpuset.cpus)} ({len(cpuset.cpus)}), numa node {nodes}'
+
+
+def describe_machine(topology: dict[int, list[int]]) -> str:
+    parts = []
+    for node, cpus in sorted(topology.items()):
+        mem = node_memory_mb(node)
+        mem_str = f', {mem:.0f} MB' if mem else ''
+        parts.append(f'node {node}: cpus {format_cpulist(cpus)}{mem_str}')
+    return '; '.join(parts)
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -4,20 +4,31 @@
 """
 Script that tries to detect performance regression by looking at previous
 benchmark results
+
+The results are read from a results table, from a local copy of it
+(`--store`) or from cr8 result files (`--results`), which doesn't need a
+connection at all.
 """
 
 import argparse
+import json
 import math
 import sys
 import os
+import time
 import numpy as np
-from scipy import stats
-from typing import NamedTuple
+import pandas as pd
+from scipy import signal
+from typing import Any, Dict, Iterator, List, NamedTuple, Optional, Tuple
 from termcolor import colored
 from itertools import groupby
 from datetime import datetime, timedelta
 from crate.client import connect
 
+from compare_measures import mean_diff_ci
+from compare_results import iter_results, result_files
+from result_store import ResultStore
+
 
 class Key(NamedTuple):
     concurrency: int
@@ -32,8 +43,29 @@ class Diff(NamedTuple):
     new_version: str
     prev_val: float
     new_val: float
-    diff: float
+    diff: float  # in percent, positive if the new result is worse
     linregress_slope: float
+    metric: str = 'minimum'
+
+
+class Shift(NamedTuple):
+    key: Key
+    metric: str  # metric of before, after and diff
+    prev_version: str  # last version before the shift
+    version: str  # first version with the new level
+    before: float  # mean of the metric in the segment before the shift
+    after: float  # mean of the metric in the segment after the shift
+    diff: float  # in percent
+    ci: Tuple[float, float]  # 95% CI of diff
+    persisted: bool  # the latest results are still shifted
+
+
+class NoiseProfile(NamedTuple):
+    versions: int  # number of versions the profile was learned from
+    median: float  # median of the metric per version
+    noise: float  # robust standard deviation of the metric in percent of the median
+    autocorr: float  # lag-1 autocorrelation of the residuals
+    updated: int  # epoch seconds
 
 
 class Row(NamedTuple):
@@ -46,20 +78,38 @@ class Row(NamedTuple):
     samples: int
     minimum: int
     percentile50: float
+    started: Optional[int] = None
+    iterations: Optional[int] = None
 
 
-UNSTABLE_PREDICATES = [
-    # fluctuates between 8 and 18 ms
-    lambda d: (d.key.stmt.startswith('insert into articles') and d.diff < 100),
+KEY_COLUMNS = ['stmt', 'concurrency', 'bulk_size', 'meta_name']
+# Throughput of write statements, derived from the duration, bulk size and
+# iterations of a result. Higher is better
+THROUGHPUT_METRICS = ('statements_per_sec', 'rows_per_sec')
+WRITE_STATEMENTS = ('insert', 'update', 'delete', 'copy')
+DIFF_METRICS = ('minimum',) + THROUGHPUT_METRICS
+# Metrics with a noise profile; shifts are measured on the p50
+PROFILE_METRICS = DIFF_METRICS + ('p50',)
+METHODS = ('minimum', 'changepoint')
+# Multiplied by the dimensions of the series and log(n) to get the cost of a changepoint
+CHANGEPOINT_PENALTY = 2.0
 
-    # fluctuates between 7 and 14 ms
-    lambda d: (d.key.stmt.startswith('insert into id_int_value_str') and d.diff < 100),
-]
+# Regression threshold in percent for series without noise profile
+DEFAULT_THRESHOLD = 15.0
+# Lower bound of the threshold of series with a noise profile
+MIN_THRESHOLD = 3.0
+# The threshold is this multiple of the noise of a series
+NOISE_FACTOR = 4.0
+# Number of versions required to learn a noise profile
+MIN_PROFILE_VERSIONS = 8
+NOISE_PROFILES = os.path.join(
+    os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')),
+    'crate-benchmarks',
+    'noise_profiles.json'
+)
 
 
-def _fetch_results(c, table):
-    twenty_days_ago = (datetime.today() - timedelta(days=20))
-    twenty_days_ago = int(twenty_days_ago.timestamp() * 1000)
+def _fetch_results(c, table, start, end):
     c.execute(f'''
 select
     statement,
@@ -68,13 +118,15 @@ select
     bulk_size,
     meta['name'] as meta_name,
     ended,
-    runtime_stats['samples'],
+    null as samples,
     runtime_stats['min'] as minimum,
-    runtime_stats['percentile']['50'] as p50
+    runtime_stats['percentile']['50'] as p50,
+    started,
+    runtime_stats['n'] as iterations
 from
     {table}
 where
-    ended >= ?
+    ended >= ? and ended < ?
 order by
     statement,
     concurrency,
@@ -83,51 +135,328 @@ order by
     version_info['number'],
     version_info['hash'],
     ended desc
-''', (twenty_days_ago,))
+''', (start, end))
     return (Row(*r) for r in c.fetchall())
 
 
-def find_diffs(results):
+def _sorted(df: pd.DataFrame) -> pd.DataFrame:
+    """ Results in the order of `_fetch_results` """
+    return df.sort_values(
+        KEY_COLUMNS + ['version', 'ended'],
+        ascending=[True, True, True, True, True, False],
+        kind='stable'
+    ).reset_index(drop=True)
+
+
+def results_frame(results) -> pd.DataFrame:
+    """ DataFrame with the fields of `Row` as columns
+
+    >>> results_frame([Row('select name', '0.56.0', 1, None, 'dummy.toml', 1, None, 10, 11)]).shape
+    (1, 11)
+    """
+    if isinstance(results, pd.DataFrame):
+        return results
+    return pd.DataFrame(list(results), columns=list(Row._fields))
+
+
+def _stored_results(store: ResultStore, start: int, end: int) -> pd.DataFrame:
+    df = store.load(start, end).rename(columns={'p50': 'percentile50'})
+    return _sorted(df.reindex(columns=list(Row._fields)))
+
+
+def _file_row(result: Dict[str, Any]) -> Row:
+    """ Result of a cr8 JSONL file in the layout of `_fetch_results`
+
+    >>> _file_row({'statement': 'select 1', 'concurrency': 2, 'ended': 1704672000000,
+    ...            'meta': {'name': 'select.toml'}, 'version_info': {'number': '5.6.0', 'hash': 'abcdef0123'},
+    ...            'runtime_stats': {'min': 1.5, 'percentile': {'50': 2.0}}})
+    Row(stmt='select 1', version='5.6.0-abcdef01', concurrency=2, bulk_size=None, meta_name='select.toml', ended=1704672000000, samples=None, minimum=1.5, percentile50=2.0, started=None, iterations=None)
+    """
+    version_info = result.get('version_info') or {}
+    stats = result['runtime_stats']
+    return Row(
+        result['statement'],
+        f"{version_info.get('number')}-{(version_info.get('hash') or '')[:8]}",
+        result.get('concurrency', 1),
+        result.get('bulk_size'),
+        (result.get('meta') or {}).get('name'),
+        result['ended'],
+        None,
+        stats['min'],
+        (stats.get('percentile') or {}).get('50'),
+        result.get('started'),
+        stats.get('n')
+    )
+
+
+def _file_results(path: str, start: int, end: int) -> pd.DataFrame:
+    """ Results of the cr8 JSONL files of a directory or glob pattern """
+    rows = (_file_row(r) for r in iter_results(result_files(path)))
+    df = results_frame(r for r in rows if start <= r.ended < end)
+    df['bulk_size'] = df['bulk_size'].astype('Int64')
+    return _sorted(df)
+
+
+def _window(days: float, until: Optional[str]) -> Tuple[int, int]:
+    """ Start and end (epoch ms) of the analysed time window
+
+    >>> _window(2, '2024-01-10T00:00:00+00:00')
+    (1704672000000, 1704844800000)
+    """
+    end = until and datetime.fromisoformat(until) or datetime.now()
+    return int((end - timedelta(days=days)).timestamp() * 1000), int(end.timestamp() * 1000)
+
+
+def _key(row) -> Key:
+    bulk_size = row.bulk_size
+    return Key(
+        int(row.concurrency),
+        row.stmt.strip(),
+        None if pd.isna(bulk_size) else int(bulk_size),
+        None if pd.isna(row.meta_name) else row.meta_name
+    )
+
+
+def _p50(df: pd.DataFrame) -> pd.Series:
+    """ p50 of each result, the minimum if the result has no (or a zero) p50 """
+    p50 = pd.to_numeric(df['percentile50'], errors='coerce')
+    return p50.where(p50.fillna(0) != 0, df['minimum']).astype(float)
+
+
+def throughput(df: pd.DataFrame) -> pd.DataFrame:
+    """ Statements and rows per second of the write statements
+
+    Statements without bulk size write one row. Results of other statements
+    and results without start or number of iterations have no throughput.
+
+    >>> throughput(results_frame([
+    ...     Row('insert into t (x) values (?)', '1.0', 2, 100, 'a.toml', 5000, None, 1, 2, 1000, 1000),
+    ...     Row('select 1', '1.0', 1, None, 'a.toml', 5000, None, 1, 2, 1000, 1000),
+    ... ]))
+       statements_per_sec  rows_per_sec
+    0               250.0       25000.0
+    1                 NaN           NaN
+    """
+    duration = (pd.to_numeric(df['ended']) - pd.to_numeric(df['started'])) / 1000
+    is_write = df['stmt'].str.lstrip().str.lower().str.startswith(WRITE_STATEMENTS)
+    statements = (pd.to_numeric(df['iterations']) / duration.where(duration > 0)).where(is_write)
+    bulk_size = pd.to_numeric(df['bulk_size']).fillna(1)
+    return pd.DataFrame({
+        'statements_per_sec': statements.astype(float),
+        'rows_per_sec': (statements * bulk_size).astype(float),
+    })
+
+
+def find_diffs(results, metric: str = 'minimum'):
     """ Find significant performance differences in the results.
 
+    Compares the latest result of each series with the worst of the previous
+    results, for `minimum` the largest minimum and for a throughput metric the
+    lowest throughput.
+
     Returns:
         list of diffs
 
-    >>> find_diffs([
+    >>> diffs = find_diffs([
     ...     Row('select name', '0.56.0', 1, 1, 'dummy.toml', 12345789000, [11, 12, 20], 10, 11),
     ...     Row('select name', '0.57.0', 1, 1, 'dummy.toml', 12345789000, [10, 10, 20], 10, 10),
     ...     Row('select name', '0.58.0', 1, 1, 'dummy.toml', 12345789000, [25, 25, 35], 25, 25),
     ... ])
-    [Diff(key=Key(concurrency=1, stmt='select name', bulk_size=1, meta_name='dummy.toml'), prev_version='0.56.0', new_version='0.58.0', prev_val=10, new_val=25, diff=150.0)]
+    >>> [d._replace(linregress_slope=round(d.linregress_slope, 3)) for d in diffs]
+    [Diff(key=Key(concurrency=1, stmt='select name', bulk_size=1, meta_name='dummy.toml'), prev_version='0.56.0', new_version='0.58.0', prev_val=10.0, new_val=25.0, diff=150.0, linregress_slope=7.0, metric='minimum')]
+
+    >>> inserts = [Row('insert into t', f'0.{i}.0', 1, 100, 'dummy.toml', 2000, None, 1, 1, 0, n)
+    ...            for i, n in enumerate([1000, 980, 1010, 700])]
+    >>> [(d.prev_val, d.new_val, round(d.diff, 1), round(d.linregress_slope, 1)) for d in find_diffs(inserts, 'rows_per_sec')]
+    [(49000.0, 35000.0, 28.6, 9.4)]
     """
+    df = results_frame(results).reset_index(drop=True)
+    if metric in THROUGHPUT_METRICS:
+        values = throughput(df)[metric]
+        trend = values
+    else:
+        values = df[metric].astype(float)
+        trend = _p50(df)
+    # Signed so that larger is worse
+    sign = -1 if metric in THROUGHPUT_METRICS else 1
+    keep = values.notna().to_numpy()
+    df = df[keep].reset_index(drop=True)
+    if df.empty:
+        return []
+    # Series are the groups of rows with the same key, in the order of the results
+    frame = pd.DataFrame({
+        'series': df.groupby(KEY_COLUMNS, sort=False, dropna=False).ngroup(),
+        'value': values[keep].to_numpy(),
+        'y': trend[keep].to_numpy(),
+    })
+    frame['worse'] = sign * frame['value']
+    by_series = frame.groupby('series', sort=False)
+    frame['x'] = by_series.cumcount().astype(float)
+    frame['xy'] = frame['x'] * frame['y']
+    sums = by_series.agg(n=('y', 'size'), y=('y', 'sum'), xy=('xy', 'sum'))
+    n = sums['n']
+    # Least squares slope of y over the row number (0..n-1) of each series
+    slopes = sign * (sums['xy'] - (n - 1) / 2 * sums['y']) / (n * (n * n - 1) / 12)
+    if metric in THROUGHPUT_METRICS:
+        # In percent of the mean throughput, rows/s and statements/s differ by orders of magnitude
+        slopes = slopes * 100 / (sums['y'] / n)
+    n_rows = frame['series'].map(n)
+    worst_prev = frame['worse'].where(frame['x'] < n_rows - 1).groupby(frame['series']).max()
+    worst = frame[frame['worse'] == frame['series'].map(worst_prev)].groupby('series').head(1)
+    last = frame.groupby('series', sort=False).tail(1)
+    last_val = last['worse'].to_numpy()
+    prev_val = worst_prev[last['series']].to_numpy()
+    tolerance = np.maximum(1e-9 * np.maximum(np.abs(last_val), np.abs(prev_val)), 0.001)
+    candidates = last[(n[last['series']].to_numpy() >= 3) & (last_val - prev_val > tolerance)]
+    worst_rows = pd.Series(worst.index, index=worst['series'])
     diffs = []
-    for stmt_c, group in groupby(
-            results,
-            lambda r: (r.stmt, r.concurrency, r.bulk_size, r.meta_name)):
-        group = list(group)
-        if len(group) < 3:
-            continue
-        x = np.array(range(len(group)))
-        y = np.array([r.percentile50 or r.minimum for r in group])
-        linregress = stats.linregress(x, y)
-        largest_min = max((r.minimum for r in group[:-1]))
-        worst_result = next((r for r in group if r.minimum == largest_min))
-        last_row = list(group)[-1]
-        if last_row.minimum < largest_min or math.isclose(last_row.minimum, largest_min, abs_tol=0.001):
-            continue
-        diff = (last_row.minimum - largest_min) * 100 / largest_min
+    for index, series in zip(candidates.index, candidates['series']):
+        last_row = Row(**df.loc[index].to_dict())
+        prev = Row(**df.loc[worst_rows[series]].to_dict())
+        prev_value = float(frame.at[worst_rows[series], 'value'])
+        new_value = float(frame.at[index, 'value'])
         diffs.append(Diff(
-            Key(last_row.concurrency, last_row.stmt.strip(), last_row.bulk_size, last_row.meta_name),
-            worst_result.version,
+            _key(last_row),
+            prev.version,
             last_row.version,
-            largest_min,
-            last_row.minimum,
-            diff,
-            linregress.slope
+            prev_value,
+            new_value,
+            sign * (new_value - prev_value) * 100 / prev_value,
+            float(slopes[series]),
+            metric
         ))
     return diffs
 
 
+def pelt(signal: np.ndarray, penalty: float, min_size: int = 2) -> List[int]:
+    """ Changepoints of the mean of a (multivariate) signal using PELT
+
+    Minimizes the sum of squared deviations from the segment means plus
+    `penalty` per changepoint. Returns the index of the first point of each
+    new segment.
+
+    >>> pelt(np.array([10, 10.2, 9.9, 10.1, 15, 15.1, 14.9, 15.2]), penalty=1.0)
+    [4]
+    >>> pelt(np.array([10, 10.2, 9.9, 10.1]), penalty=1.0)
+    []
+    """
+    signal = signal.reshape(len(signal), -1)
+    n = len(signal)
+    cumsum = np.vstack([np.zeros(signal.shape[1]), np.cumsum(signal, axis=0)])
+    cumsum_sq = np.vstack([np.zeros(signal.shape[1]), np.cumsum(signal ** 2, axis=0)])
+
+    def cost(starts: np.ndarray, end: int) -> np.ndarray:
+        length = (end - starts)[:, None]
+        sums = cumsum[end] - cumsum[starts]
+        return (cumsum_sq[end] - cumsum_sq[starts] - sums ** 2 / length).sum(axis=1)
+
+    best = np.full(n + 1, np.inf)
+    best[0] = -penalty
+    last = np.zeros(n + 1, dtype=int)
+    candidates = np.array([0])
+    for end in range(min_size, n + 1):
+        admissible = candidates[end - candidates >= min_size]
+        costs = best[admissible] + cost(admissible, end)
+        i = np.argmin(costs)
+        best[end] = costs[i] + penalty
+        last[end] = admissible[i]
+        # Start points which can't become optimal anymore are pruned
+        pending = candidates[end - candidates < min_size]
+        candidates = np.concatenate([admissible[costs <= best[end]], pending])
+        if end - min_size + 1 >= min_size:
+            candidates = np.append(candidates, end - min_size + 1)
+    changepoints = []
+    end = n
+    while last[end] > 0:
+        end = last[end]
+        changepoints.append(int(end))
+    return changepoints[::-1]
+
+
+def robust_scale(values: np.ndarray) -> float:
+    """ Noise level of a series, estimated from the MAD of its first differences
+
+    Level shifts only affect a single difference, so they barely change the estimate.
+
+    >>> round(robust_scale(np.array([10, 11, 10.5, 10.2, 20, 21, 20.4, 20.8])), 3)
+    0.734
+    """
+    if len(values) < 3:
+        return 0.0
+    d = np.diff(values)
+    return float(1.4826 * np.median(np.abs(d - np.median(d))) / math.sqrt(2))
+
+
+def version_series(results, metrics: Tuple[str, ...] = ('p50', 'minimum')) -> Iterator[Tuple]:
+    """ Versions of each series ordered by their first result, with the median of each metric per version
+
+    >>> rows = [Row('select name', v, 1, 1, 'dummy.toml', e, [], m, None)
+    ...         for v, e, m in [('0.2.0', 3, 12), ('0.1.0', 1, 10), ('0.1.0', 2, 11)]]
+    >>> [(key.stmt, versions, p50.tolist()) for key, versions, p50, _ in version_series(rows)]
+    [('select name', ['0.1.0', '0.2.0'], [10.5, 12.0])]
+    """
+    df = results_frame(results)
+    if df.empty:
+        return
+    df = df.assign(p50=_p50(df), minimum=df['minimum'].astype(float))
+    if any(m in THROUGHPUT_METRICS for m in metrics):
+        df = df.join(throughput(df))
+    per_version = df.groupby(KEY_COLUMNS + ['version'], sort=False, dropna=False).agg(
+        first=('ended', 'min'),
+        **{m: (m, 'median') for m in metrics}
+    ).reset_index()
+    per_version['series'] = per_version.groupby(KEY_COLUMNS, sort=False, dropna=False).ngroup()
+    per_version = per_version.sort_values(['series', 'first'], kind='stable')
+    for _, series in per_version.groupby('series', sort=False):
+        yield (_key(series.iloc[0]), series['version'].tolist()) + tuple(series[m].to_numpy() for m in metrics)
+
+
+def find_shifts(results, penalty: float = CHANGEPOINT_PENALTY, min_size: int = 2) -> List[Shift]:
+    """ Find level shifts of the p50 and minimum of each series with PELT
+
+    Both metrics are scaled by their noise level and searched for
+    changepoints together, one point per version. Returns the shifts to a
+    slower level.
+
+    >>> rows = [Row('select name', f'0.{i}.0', 1, 1, 'dummy.toml', i, [], v, v + 1)
+    ...         for i, v in enumerate([10, 10.5, 9.8, 10.2, 10.1, 15.2, 14.8, 15.1, 15.0, 14.9])]
+    >>> shift, = find_shifts(rows)
+    >>> shift.prev_version, shift.version, round(shift.diff, 1), shift.ci[0] > 40, shift.persisted
+    ('0.4.0', '0.5.0', 43.9, True, True)
+    >>> recovered = rows + [r._replace(version=f'0.{i}.1', ended=i + 10) for i, r in enumerate(rows[:4])]
+    >>> [(s.version, s.persisted) for s in find_shifts(recovered)]
+    [('0.5.0', False)]
+    """
+    shifts = []
+    for key, versions, p50, minimum in version_series(results):
+        if len(versions) < 2 * min_size:
+            continue
+        scales = [max(robust_scale(v), 1e-3 * abs(float(np.median(v))), 1e-9) for v in (p50, minimum)]
+        signal = np.column_stack([p50 / scales[0], minimum / scales[1]])
+        changepoints = pelt(signal, penalty * signal.shape[1] * math.log(len(versions)), min_size)
+        bounds = [0] + changepoints + [len(versions)]
+        latest = p50[bounds[-2]:].mean()
+        for start, cp, end in zip(bounds, bounds[1:], bounds[2:]):
+            before = p50[start:cp]
+            after = p50[cp:end]
+            if after.mean() <= before.mean():
+                continue
+            diff = (after.mean() - before.mean()) * 100 / before.mean()
+            shifts.append(Shift(
+                key,
+                'p50',
+                versions[cp - 1],
+                versions[cp],
+                float(before.mean()),
+                float(after.mean()),
+                float(diff),
+                mean_diff_ci(before, after),
+                # Not recovered as long as the latest level kept at least half of the shift
+                bool(latest - before.mean() >= (after.mean() - before.mean()) / 2)
+            ))
+    return shifts
+
+
 def print_diffs(diffs):
     print(colored('Diffs detected: ', attrs=['bold']))
     print('')
@@ -147,45 +476,218 @@ def print_diffs(diffs):
             values['diff'] = diff_fmt.format(g.diff)
 
             print(('  {prev_version} → {new_version}\n'
-                   '  {diff}%   {prev_val:.3f} → {new_val:.3f}\n'
+                   '  {diff}%   {prev_val:.3f} → {new_val:.3f} {metric}\n'
                    '  linregress slope: {linregress_slope:.3f}').format(**values))
             print('')
 
 
-def is_stable(diff):
-    """Return True if the benchmark in question is expected to be stable"""
-    for is_unstable in UNSTABLE_PREDICATES:
-        if is_unstable(diff):
-            return False
-    return True
-
-
-def find_regressions(hosts, table):
-    user = os.getenv('DB_USERNAME')
-    password = os.getenv('DB_PASSWORD')
-    disable_ssl_verify = "verify_ssl=false" in hosts
-    with connect(hosts,
-                 username=user,
-                 password=password,
-                 verify_ssl_cert=not disable_ssl_verify) as conn:
-        c = conn.cursor()
-        results = _fetch_results(c, table)
-        diffs = find_diffs(results)
-        if diffs:
-            stable_regressions = filter(is_stable, diffs)
-            likely_regressions = [d for d in stable_regressions
-                                  if d.linregress_slope > 1.00]
-            print_diffs(likely_regressions)
-            if any(filter(lambda d: d.diff > 15, likely_regressions)):
-                sys.exit(1)
+def print_shifts(shifts):
+    print(colored('Level shifts detected: ', attrs=['bold']))
+    print('')
+    for shift in sorted(shifts, key=lambda s: s.diff, reverse=True):
+        diff_fmt = '{0:+5.1f}%'
+        if shift.persisted and shift.ci[0] > 0:
+            diff_fmt = colored(diff_fmt, 'red', attrs=['bold'])
+        print(str(shift.key))
+        print('')
+        print(f'  {shift.prev_version} → {shift.version}')
+        print(f'  {diff_fmt.format(shift.diff)} ({shift.ci[0]:+.1f}% .. {shift.ci[1]:+.1f}%, 95% CI)'
+              f'   {shift.before:.3f} → {shift.after:.3f}')
+        print('  ' + ('persisted' if shift.persisted else 'recovered since'))
+        print('')
+
+
+def noise_profile(values: np.ndarray, updated: int) -> NoiseProfile:
+    """ Learn the noise of a series from the value (minimum or throughput) of each version
+
+    The noise is estimated from the first differences, so that level shifts
+    don't count as noise. The autocorrelation is that of the deviations from
+    a running median.
+
+    >>> rng = np.random.default_rng(42)
+    >>> p = noise_profile(10 + rng.normal(0, 0.5, 200), 0)
+    >>> p.versions, round(p.median, 1), round(p.noise, 1), abs(p.autocorr) < 0.2
+    (200, 10.0, 4.4, True)
+    """
+    median = float(np.median(values))
+    residuals = values - signal.medfilt(values, 5)
+    if len(residuals) > 2 and residuals.std() > 0:
+        autocorr = float(np.corrcoef(residuals[:-1], residuals[1:])[0, 1])
+    else:
+        autocorr = 0.0
+    return NoiseProfile(
+        len(values),
+        median,
+        robust_scale(values) * 100 / median if median else 0.0,
+        autocorr,
+        updated
+    )
+
+
+def regression_threshold(profile: Optional[NoiseProfile]) -> float:
+    """ Minimum slowdown (or loss of throughput) in percent that counts as regression
+
+    Positively autocorrelated series drift more between versions than their
+    noise suggests, the threshold is widened accordingly.
+
+    >>> regression_threshold(None)
+    15.0
+    >>> regression_threshold(NoiseProfile(20, 10.0, 0.5, 0.0, 0))
+    3.0
+    >>> regression_threshold(NoiseProfile(20, 12.0, 25.0, 0.0, 0))
+    100.0
+    >>> round(regression_threshold(NoiseProfile(20, 12.0, 2.0, 0.5, 0)), 2)
+    13.86
+    """
+    if profile is None:
+        return DEFAULT_THRESHOLD
+    rho = min(max(profile.autocorr, 0.0), 0.9)
+    return max(MIN_THRESHOLD, NOISE_FACTOR * profile.noise * math.sqrt((1 + rho) / (1 - rho)))
+
+
+def _profile_key(key: Key, metric: str) -> str:
+    return json.dumps(list(key) + [metric])
+
+
+def _parse_profile_key(profile_key: str) -> Tuple[Key, str]:
+    """
+    >>> _parse_profile_key(_profile_key(Key(1, 'select 1', None, 'a.toml'), 'rows_per_sec'))
+    (Key(concurrency=1, stmt='select 1', bulk_size=None, meta_name='a.toml'), 'rows_per_sec')
+
+    Profiles without metric are those of the minimum
+
+    >>> _parse_profile_key('[1, "select 1", null, "a.toml"]')[1]
+    'minimum'
+    """
+    values = json.loads(profile_key)
+    return Key(*values[:len(Key._fields)]), (values[len(Key._fields):] or ['minimum'])[0]
+
+
+def load_profiles(path: str) -> Dict[Tuple[Key, str], NoiseProfile]:
+    try:
+        with open(path) as f:
+            profiles = json.load(f)
+    except FileNotFoundError:
+        return {}
+    return {_parse_profile_key(k): NoiseProfile(**v) for k, v in profiles.items()}
+
+
+def save_profiles(path: str, profiles: Dict[Tuple[Key, str], NoiseProfile]):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp_path = f'{path}.{os.getpid()}'
+    with open(tmp_path, 'w') as f:
+        json.dump({_profile_key(*k): p._asdict() for k, p in profiles.items()}, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def learn_profiles(results, profiles: Dict[Tuple[Key, str], NoiseProfile]) -> Dict[Tuple[Key, str], NoiseProfile]:
+    """ Refresh the noise profiles of the metrics of all series with enough history
+
+    Series with too few versions keep their previous profile.
+
+    >>> rows = [Row('select name', f'0.{i}.0', 1, 1, 'dummy.toml', i, [], 10 + i % 2, 11) for i in range(10)]
+    >>> learn_profiles(rows, {})[Key(1, 'select name', 1, 'dummy.toml'), 'minimum'].versions
+    10
+    >>> learn_profiles(rows, {})[Key(1, 'select name', 1, 'dummy.toml'), 'p50'].median
+    11.0
+    >>> learn_profiles(rows[:5], {})
+    {}
+    """
+    profiles = dict(profiles)
+    now = int(time.time())
+    for key, versions, *series in version_series(results, PROFILE_METRICS):
+        for metric, values in zip(PROFILE_METRICS, series):
+            values = values[~np.isnan(values)]
+            if len(values) < MIN_PROFILE_VERSIONS:
+                continue
+            profiles[key, metric] = noise_profile(values, now)
+    return profiles
+
+
+def find_regressions(hosts,
+                     table,
+                     method='minimum',
+                     profiles_path=NOISE_PROFILES,
+                     days=20,
+                     until=None,
+                     store_path=None,
+                     offline=False,
+                     results_path=None):
+    start, end = _window(days, until)
+    store = store_path and ResultStore(store_path) or None
+    if results_path:
+        results = _file_results(results_path, start, end)
+    elif not offline:
+        user = os.getenv('DB_USERNAME')
+        password = os.getenv('DB_PASSWORD')
+        disable_ssl_verify = "verify_ssl=false" in hosts
+        with connect(hosts,
+                     username=user,
+                     password=password,
+                     verify_ssl_cert=not disable_ssl_verify) as conn:
+            c = conn.cursor()
+            if store:
+                new_results = store.sync(c, table, start)
+                print(f'Synced {new_results} new results into {store_path}')
+            else:
+                results = results_frame(_fetch_results(c, table, start, end))
+    if store and not results_path:
+        results = _stored_results(store, start, end)
+    profiles = learn_profiles(results, load_profiles(profiles_path))
+    save_profiles(profiles_path, profiles)
+    if method == 'changepoint':
+        shifts = find_shifts(results)
+        if shifts:
+            print_shifts(shifts)
+        if any(s.persisted and s.ci[0] > 0 and s.diff > regression_threshold(profiles.get((s.key, s.metric)))
+               for s in shifts):
+            sys.exit(1)
+        return
+    diffs = [d for metric in DIFF_METRICS for d in find_diffs(results, metric)]
+    if diffs:
+        # Each metric of a benchmark is held to a threshold derived from its own noise
+        likely_regressions = [d for d in diffs
+                              if d.linregress_slope > 1.00
+                              and d.diff > regression_threshold(profiles.get((d.key, d.metric)))]
+        print_diffs(likely_regressions)
+        if likely_regressions:
+            sys.exit(1)
 
 
 def main():
     p = argparse.ArgumentParser()
     p.add_argument('--hosts', type=str, default='localhost:4200')
     p.add_argument('--table', type=str, default='benchmarks')
+    p.add_argument('--method', choices=METHODS, default='minimum',
+                   help='minimum: compare the minimum of the latest result with the largest previous minimum. '
+                        'changepoint: detect level shifts of p50 and minimum across versions (PELT)')
+    p.add_argument('--noise-profiles', type=str, default=NOISE_PROFILES,
+                   help='File with the noise profile of each benchmark, learned from the results and refreshed '
+                        'on every run. Regression thresholds scale with the noise of each benchmark')
+    p.add_argument('--days', type=float, default=20,
+                   help='Number of days of results that are analysed. Defaults to 20')
+    p.add_argument('--until', type=str,
+                   help='End of the analysed time window as ISO 8601 date (time). Defaults to now')
+    p.add_argument('--store', type=str,
+                   help='Directory of a local copy of the results table (Parquet). New results are synced into '
+                        'it incrementally and the analysis reads the local copy')
+    p.add_argument('--offline', action='store_true',
+                   help='Analyse the results of --store without connecting to --hosts')
+    p.add_argument('--results', type=str,
+                   help='Analyse cr8 result files (JSONL) instead of the results table: a file, a directory '
+                        '(all *.jsonl files within, recursively) or a glob pattern')
     args = p.parse_args()
-    find_regressions(hosts=args.hosts, table=args.table)
+    if args.offline and not args.store:
+        p.error('--offline requires --store')
+    find_regressions(hosts=args.hosts,
+                     table=args.table,
+                     method=args.method,
+                     profiles_path=args.noise_profiles,
+                     days=args.days,
+                     until=args.until,
+                     store_path=args.store,
+                     offline=args.offline,
+                     results_path=args.results)
 
 
 if __name__ == "__main__":
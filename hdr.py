@@ -0,0 +1,308 @@
+#!/usr/bin/env python3
+
+"""
+HDR (high dynamic range) histogram for runtime samples.
+
+Values are recorded with a fixed resolution (1 µs for runtimes in ms) into
+log-linear buckets: every power of two is split into 1024 sub-buckets, which
+keeps the relative error below 0.1% (3 significant digits) with a fixed
+amount of memory, no matter how many samples are recorded.
+
+Histograms of several forks can be merged and are serialized into a compact
+string, which is stored in the `hdr` entry of a runtime stats dict in place of
+the `samples` list.
+"""
+
+import base64
+import zlib
+from functools import partial
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+from cr8 import engine, metrics
+
+
+SUB_BUCKET_BITS = 10
+SUB_BUCKET_HALF = 1 << SUB_BUCKET_BITS
+# Values up to 2^40 units (~12 days with a resolution of 1 µs) can be recorded
+MAX_BITS = 40
+NUM_COUNTS = SUB_BUCKET_HALF * (MAX_BITS - SUB_BUCKET_BITS + 1)
+# Same percentiles as cr8.metrics.Stats
+PLEVELS = [50, 75, 90, 95, 99, 99.9]
+ENCODING_PREFIX = 'hdr1:'
+# Sample mode of the benchmark scripts, which records all samples and stores
+# them as histogram
+HDR_SAMPLE_MODE = 'hdr'
+# Number of samples kept in execution order for the warm-up detection
+WARMUP_PREFIX = 10_000
+# Samples are recorded into the histogram in batches of this size
+RECORD_BATCH = 4096
+
+
+def bucket_index(units: np.ndarray) -> np.ndarray:
+    """ Index of the bucket of each (integer) value
+
+    >>> bucket_index(np.array([0, 1, 2047, 2048, 2049, 2050, 4096]))
+    array([   0,    1, 2047, 2048, 2048, 2049, 3072])
+    """
+    # frexp returns e with units = m * 2^e and 0.5 <= m < 1, e is the bit length
+    exponent = np.maximum(np.frexp(units.astype(np.float64))[1] - (SUB_BUCKET_BITS + 1), 0)
+    return SUB_BUCKET_HALF * exponent + (units >> exponent)
+
+
+def bucket_bounds(index: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """ Lowest value and width of the buckets
+
+    >>> bucket_bounds(np.array([5, 2048, 2049, 3072]))
+    (array([   5, 2048, 2050, 4096]), array([1, 2, 2, 4]))
+    """
+    exponent = np.maximum(index // SUB_BUCKET_HALF - 1, 0)
+    lowest = (index - SUB_BUCKET_HALF * exponent) << exponent
+    return lowest, np.left_shift(1, exponent)
+
+
+class HdrHistogram:
+    """ Fixed memory histogram with exact count, mean, stdev, min and max
+
+    >>> h = HdrHistogram()
+    >>> h.record([0.5, 1.0, 1.5, 2.0, 250.5])
+    >>> h.count, h.mean, h.min, h.max
+    (5, 51.1, 0.5, 250.5)
+    >>> h.percentile(50), h.percentile(99)
+    (1.5, 250.5)
+    >>> other = HdrHistogram.decode(h.encode())
+    >>> other.merge(h).count
+    10
+    """
+
+    def __init__(self, resolution: float = 0.001):
+        self.resolution = resolution
+        self.counts = np.zeros(NUM_COUNTS, dtype=np.int64)
+        self.count = 0
+        self.mean = 0.0
+        self._m2 = 0.0
+        self.min = float('inf')
+        self.max = float('-inf')
+
+    def _add_moments(self, count: int, mean: float, m2: float):
+        # Chan et al. parallel variance, exact for merges of any size
+        total = self.count + count
+        delta = mean - self.mean
+        self.mean += delta * count / total
+        self._m2 += m2 + delta ** 2 * self.count * count / total
+        self.count = total
+
+    def record(self, values: Iterable[float]):
+        """ Record one or many values """
+        values = np.atleast_1d(np.asarray(values, dtype=np.float64))
+        if not len(values):
+            return
+        units = np.clip(np.rint(values / self.resolution), 0, (1 << MAX_BITS) - 1).astype(np.int64)
+        self.counts += np.bincount(bucket_index(units), minlength=NUM_COUNTS)
+        self.min = min(self.min, float(values.min()))
+        self.max = max(self.max, float(values.max()))
+        mean = float(values.mean())
+        self._add_moments(len(values), mean, float(((values - mean) ** 2).sum()))
+
+    def merge(self, other: 'HdrHistogram') -> 'HdrHistogram':
+        if other.resolution != self.resolution:
+            raise ValueError('Histograms with different resolutions cannot be merged')
+        if other.count:
+            self.counts += other.counts
+            self.min = min(self.min, other.min)
+            self.max = max(self.max, other.max)
+            self._add_moments(other.count, other.mean, other._m2)
+        return self
+
+    @property
+    def variance(self) -> float:
+        return self._m2 / (self.count - 1) if self.count > 1 else 0.0
+
+    @property
+    def stdev(self) -> float:
+        return self.variance ** 0.5
+
+    def buckets(self) -> Tuple[np.ndarray, np.ndarray]:
+        """ Representative value and count of each non-empty bucket, in ascending order """
+        index = np.flatnonzero(self.counts)
+        lowest, width = bucket_bounds(index)
+        values = (lowest + (width - 1) / 2) * self.resolution
+        return np.clip(values, self.min, self.max), self.counts[index]
+
+    def percentiles(self, plevels: Iterable[float]) -> np.ndarray:
+        """ Percentiles using the nearest rank method like cr8.metrics.percentile """
+        values, counts = self.buckets()
+        ranks = np.clip((np.asarray(plevels, dtype=np.float64) / 100 * self.count - 0.5).astype(np.int64),
+                        0, self.count - 1)
+        return values[np.searchsorted(np.cumsum(counts), ranks, side='right')]
+
+    def percentile(self, plevel: float) -> float:
+        return float(self.percentiles([plevel])[0])
+
+    def encode(self) -> str:
+        """ Serialize into a compact string (delta encoded non-empty buckets, zlib, base64) """
+        index = np.flatnonzero(self.counts)
+        header = np.array([self.count, self.mean, self._m2, self.min, self.max, self.resolution], dtype='<f8')
+        body = np.concatenate([np.diff(index, prepend=0), self.counts[index]]).astype('<i8')
+        data = zlib.compress(header.tobytes() + body.tobytes(), 9)
+        return ENCODING_PREFIX + base64.b64encode(data).decode('ascii')
+
+    @classmethod
+    def decode(cls, encoded: str) -> 'HdrHistogram':
+        if not encoded.startswith(ENCODING_PREFIX):
+            raise ValueError('Not an encoded HdrHistogram')
+        data = zlib.decompress(base64.b64decode(encoded[len(ENCODING_PREFIX):]))
+        count, mean, m2, min_, max_, resolution = np.frombuffer(data[:48], dtype='<f8')
+        body = np.frombuffer(data[48:], dtype='<i8')
+        h = cls(float(resolution))
+        index = np.cumsum(body[:len(body) // 2])
+        h.counts[index] = body[len(body) // 2:]
+        h.count = int(count)
+        h.mean = float(mean)
+        h._m2 = float(m2)
+        h.min = float(min_)
+        h.max = float(max_)
+        return h
+
+    @classmethod
+    def from_stats(cls, runtime_stats: Dict[str, Any]) -> 'HdrHistogram':
+        """ Histogram of a runtime stats dict, either from its `hdr` entry or from its samples """
+        if 'hdr' in runtime_stats:
+            return cls.decode(runtime_stats['hdr'])
+        h = cls()
+        h.record(runtime_stats['samples'] if 'samples' in runtime_stats else runtime_stats['mean'])
+        return h
+
+    def stats(self) -> Dict[str, Any]:
+        """ Runtime stats in the layout of cr8.metrics.Stats, with `hdr` instead of `samples` """
+        if not self.count:
+            return dict(n=0)
+        percentiles = self.percentiles(PLEVELS)
+        median = float(percentiles[0])
+        return dict(
+            min=self.min,
+            max=self.max,
+            mean=self.mean,
+            median=median,
+            variance=self.variance,
+            error_margin=1.96 * self.stdev / self.count ** 0.5,
+            stdev=self.stdev,
+            percentile={str(p).replace('.', '_'): float(v) for p, v in zip(PLEVELS, percentiles)},
+            n=self.count,
+            hdr=self.encode()
+        )
+
+
+class HdrSampler:
+    """ cr8 sampler which records the samples into a histogram as they arrive
+
+    With `truncation` (a function returning the number of warm-up samples of
+    a list of samples) the first WARMUP_PREFIX samples are kept in execution
+    order and the detected warm-up is left out of the histogram.
+
+    >>> sampler = HdrSampler(truncation=lambda samples: 2)
+    >>> for value in [50.0, 40.0, 1.0, 2.0, 3.0]:
+    ...     sampler.add(value)
+    >>> stats = sampler.stats()
+    >>> stats['n'], stats['mean'], stats['warmup']
+    (3, 2.0, {'n': 2, 'duration': 90.0})
+    """
+
+    def __init__(self,
+                 truncation: Optional[Callable[[List[float]], int]] = None,
+                 prefix_size: int = WARMUP_PREFIX):
+        self.truncation = truncation
+        self.prefix_size = prefix_size if truncation else 0
+        self.histogram = HdrHistogram()
+        self.prefix: List[float] = []
+        self.pending: List[float] = []
+        self.count = 0
+
+    def add(self, value: float):
+        self.count += 1
+        if len(self.prefix) < self.prefix_size:
+            self.prefix.append(value)
+            return
+        self.pending.append(value)
+        if len(self.pending) >= RECORD_BATCH:
+            self.histogram.record(self.pending)
+            self.pending = []
+
+    @property
+    def values(self) -> List[float]:
+        # Only used by cr8.metrics.Stats.get, which HdrStats replaces
+        return self.prefix + self.pending
+
+    def stats(self) -> Dict[str, Any]:
+        """ Runtime stats like HdrHistogram.stats with the warm-up left out """
+        n = self.truncation(self.prefix) if self.truncation and self.prefix else 0
+        histogram = HdrHistogram().merge(self.histogram)
+        histogram.record(self.prefix[n:] + self.pending)
+        stats = histogram.stats()
+        if self.truncation:
+            stats['warmup'] = {'n': n, 'duration': float(sum(self.prefix[:n]))}
+        return stats
+
+
+class HdrStats(metrics.Stats):
+    """ cr8.metrics.Stats which returns the stats of a HdrSampler """
+
+    def get(self):
+        if isinstance(self.sampler, HdrSampler):
+            return self.sampler.stats()
+        return super().get()
+
+
+_warmup_truncation: Optional[Callable[[List[float]], int]] = None
+
+
+def get_sampler(sample_mode: str):
+    """ cr8.metrics.get_sampler which additionally supports HDR_SAMPLE_MODE """
+    if sample_mode == HDR_SAMPLE_MODE:
+        return partial(HdrSampler, truncation=_warmup_truncation)
+    return metrics.get_sampler(sample_mode)
+
+
+def install_hdr_sampler(warmup_truncation: Optional[Callable[[List[float]], int]] = None):
+    """ Make the cr8 query runner accept HDR_SAMPLE_MODE
+
+    The other sample modes are unaffected. `warmup_truncation` detects the
+    warm-up phase of the queries run with HDR_SAMPLE_MODE, None keeps it.
+    """
+    global _warmup_truncation
+    _warmup_truncation = warmup_truncation
+    engine.Stats = HdrStats
+    engine.get_sampler = get_sampler
+
+
+def to_hdr_stats(runtime_stats: Dict[str, Any]) -> Dict[str, Any]:
+    """ Replace the samples of a runtime stats dict with a histogram
+
+    Entries that aren't derived from the samples (like `warmup`) are kept.
+
+    >>> stats = to_hdr_stats({'n': 3, 'mean': 2.0, 'samples': [1.0, 2.0, 3.0], 'warmup': {'n': 0}})
+    >>> stats['n'], stats['percentile']['50'], stats['warmup'], 'samples' in stats
+    (3, 2.0, {'n': 0}, False)
+    """
+    if 'hdr' in runtime_stats or not runtime_stats.get('samples'):
+        return runtime_stats
+    h = HdrHistogram.from_stats(runtime_stats)
+    stats = h.stats()
+    for key, value in runtime_stats.items():
+        if key not in stats and key != 'samples':
+            stats[key] = value
+    return stats
+
+
+def merge_hdr_stats(runtime_stats: Iterable[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    """ Merge the histograms (or samples) of several runtime stats dicts """
+    merged = None
+    for r in runtime_stats:
+        h = HdrHistogram.from_stats(r)
+        merged = merged.merge(h) if merged else h
+    return merged and merged.stats()
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,449 @@
+#!/usr/bin/env python3
+
+"""
+Generate a self-contained HTML report from the JSON lines written with
+`--output-json` by compare_run.py, compare_results.py and
+compare_run_disk_usage.py.
+
+    ./compare_run.py --v1 5.6.0 --v2 5.7.0 --spec specs/select.toml --output-json run.jsonl
+    ./html_report.py run.jsonl --output report.html
+
+For every query the report shows the latency distribution of each version
+pooled over all forks (ECDF and violin plot) and the median and p99 of every
+fork, as well as the indexing timeline of the query if it was sampled
+(`compare_run.py --report-indexing`). JVM/GC, process, indexing and disk usage
+tables follow.
+The plots are rendered with matplotlib in worker processes and embedded as
+PNG images.
+"""
+
+import argparse
+import base64
+import html
+import io
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+from matplotlib.figure import Figure
+from tabulate import tabulate
+
+from compare_measures import Diff, merge_stats, sorted_samples
+from indexing_stats import TIMELINE_PEAK_HEADERS, timeline_peaks
+from util import human_readable_byte_size
+
+
+VIOLIN_POINTS = 500
+STYLE = '''
+body { font-family: sans-serif; margin: 2em; color: #222; }
+table { border-collapse: collapse; margin: 0.5em 0 1em 0; font-size: 0.9em; }
+th, td { border: 1px solid #ccc; padding: 0.2em 0.6em; text-align: right; }
+th:first-child, td:first-child { text-align: left; }
+pre { background: #f4f4f4; padding: 0.5em; white-space: pre-wrap; }
+section { border-top: 1px solid #ddd; margin-top: 1.5em; }
+.regression { color: #b00; font-weight: bold; }
+.improvement { color: #080; font-weight: bold; }
+'''
+
+
+def read_records(paths: List[str]) -> List[Dict[str, Any]]:
+    records = []
+    for path in paths:
+        with open(path) as f:
+            records.extend(json.loads(line) for line in f if line.strip())
+    return records
+
+
+def query_key(query: Dict[str, Any]) -> Tuple:
+    return (query.get('spec'), query['statement'], query['concurrency'], query.get('bulk_size'))
+
+
+def collect_queries(records: List[Dict[str, Any]]) -> Dict[Tuple, Dict[str, Any]]:
+    """ Group the runtime stats of each query by fork (`forks[fork][version]`)
+
+    The indexing timelines are grouped the same way in `indexing_timelines`.
+
+    >>> records = [{'queries': [{'statement': 'select 1', 'concurrency': 1, 'name': 'one', 'runtime_stats': [1, 2]}]},
+    ...            {'queries': [{'statement': 'select 1', 'concurrency': 1, 'name': 'one', 'runtime_stats': [3, 4]}]}]
+    >>> query = collect_queries(records)[(None, 'select 1', 1, None)]
+    >>> query['forks'], query['indexing_timelines']
+    ([[1, 2], [3, 4]], [None, None])
+    """
+    queries = {}
+    for record in records:
+        for q in record['queries']:
+            query = queries.setdefault(query_key(q), {
+                'spec': q.get('spec'),
+                'name': q.get('name'),
+                'statement': q['statement'],
+                'concurrency': q['concurrency'],
+                'forks': [],
+                'indexing_timelines': [],
+            })
+            query['forks'].append(q['runtime_stats'])
+            query['indexing_timelines'].append(q.get('indexing_timeline'))
+    return queries
+
+
+def relative_change(base: float, value: float) -> float:
+    """
+    >>> relative_change(10.0, 12.5)
+    25.0
+    >>> relative_change(0, 0)
+    0.0
+    """
+    return (value - base) / base * 100 if base else 0.0
+
+
+def quantile(runtime_stats: Dict[str, Any], q: float) -> float:
+    """ Quantile (nearest rank) of the samples or histogram of runtime stats
+
+    cr8 leaves out `median` and `percentile` for queries with a single
+    sample, so they are taken from the samples.
+
+    >>> quantile({'n': 1, 'mean': 5.0, 'samples': [5.0]}, 0.99)
+    5.0
+    >>> quantile({'n': 1, 'mean': 5.0}, 0.5)
+    5.0
+    >>> quantile({'samples': list(range(1, 101))}, 0.99)
+    99.0
+    """
+    values, weights = sorted_samples(runtime_stats)
+    cum = np.cumsum(weights if weights is not None else np.ones(len(values)))
+    return float(values[np.searchsorted(cum, max(np.ceil(q * cum[-1] - 1e-9), 1), side='left')])
+
+
+def distribution_points(runtime_stats: Dict[str, Any], points: int = VIOLIN_POINTS) -> np.ndarray:
+    """ Evenly spaced quantiles which stand in for the samples in a violin plot
+
+    >>> distribution_points({'samples': [3.0, 1.0, 2.0]}, 10)
+    array([1., 2., 3.])
+    >>> distribution_points({'samples': list(range(1000))}, 4)
+    array([124., 374., 624., 874.])
+    """
+    values, weights = sorted_samples(runtime_stats)
+    if weights is None and len(values) <= points:
+        return values
+    qs = (np.arange(points) + 0.5) / points
+    if weights is None:
+        return values[np.maximum(np.ceil(qs * len(values) - 1e-9).astype(int), 1) - 1]
+    cum = np.cumsum(weights)
+    return values[np.searchsorted(cum, np.maximum(np.ceil(qs * cum[-1] - 1e-9), 1), side='left')]
+
+
+def plot_distribution(ecdf, violin, labels: List[str], pooled: List[Optional[Dict[str, Any]]]):
+    present = [(label, r) for label, r in zip(labels, pooled) if r]
+    for label, r in present:
+        values, weights = sorted_samples(r)
+        cum = np.cumsum(weights if weights is not None else np.ones(len(values)))
+        ecdf.step(values, cum / cum[-1], where='post', label=label)
+    ecdf.set_xlabel('ms')
+    ecdf.set_ylabel('ECDF')
+    ecdf.legend(fontsize='small')
+    violin.violinplot([distribution_points(r) for _, r in present], showmedians=True)
+    violin.set_xticks(range(1, len(present) + 1), [label for label, _ in present])
+    violin.set_ylabel('ms')
+
+
+def plot_forks(ax, labels: List[str], forks: List[List[Optional[Dict[str, Any]]]]):
+    for i, label in enumerate(labels):
+        points = [(f + 1, stats[i]) for f, stats in enumerate(forks) if stats[i]]
+        if not points:
+            continue
+        line, = ax.plot([f for f, _ in points], [quantile(r, 0.5) for _, r in points], marker='o',
+                        label=f'{label} median')
+        ax.plot([f for f, _ in points], [quantile(r, 0.99) for _, r in points],
+                marker='x', linestyle='--', color=line.get_color(), label=f'{label} p99')
+    ax.set_xlabel('fork')
+    ax.set_ylabel('ms')
+    ax.xaxis.get_major_locator().set_params(integer=True)
+    ax.legend(fontsize='small')
+
+
+def plot_query(labels: List[str], pooled: List[Optional[Dict[str, Any]]], forks) -> str:
+    """ ECDF and violin plot of the pooled runtimes and the median/p99 per fork as embedded PNG """
+    fig = Figure(figsize=(14, 3.5))
+    ecdf, violin, trend = fig.subplots(1, 3, gridspec_kw={'width_ratios': [2, 1, 2]})
+    fig.subplots_adjust(left=0.05, right=0.98, bottom=0.15, wspace=0.25)
+    plot_distribution(ecdf, violin, labels, pooled)
+    plot_forks(trend, labels, forks)
+    buf = io.BytesIO()
+    fig.savefig(buf, format='png', dpi=80)
+    return f'<img src="data:image/png;base64,{base64.b64encode(buf.getvalue()).decode("ascii")}">'
+
+
+def indexing_timeline_table(labels: List[str], timelines: List[Optional[List[Optional[Dict[str, Any]]]]]) -> str:
+    rows = [
+        (f + 1, label, *timeline_peaks(t))
+        for f, fork in enumerate(timelines) if fork
+        for label, t in zip(labels, fork) if t
+    ]
+    return tabulate(rows, headers=('Fork', 'Version', *TIMELINE_PEAK_HEADERS), tablefmt='html', floatfmt='.2f')
+
+
+def plot_indexing_timelines(labels: List[str], timelines: List[Optional[List[Optional[Dict[str, Any]]]]]) -> str:
+    """ Segments, translog and write queue of every fork over the time of the query as embedded PNG """
+    fig = Figure(figsize=(14, 2.5))
+    axes = fig.subplots(1, 3)
+    fig.subplots_adjust(left=0.05, right=0.98, bottom=0.2, wspace=0.25)
+    colors = {}
+    for fork in timelines:
+        for label, t in zip(labels, fork or []):
+            if not t:
+                continue
+            for ax, metric in zip(axes, ('segments', 'translog', 'write_queue')):
+                line, = ax.plot(t['seconds'], t.get(metric, [0] * len(t['seconds'])), color=colors.get(label),
+                                label=label if label not in colors else None)
+            colors.setdefault(label, line.get_color())
+    for ax, ylabel in zip(axes, ('segments', 'translog MB', 'write queue')):
+        ax.set_xlabel('s')
+        ax.set_ylabel(ylabel)
+    axes[0].legend(fontsize='small')
+    buf = io.BytesIO()
+    fig.savefig(buf, format='png', dpi=80)
+    return f'<img src="data:image/png;base64,{base64.b64encode(buf.getvalue()).decode("ascii")}">'
+
+
+def render_query(job: Dict[str, Any]) -> Tuple[str, List[Tuple[str, float, bool]]]:
+    """ Pool the forks of a query, compare the versions and render its section
+
+    Runs in a worker process. Returns the HTML and the (label, change of the
+    mean, significant) tuples of the versions compared to the baseline.
+
+    Queries with a single sample per fork have no median or percentiles in
+    their runtime stats:
+
+    >>> single = {'min': 5.0, 'max': 5.0, 'mean': 5.0, 'n': 1, 'stdev': 0, 'samples': [5.0]}
+    >>> section, changes = render_query({'anchor': 'q0', 'title': 'delete', 'statement': 'delete from t',
+    ...                                  'concurrency': 1, 'labels': ['V1', 'V2'], 'baseline': 0,
+    ...                                  'forks': [[single, single]] * 3})
+    >>> changes
+    [('V2', 0.0, False)]
+
+    The indexing timelines of write statements are shown below the plots:
+
+    >>> timeline = {'seconds': [0.5, 1.5], 'segments': [12, 9], 'merges': [1, 1], 'merge_throttled_ms': [200.0, 0.0],
+    ...             'merge_throttle': [20.0, 20.0], 'translog': [3.0, 2.0], 'translog_growth': [2.0, -1.0],
+    ...             'refresh_pending': [1, 4]}
+    >>> section, _ = render_query({'anchor': 'q1', 'title': 'insert', 'statement': 'insert into t',
+    ...                            'concurrency': 1, 'labels': ['V1', 'V2'], 'baseline': 0,
+    ...                            'forks': [[single, single]], 'indexing_timelines': [[timeline, None]]})
+    >>> 'Indexing timeline' in section, section.count('<img')
+    (True, 2)
+    """
+    labels = job['labels']
+    baseline = job['baseline']
+    forks = job['forks']
+    pooled = [merge_stats([stats[i] for stats in forks if stats[i]]) if any(stats[i] for stats in forks) else None
+              for i in range(len(labels))]
+    base = pooled[baseline]
+    rows = []
+    changes = []
+    for i, (label, r) in enumerate(zip(labels, pooled)):
+        if not r:
+            rows.append((label, 'no results'))
+            continue
+        row = [label, r['n'], r['mean'], quantile(r, 0.5), quantile(r, 0.99), r['max']]
+        if i != baseline and base:
+            diff = Diff(base, r)
+            row += [f"{relative_change(base['mean'], r['mean']):+.2f}%", f'{diff.probability:.2f}%']
+            changes.append((label, relative_change(base['mean'], r['mean']), bool(diff.is_significant)))
+        rows.append(row)
+    headers = ('Version', 'n', 'Mean', 'Median', 'p99', 'Max', 'Δ mean', 'Probability')
+    parts = [
+        f'<section id="{job["anchor"]}">',
+        f'<h3>{html.escape(job["title"])}</h3>',
+        f'<pre>{html.escape(job["statement"])}</pre>',
+        f'<p>Concurrency {job["concurrency"]}, {len(forks)} forks</p>',
+        tabulate(rows, headers=headers, tablefmt='html', floatfmt='.3f'),
+    ]
+    if any(pooled):
+        parts.append(plot_query(labels, pooled, forks))
+    timelines = job.get('indexing_timelines') or []
+    if any(t for fork in timelines if fork for t in fork):
+        parts.append('<h4>Indexing timeline</h4>')
+        parts.append(indexing_timeline_table(labels, timelines))
+        parts.append(plot_indexing_timelines(labels, timelines))
+    parts.append('</section>')
+    return '\n'.join(parts), changes
+
+
+def _version(version: Any) -> str:
+    if isinstance(version, dict):
+        return f"{version.get('number')}-{version.get('hash')}"
+    return str(version)
+
+
+def _change_cell(label: str, change: float, significant: bool) -> str:
+    if not significant:
+        return f'{label} {change:+.2f}%'
+    css = 'regression' if change > 0 else 'improvement'
+    return f'<span class="{css}">{label} {change:+.2f}%</span>'
+
+
+def summary_table(jobs: List[Dict[str, Any]], changes: List[List[Tuple[str, float, bool]]]) -> str:
+    rows = [
+        (f'<a href="#{job["anchor"]}">{html.escape(job["title"][:80])}</a>', job['concurrency'],
+         ' '.join(_change_cell(*c) for c in query_changes))
+        for job, query_changes in zip(jobs, changes)
+    ]
+    return tabulate(rows, headers=('Query', 'C', 'Δ mean (bold: significant)'), tablefmt='unsafehtml')
+
+
+def jvm_table(records: List[Dict[str, Any]]) -> Optional[str]:
+    rows = []
+    for record in records:
+        for label, m in zip(record['labels'], record.get('jvm') or []):
+            if not m or 'gc' not in m:
+                continue
+            young = m['gc']['young']
+            old = m['gc']['old']
+            rows.append((
+                record.get('fork', 0) + 1,
+                label,
+                young['count'], young['avg_duration_ns'] / 1e6, young['max_duration_ns'] / 1e6,
+                old['count'], old['avg_duration_ns'] / 1e6, old['max_duration_ns'] / 1e6,
+                m['heap']['initial'] / 1e6, m['heap']['used'] / 1e6,
+                m['alloc']['rate'] / 1e6, m['alloc']['total'] / 1e6,
+            ))
+    if not rows:
+        return None
+    headers = ('Fork', 'Version', 'Young GC', 'avg ms', 'max ms', 'Old GC', 'avg ms', 'max ms',
+               'Heap initial MB', 'Heap used MB', 'Alloc MB/s', 'Alloc MB')
+    return tabulate(rows, headers=headers, tablefmt='html', floatfmt='.2f')
+
+
+def proc_table(records: List[Dict[str, Any]]) -> Optional[str]:
+    rows = [
+        (record.get('fork', 0) + 1, label, p['cpu_user'], p['cpu_system'], p['rss_max_mb'], p['read_mb'],
+         p['write_mb'], p['voluntary_cs'], p['involuntary_cs'], p['run_delay_ms'], p['threads_max'])
+        for record in records
+        for label, p in zip(record['labels'], record.get('proc') or [])
+        if p
+    ]
+    if not rows:
+        return None
+    headers = ('Fork', 'Version', 'CPU usr %', 'CPU sys %', 'RSS MB', 'Read MB', 'Write MB',
+               'Vol CS', 'Invol CS', 'Run delay ms', 'Threads')
+    return tabulate(rows, headers=headers, tablefmt='html', floatfmt='.2f')
+
+
+def indexing_table(records: List[Dict[str, Any]], labels: List[str], baseline: int) -> Optional[str]:
+    """ Segment and shard statistics of each version, averaged over the forks """
+    sums = [{} for _ in labels]
+    counts = [0] * len(labels)
+    for record in records:
+        for i, m in enumerate(record.get('indexing') or []):
+            if not m:
+                continue
+            counts[i] += 1
+            for group in ('segments', 'shards'):
+                for metric, value in (m.get(group) or {}).items():
+                    sums[i][f'{group}.{metric}'] = sums[i].get(f'{group}.{metric}', 0) + value
+    if not all(counts):
+        return None
+    means = [{k: v / n for k, v in s.items()} for s, n in zip(sums, counts)]
+    rows = []
+    for metric in means[baseline]:
+        values = [m.get(metric, 0) for m in means]
+        rows.append([metric] + values + [
+            f'{relative_change(values[baseline], v):+.2f}%' for i, v in enumerate(values) if i != baseline
+        ])
+    headers = ['Metric'] + labels + [f'Δ {label}' for i, label in enumerate(labels) if i != baseline]
+    return tabulate(rows, headers=headers, tablefmt='html', floatfmt='.2f')
+
+
+def disk_usage_table(record: Dict[str, Any]) -> str:
+    sizes = record['sizes']
+    rows = []
+    for ext in sorted(set().union(*sizes), key=lambda ext: -sizes[0].get(ext, 0)):
+        values = [s.get(ext, 0) for s in sizes]
+        rows.append([ext] + ['%.2f %s' % human_readable_byte_size(v) for v in values] + [
+            f'{relative_change(values[0], v):+.2f}%' for v in values[1:]
+        ])
+    totals = [sum(s.values()) for s in sizes]
+    rows.append(['Total'] + ['%.2f %s' % human_readable_byte_size(v) for v in totals] + [
+        f'{relative_change(totals[0], v):+.2f}%' for v in totals[1:]
+    ])
+    headers = ['File type'] + record['labels'] + [f'Δ {label}' for label in record['labels'][1:]]
+    return tabulate(rows, headers=headers, tablefmt='html')
+
+
+def build_report(records: List[Dict[str, Any]], title: str, workers: Optional[int] = None) -> str:
+    compare_records = [r for r in records if r.get('kind', 'compare') == 'compare']
+    disk_records = [r for r in records if r.get('kind') == 'disk_usage']
+    parts = [f'<h1>{html.escape(title)}</h1>']
+    if compare_records:
+        labels = compare_records[0]['labels']
+        baseline = compare_records[0].get('baseline', 0)
+        if any(r['labels'] != labels for r in compare_records):
+            raise SystemExit('All records must compare the same versions')
+        parts.append('<ul>' + ''.join(
+            f'<li>{label}: {html.escape(_version(v))}{" (baseline)" if i == baseline else ""}</li>'
+            for i, (label, v) in enumerate(zip(labels, compare_records[0]['versions']))
+        ) + '</ul>')
+        jobs = [
+            {
+                'anchor': f'q{i}',
+                'title': (q['spec'] and f"{q['spec']}: " or '') + (q['name'] or q['statement']),
+                'statement': q['statement'],
+                'concurrency': q['concurrency'],
+                'labels': labels,
+                'baseline': baseline,
+                'forks': q['forks'],
+                'indexing_timelines': q['indexing_timelines'],
+            }
+            for i, q in enumerate(collect_queries(compare_records).values())
+        ]
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            rendered = list(pool.map(render_query, jobs))
+        parts.append('<h2>Summary</h2>')
+        parts.append(summary_table(jobs, [changes for _, changes in rendered]))
+        parts.append('<h2>Queries</h2>')
+        parts.extend(section for section, _ in rendered)
+        for heading, table in (('JVM / GC (cluster total per fork)', jvm_table(compare_records)),
+                               ('Process metrics (/proc, CPU in % of a core)', proc_table(compare_records)),
+                               ('Indexing statistics (mean over forks)',
+                                indexing_table(compare_records, labels, baseline))):
+            if table:
+                parts.append(f'<h2>{heading}</h2>')
+                parts.append(table)
+    for record in disk_records:
+        parts.append('<h2>Disk usage</h2>')
+        parts.append('<ul>' + ''.join(
+            f'<li>{label}: {html.escape(_version(v))}</li>' for label, v in zip(record['labels'], record['versions'])
+        ) + '</ul>')
+        parts.append(disk_usage_table(record))
+    body = '\n'.join(parts)
+    return f'''<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>{html.escape(title)}</title>
+<style>{STYLE}</style>
+</head>
+<body>
+{body}
+</body>
+</html>
+'''
+
+
+def main():
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument('inputs', nargs='+', help='JSON lines files written with --output-json')
+    p.add_argument('-o', '--output', type=str, default='report.html', help='Path of the HTML file')
+    p.add_argument('--title', type=str, default='Benchmark report')
+    p.add_argument('--workers', type=int, default=os.cpu_count(),
+                   help='Number of worker processes rendering the plots. Defaults to the number of CPUs')
+    args = p.parse_args()
+    report = build_report(read_records(args.inputs), args.title, args.workers)
+    with open(args.output, 'w') as f:
+        f.write(report)
+    print(f'Report written to {args.output}')
+
+
+if __name__ == '__main__':
+    main()
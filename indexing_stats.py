@@ -1,8 +1,15 @@
 # -*- coding: utf-8 -*-
-from typing import Dict, Any
+import asyncio
+import time
+from contextlib import suppress
+from typing import Dict, Any, List, NamedTuple, Optional
 
 from crate.client.connection import connect
 from crate.client.cursor import Cursor
+from crate.client.exceptions import Error
+from tabulate import tabulate
+
+from proc_sampler import sparkline
 
 SEGMENTS_STATS_STMT = '''
 SELECT
@@ -75,43 +82,65 @@ WHERE
 '''
 
 
-def report_indexing_stats(indexing_metrics_v1: Dict[str, Any],
-                          indexing_metrics_v2: Dict[str, Any]):
+NODE_FILTER = '''
+  AND
+    node['name'] = ?
+'''
+
+NODES_STATS_STMT = '''
+SELECT
+    thread_pools,
+    breakers
+FROM
+    sys.nodes
+'''
+
+# Thread pools of which the active threads, queue and rejections are sampled
+TIMELINE_POOLS = ('write', 'search', 'refresh', 'flush', 'force_merge')
+
+
+class IndexingSample(NamedTuple):
+    ts: int  # epoch ms
+    segments: Dict[str, Any]  # SEGMENTS_STATS_STMT
+    shards: Dict[str, Any]  # SHARDS_STATS_STMT
+    pools: Dict[str, Dict[str, int]]  # active, queue and rejected of each thread pool, summed over all nodes
+    breakers: Dict[str, float]  # used MB of each circuit breaker, summed over all nodes
+
+
+def report_indexing_stats(indexing_metrics: List[Dict[str, Any]],
+                          labels: List[str],
+                          title: str = 'Indexing statistics across all primary shards'):
     print("")
-    print("Indexing statistics across all primary shards")
-    segments_metrics_v1 = indexing_metrics_v1.get('segments')
-    segments_metrics_v2 = indexing_metrics_v2.get('segments')
-    if segments_metrics_v1:
-        report_segment_stats(segments_metrics_v1, segments_metrics_v2)
-
-    shards_metrics_v1 = indexing_metrics_v1.get('shards')
-    shards_metrics_v2 = indexing_metrics_v2.get('shards')
-    if shards_metrics_v1:
-        report_shard_stats(shards_metrics_v1, shards_metrics_v2)
-
-
-def report_segment_stats(segments_metrics_v1: Dict[str, Any], segments_metrics_v2: Dict[str, Any]):
-    cnt_v1 = segments_metrics_v1["cnt"]
-    size_v1 = segments_metrics_v1["size"]
-    min_v1 = segments_metrics_v1["min_size"]
-    max_v1 = segments_metrics_v1["max_size"]
-    avg_v1 = segments_metrics_v1["avg_size"]
-    cnt_v2 = segments_metrics_v2["cnt"]
-    size_v2 = segments_metrics_v2["size"]
-    min_v2 = segments_metrics_v2["min_size"]
-    max_v2 = segments_metrics_v2["max_size"]
-    avg_v2 = segments_metrics_v2["avg_size"]
+    print(title)
+    segments_metrics = [m.get('segments') for m in indexing_metrics]
+    if all(segments_metrics):
+        report_segment_stats(segments_metrics, labels)
+
+    shards_metrics = [m.get('shards') for m in indexing_metrics]
+    if all(shards_metrics):
+        report_shard_stats(shards_metrics, labels)
+
+
+def _rows(labels: List[str], stats: List[str]) -> str:
+    return '\n'.join(f'  {label:>2} | {row}' for label, row in zip(labels, stats))
+
+
+def report_segment_stats(segments_metrics: List[Dict[str, Any]], labels: List[str]):
+    segment_stats = []
+    for m in segments_metrics:
+        segment_stats.append(
+            f"{m['cnt']:6.0f} | {m['size']:8.2f} {m['avg_size']:8.2f} {m['min_size']:8.2f} {m['max_size']:8.2f}"
+        )
     print(f''' Segments
      |        |                Size (MB)        
      |    cnt |      sum      avg      min      max
-  V1 | {cnt_v1:6.0f} | {size_v1:8.2f} {avg_v1:8.2f} {min_v1:8.2f} {max_v1:8.2f}
-  V2 | {cnt_v2:6.0f} | {size_v2:8.2f} {avg_v2:8.2f} {min_v2:8.2f} {max_v2:8.2f}
+{_rows(labels, segment_stats)}
     ''')
 
 
-def report_shard_stats(shards_metrics_v1: Dict[str, Any], shards_metrics_v2: Dict[str, Any]):
+def report_shard_stats(shards_metrics: List[Dict[str, Any]], labels: List[str]):
     flush_stats = []
-    for m in (shards_metrics_v1, shards_metrics_v2):
+    for m in shards_metrics:
         cnt = m['flush_count']
         cnt_periodic = m['flush_periodic_count']
         time = m['flush_time']
@@ -125,12 +154,11 @@ def report_shard_stats(shards_metrics_v1: Dict[str, Any], shards_metrics_v2: Dic
     print(f''' Flush                   
      |      Counts      |                   Times (sec)                
      | total   periodic |        sum        avg        min        max 
-  V1 | {flush_stats[0]}
-  V2 | {flush_stats[1]} 
+{_rows(labels, flush_stats)}
     ''')
 
     refresh_stats = []
-    for m in (shards_metrics_v1, shards_metrics_v2):
+    for m in shards_metrics:
         cnt = m['refresh_count']
         cnt_pending = m['refresh_pending_count']
         time = m['refresh_time']
@@ -144,12 +172,11 @@ def report_shard_stats(shards_metrics_v1: Dict[str, Any], shards_metrics_v2: Dic
     print(f''' Refresh 
      |      Counts      |                   Times (sec)                
      | total    pending |        sum        avg        min        max 
-  V1 | {refresh_stats[0]}
-  V2 | {refresh_stats[1]} 
+{_rows(labels, refresh_stats)}
     ''')
 
     merge_stats = []
-    for m in (shards_metrics_v1, shards_metrics_v2):
+    for m in shards_metrics:
         cnt = m['merge_count']
         curr_cnt = m['merge_current_count']
         time = m['merge_time']
@@ -172,12 +199,11 @@ def report_shard_stats(shards_metrics_v1: Dict[str, Any], shards_metrics_v2: Dic
     print(f''' Merge 
      |     Counts     |                   Times (ms)                |             Throttle Times (ms)             |       Docs        |         MB        | Throttle (MB/s)
      | total  current |        sum        avg        min        max |        sum        avg        min        max |   total   current |    total  current | 
-  V1 | {merge_stats[0]}
-  V2 | {merge_stats[1]} 
+{_rows(labels, merge_stats)}
     ''')
 
     translog_stats = []
-    for m in (shards_metrics_v1, shards_metrics_v2):
+    for m in shards_metrics:
         size = m['translog_size']
         size_min = m['translog_size_min']
         size_max = m['translog_size_max']
@@ -205,14 +231,13 @@ def report_shard_stats(shards_metrics_v1: Dict[str, Any], shards_metrics_v2: Dic
     print(f''' Translog 
      |                Size (MB)            |                   Ops               |          Size Uncommitted (MB)      |             Ops Uncommitted       
      |    total      avg      min      max |    total      avg      min      max |    total      avg      min      max |    total      avg      min      max 
-  V1 | {translog_stats[0]}
-  V2 | {translog_stats[1]} 
+{_rows(labels, translog_stats)}
     ''')
 
 
 # Executes a SQL statement, fetches the first row and converts the result into a dict of column_name -> value
-def fetch_sql_result(stmt: str, cursor: Cursor) -> Dict[str, Any]:
-    cursor.execute(stmt)
+def fetch_sql_result(stmt: str, cursor: Cursor, args: Optional[List[Any]] = None) -> Dict[str, Any]:
+    cursor.execute(stmt, args)
     columns = [column[0] for column in cursor.description]
     row = cursor.fetchone()
     result = {}
@@ -223,12 +248,208 @@ def fetch_sql_result(stmt: str, cursor: Cursor) -> Dict[str, Any]:
     return result
 
 
-def collect_indexing_metrics(benchmark_host: str, indexing_stats: bool) -> Dict[str, Any]:
+def node_stats(rows: List[List[Any]]):
+    """ Sum up the thread pool and breaker statistics of the rows of NODES_STATS_STMT
+
+    >>> pools, breakers = node_stats([
+    ...     [[{'name': 'write', 'active': 2, 'queue': 5, 'rejected': 0}], {'query': {'used': 2e6, 'limit': 1e9}}],
+    ...     [[{'name': 'write', 'active': 1, 'queue': 0, 'rejected': 3}], {'query': {'used': 1e6, 'limit': 1e9}}],
+    ... ])
+    >>> pools, breakers
+    ({'write': {'active': 3, 'queue': 5, 'rejected': 3}}, {'query': 3.0})
+    """
+    pools = {}
+    breakers = {}
+    for thread_pools, node_breakers in rows:
+        for pool in thread_pools or []:
+            if pool['name'] not in TIMELINE_POOLS:
+                continue
+            stats = pools.setdefault(pool['name'], {'active': 0, 'queue': 0, 'rejected': 0})
+            for key in stats:
+                stats[key] += pool.get(key) or 0
+        for name, breaker in (node_breakers or {}).items():
+            breakers[name] = breakers.get(name, 0.0) + (breaker.get('used') or 0) / 1000 ** 2
+    return pools, breakers
+
+
+def read_indexing_sample(cursor: Cursor) -> IndexingSample:
+    ts = int(time.time() * 1000)
+    segments = fetch_sql_result(SEGMENTS_STATS_STMT, cursor)
+    shards = fetch_sql_result(SHARDS_STATS_STMT, cursor)
+    cursor.execute(NODES_STATS_STMT)
+    pools, breakers = node_stats(cursor.fetchall())
+    return IndexingSample(ts, segments, shards, pools, breakers)
+
+
+class IndexingSampler:
+    """ Polls the segment, shard, thread pool and breaker statistics in the background until stopped
+
+    Like ProcSampler, but the samples are taken via SQL from the cluster. A
+    query which is in flight when the sampler is stopped is waited for, it
+    must not race with the connection being closed.
+    """
+
+    def __init__(self, benchmark_host: str, interval: float = 1.0):
+        self.benchmark_host = benchmark_host
+        self.interval = interval
+        self.samples: List[IndexingSample] = []
+        self._task: Optional[asyncio.Task] = None
+        self._stopped = asyncio.Event()
+
+    async def _run(self):
+        with connect(self.benchmark_host) as conn:
+            cursor = conn.cursor()
+            while not self._stopped.is_set():
+                try:
+                    sample = await asyncio.to_thread(read_indexing_sample, cursor)
+                except Error:
+                    return  # cluster stopped
+                self.samples.append(sample)
+                with suppress(asyncio.TimeoutError):
+                    await asyncio.wait_for(self._stopped.wait(), self.interval)
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+        return self
+
+    async def stop(self) -> List[IndexingSample]:
+        if self._task:
+            self._stopped.set()
+            with suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+        return self.samples
+
+
+def _coalesce(stats: Dict[str, Any]) -> Dict[str, Any]:
+    return {k: v or 0 for k, v in stats.items()}
+
+
+def indexing_timeline(samples: List[IndexingSample], start: int, end: int) -> Optional[Dict[str, List[float]]]:
+    """ Derive time series for the samples within the window [start, end]
+
+    Counters are turned into rates per second of the interval since the
+    previous sample. The last sample before the window serves as starting
+    point, so that the timeline lines up with the results of a query.
+
+    >>> def sample(ts, segments, throttled, translog, pending, rejected):
+    ...     return IndexingSample(
+    ...         ts, {'cnt': segments}, {'merge_current_count': 1, 'merge_throttled_time': throttled,
+    ...                                 'merge_throttle': 20.0, 'translog_size': translog,
+    ...                                 'translog_uncommitted_size': translog, 'refresh_pending_count': pending},
+    ...         {'write': {'active': 2, 'queue': 4, 'rejected': rejected}}, {'parent': 100.0})
+    >>> samples = [sample(0, 10, 0, 1.0, 0, 0), sample(1000, 12, 200, 3.0, 1, 0), sample(2000, 9, 1200, 2.0, 4, 5)]
+    >>> timeline = indexing_timeline(samples, 500, 2500)
+    >>> timeline['seconds'], timeline['segments'], timeline['merge_throttled_ms']
+    ([0.5, 1.5], [12, 9], [200.0, 1000.0])
+    >>> timeline['translog_growth'], timeline['refresh_pending'], timeline['write_rejected']
+    ([2.0, -1.0], [1, 4], [0.0, 5.0])
+    >>> indexing_timeline(samples, 3000, 4000) is None
+    True
+
+    The sums are None while there are no shards:
+
+    >>> empty = IndexingSample(0, {'cnt': None}, dict.fromkeys(samples[0].shards), {}, {})
+    >>> indexing_timeline([empty, samples[1]], 0, 1000)['merge_throttled_ms']
+    [200.0]
+    """
+    window = [s for s in samples if start <= s.ts <= end]
+    if not window:
+        return None
+    before = [s for s in samples if s.ts < start]
+    if before:
+        window.insert(0, before[-1])
+    if len(window) < 2:
+        return None
+    timeline = {
+        'seconds': [],
+        'segments': [],
+        'merges': [],
+        'merge_throttled_ms': [],
+        'merge_throttle': [],
+        'translog': [],
+        'translog_growth': [],
+        'refresh_pending': [],
+    }
+    for prev, cur in zip(window, window[1:]):
+        seconds = (cur.ts - prev.ts) / 1000 or 0.001
+        timeline['seconds'].append(round((cur.ts - start) / 1000, 3))
+        shards, prev_shards = _coalesce(cur.shards), _coalesce(prev.shards)
+        timeline['segments'].append(cur.segments['cnt'] or 0)
+        timeline['merges'].append(shards['merge_current_count'])
+        timeline['merge_throttled_ms'].append(
+            round((shards['merge_throttled_time'] - prev_shards['merge_throttled_time']) / seconds, 2))
+        timeline['merge_throttle'].append(shards['merge_throttle'])
+        timeline['translog'].append(shards['translog_uncommitted_size'])
+        timeline['translog_growth'].append(
+            round((shards['translog_size'] - prev_shards['translog_size']) / seconds, 3))
+        timeline['refresh_pending'].append(shards['refresh_pending_count'])
+        for name, stats in cur.pools.items():
+            prev_rejected = prev.pools.get(name, {}).get('rejected', stats['rejected'])
+            timeline.setdefault(f'{name}_active', []).append(stats['active'])
+            timeline.setdefault(f'{name}_queue', []).append(stats['queue'])
+            timeline.setdefault(f'{name}_rejected', []).append((stats['rejected'] - prev_rejected) / seconds)
+        for name, used in cur.breakers.items():
+            timeline.setdefault(f'breaker_{name}', []).append(used)
+    return timeline
+
+
+TIMELINE_PEAK_HEADERS = ['Segments', 'Merges', 'Throttled ms/s', 'Translog MB', 'Refresh pending',
+                         'Write queue', 'Rejected/s', 'Breaker MB']
+
+
+def timeline_peaks(t: Dict[str, List[float]]) -> List[float]:
+    """ Peaks (and mean rates) of an indexing timeline, see TIMELINE_PEAK_HEADERS """
+    return [
+        max(t['segments']),
+        max(t['merges']),
+        sum(t['merge_throttled_ms']) / len(t['merge_throttled_ms']),
+        max(t['translog']),
+        max(t['refresh_pending']),
+        max(t.get('write_queue', [0])),
+        sum(t.get('write_rejected', [0])) / len(t['seconds']),
+        max(t.get('breaker_parent', [0])),
+    ]
+
+
+def print_indexing_timeline(labels: List[str], timelines: List[Dict[str, List[float]]]):
+    """ Print the peaks of the indexing timeline of each version with sparklines of the segments, translog and queue """
+    rows = []
+    for label, t in zip(labels, timelines):
+        rows.append([
+            label,
+            *timeline_peaks(t),
+            sparkline(t['segments'], 20),
+            sparkline(t['translog'], 20),
+            sparkline(t.get('write_queue', [0]), 20),
+        ])
+    print(tabulate(
+        rows,
+        headers=['', *TIMELINE_PEAK_HEADERS, 'Segments', 'Translog', 'Write queue'],
+        floatfmt='.2f'
+    ))
+
+
+def collect_indexing_metrics(benchmark_host: str, indexing_stats: bool, per_node: bool = False) -> Dict[str, Any]:
+    """ Collect segment and shard statistics of the primary shards
+
+    With `per_node` the result additionally contains the statistics of each
+    node of the cluster under `nodes`, keyed by node name.
+    """
     indexing_metrics = {}
     if indexing_stats:
         with connect(benchmark_host) as conn:
             cursor = conn.cursor()
             indexing_metrics['segments'] = fetch_sql_result(SEGMENTS_STATS_STMT, cursor)
             indexing_metrics['shards'] = fetch_sql_result(SHARDS_STATS_STMT, cursor)
+            if per_node:
+                cursor.execute('SELECT name FROM sys.nodes ORDER BY name')
+                indexing_metrics['nodes'] = {
+                    name: {
+                        'segments': fetch_sql_result(SEGMENTS_STATS_STMT + NODE_FILTER, cursor, [name]),
+                        'shards': fetch_sql_result(SHARDS_STATS_STMT + NODE_FILTER, cursor, [name]),
+                    }
+                    for name, in cursor.fetchall()
+                }
             cursor.close()
     return indexing_metrics
@@ -1,10 +1,42 @@
 #!/usr/bin/env python
 
+"""
+Linear regression of series of benchmark results (one value per version).
+
+By default every input line is a JSON list of values, the regression of each
+line is printed and the script exits with 1 if any slope is >= 0.1.
+
+With `--batch` every input line is a JSON object which maps series names to
+their values. The trends of all series are estimated with the outlier
+resistant Theil-Sen and Siegel (repeated medians) slopes, normalized to
+percent of the median per version, and printed as table ranked by the lower
+bound of the Theil-Sen confidence interval:
+
+    ./line_regress.py --batch --input series.jsonl --threshold 0.5
+"""
+
 import sys
 import json
+import math
+import warnings
 import numpy as np
-from argparse import ArgumentParser, FileType
+from argparse import ArgumentParser, FileType, RawDescriptionHelpFormatter
 from scipy import stats
+from tabulate import tabulate
+from typing import Dict, Iterable, List, NamedTuple, Tuple
+
+# Max. number of slopes which are computed at once
+MAX_SLOPES = 20_000_000
+
+
+class Trend(NamedTuple):
+    name: str
+    versions: int
+    median: float
+    slope: float  # Theil-Sen slope in percent of the median per version
+    low: float  # confidence interval of the Theil-Sen slope
+    high: float
+    siegel: float  # Siegel slope in percent of the median per version
 
 
 def get_lineregress(data):
@@ -15,11 +47,147 @@ def get_lineregress(data):
     return stats.linregress(x, y)
 
 
+def pad_series(series: List[List[float]]) -> np.ndarray:
+    """ One row per series, shorter series and missing values (None) are NaN
+
+    >>> pad_series([[1, 2, 3], [4, None]])
+    array([[ 1.,  2.,  3.],
+           [ 4., nan, nan]])
+    """
+    y = np.full((len(series), max((len(s) for s in series), default=0)), np.nan)
+    for i, s in enumerate(series):
+        y[i, :len(s)] = np.array(s, dtype=float)
+    return y
+
+
+def theil_sen(y: np.ndarray, confidence: float = 0.95) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """ Theil-Sen slope and its confidence interval of each row of `y`
+
+    The interval is that of Sen (1968) like in scipy.stats.theilslopes.
+    Rows with less than 3 values have NaN slopes.
+
+    >>> y = np.array([[1.0, 2.0, 3.1, 3.9, 5.0, 60.0], [1.0, 2.0, np.nan, np.nan, np.nan, np.nan]])
+    >>> slope, low, high = theil_sen(y)
+    >>> r = stats.theilslopes(y[0])
+    >>> np.allclose([slope[0], low[0], high[0]], [r.slope, r.low_slope, r.high_slope]), bool(np.isnan(slope[1]))
+    (True, True)
+    """
+    n = y.shape[1]
+    i, j = np.triu_indices(n, 1)
+    with np.errstate(invalid='ignore'):
+        slopes = np.sort((y[:, j] - y[:, i]) / (j - i), axis=1)
+    pairs = np.count_nonzero(~np.isnan(slopes), axis=1)
+    values = np.count_nonzero(~np.isnan(y), axis=1).astype(float)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        slope = np.nanmedian(slopes, axis=1)
+    # Variance of Kendall's S without ties
+    sigma = np.sqrt(values * (values - 1) * (2 * values + 5) / 18)
+    z = stats.norm.ppf(0.5 + confidence / 2)
+    last = np.maximum(pairs - 1, 0)
+    low = np.clip(np.round((pairs - z * sigma) / 2).astype(int) - 1, 0, last)
+    high = np.clip(np.round((pairs + z * sigma) / 2).astype(int), 0, last)
+    rows = np.arange(len(y))
+    too_short = values < 3
+    slope[too_short] = np.nan
+    return (
+        slope,
+        np.where(too_short, np.nan, slopes[rows, low] if n > 1 else np.nan),
+        np.where(too_short, np.nan, slopes[rows, high] if n > 1 else np.nan)
+    )
+
+
+def siegel(y: np.ndarray) -> np.ndarray:
+    """ Siegel repeated medians slope of each row of `y`
+
+    >>> y = np.array([[1.0, 2.0, 3.1, 3.9, 5.0, 60.0]])
+    >>> bool(np.isclose(siegel(y)[0], stats.siegelslopes(y[0]).slope))
+    True
+    """
+    n = y.shape[1]
+    dx = np.subtract.outer(np.arange(n), np.arange(n)).astype(float)
+    np.fill_diagonal(dx, np.nan)
+    with np.errstate(invalid='ignore'), warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        slopes = (y[:, :, None] - y[:, None, :]) / dx
+        slope = np.nanmedian(np.nanmedian(slopes, axis=2), axis=1)
+    slope[np.count_nonzero(~np.isnan(y), axis=1) < 3] = np.nan
+    return slope
+
+
+def trends(series: Dict[str, List[float]], confidence: float = 0.95) -> List[Trend]:
+    """ Trends of the series, most likely decay first
+
+    >>> ranked = trends({'flat': [10, 10.1, 9.9, 10, 10.1], 'decay': [10, 10.2, 10.4, 10.6, 50], 'new': [10]})
+    >>> [(t.name, round(t.slope, 2), round(t.low, 2)) for t in ranked]
+    [('decay', 1.92, 1.92), ('flat', 0.12, -2.0), ('new', nan, nan)]
+    """
+    names = list(series)
+    y = pad_series([series[name] for name in names])
+    result = []
+    # Chunked, the number of slopes grows quadratically with the number of versions
+    chunk = max(1, MAX_SLOPES // max(1, y.shape[1] ** 2))
+    for start in range(0, len(names), chunk):
+        part = y[start:start + chunk]
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            median = np.nanmedian(part, axis=1)
+        scale = 100 / np.abs(np.where(median == 0, np.nan, median))
+        slope, low, high = theil_sen(part, confidence)
+        result.extend(Trend(*t) for t in zip(
+            names[start:start + chunk],
+            np.count_nonzero(~np.isnan(part), axis=1).tolist(),
+            median.tolist(),
+            (slope * scale).tolist(),
+            (low * scale).tolist(),
+            (high * scale).tolist(),
+            (siegel(part) * scale).tolist()
+        ))
+    return sorted(result, key=lambda t: (math.isnan(t.low), -t.low if not math.isnan(t.low) else 0))
+
+
+def read_series(lines: Iterable[str]) -> Dict[str, List[float]]:
+    """ Series of JSON lines with objects mapping names to values, later lines win
+
+    >>> read_series(['{"a": [1, 2]}', '', '{"b": [3], "a": [4]}'])
+    {'a': [4], 'b': [3]}
+    """
+    series = {}
+    for line in lines:
+        if line.strip():
+            series.update(json.loads(line))
+    return series
+
+
+def print_trends(trends: List[Trend], confidence: float, threshold: float):
+    rows = [
+        (t.name, t.versions, t.median, t.slope, f'{t.low:+.3f} .. {t.high:+.3f}', t.siegel,
+         '*' if t.low >= threshold else '')
+        for t in trends
+    ]
+    headers = ('Series', 'Versions', 'Median', 'Theil-Sen %/version',
+               f'{confidence * 100:g}% CI', 'Siegel %/version', 'Decay')
+    print(tabulate(rows, headers=headers, floatfmt=('', '', '.3f', '+.3f', '', '+.3f', '')))
+
+
 def main():
-    p = ArgumentParser()
+    p = ArgumentParser(description=__doc__, formatter_class=RawDescriptionHelpFormatter)
     p.add_argument(
         '--input', dest='lines', type=FileType('r'), default=sys.stdin)
+    p.add_argument('--batch', action='store_true',
+                   help='Robust trends of named series, see above')
+    p.add_argument('--confidence', type=float, default=0.95,
+                   help='Confidence level of the slope intervals in batch mode. Defaults to 0.95')
+    p.add_argument('--threshold', type=float, default=0.1,
+                   help='In batch mode exit with 1 if the lower bound of the slope of a series is at least '
+                        'this percent per version. Defaults to 0.1')
+    p.add_argument('--top', type=int,
+                   help='Only print the first N series of the ranking in batch mode')
     args = p.parse_args()
+    if args.batch:
+        ranked = trends(read_series(args.lines), args.confidence)
+        print_trends(ranked[:args.top], args.confidence, args.threshold)
+        sys.exit(1 if any(t.low >= args.threshold for t in ranked) else 0)
     result = 0
     for line in args.lines:
         d = json.loads(line)
@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+
+"""
+Samples resource usage of a process from /proc at a fixed interval.
+
+Unlike `perf stat` this doesn't require any additional tools and yields time
+series, which can be sliced into the time windows of individual queries.
+"""
+
+import asyncio
+import os
+import time
+from glob import glob
+from typing import Any, Dict, List, NamedTuple, Optional
+
+from tabulate import tabulate
+
+
+CLK_TCK = os.sysconf('SC_CLK_TCK')
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+SPARK_CHARS = '▁▂▃▄▅▆▇█'
+
+
+class ProcSample(NamedTuple):
+    ts: int  # epoch ms
+    rss: int  # bytes
+    utime: float  # seconds
+    stime: float  # seconds
+    read_bytes: int
+    write_bytes: int
+    voluntary_cs: int
+    involuntary_cs: int
+    run_delay_ns: int
+    threads: int
+
+
+def _read(path: str) -> str:
+    with open(path) as f:
+        return f.read()
+
+
+def _status_fields(status: str) -> Dict[str, str]:
+    fields = {}
+    for line in status.splitlines():
+        key, _, value = line.partition(':')
+        fields[key] = value.strip()
+    return fields
+
+
+def _io_counters(pid: int) -> Dict[str, int]:
+    try:
+        io = _read(f'/proc/{pid}/io')
+    except PermissionError:
+        # Only readable by the owner of the process (or with CAP_SYS_PTRACE)
+        return {}
+    return {k: int(v) for k, v in _status_fields(io).items() if v}
+
+
+def read_sample(pid: int) -> ProcSample:
+    """ Read a single sample for `pid`
+
+    Context switches and scheduler delays are only reported per thread, they
+    are summed up over all threads of the process.
+    """
+    ts = int(time.time() * 1000)
+    # The command name can contain spaces and parentheses
+    stat = _read(f'/proc/{pid}/stat').rsplit(')', 1)[1].split()
+    # Fields after the command name, starting at field 3 (state)
+    utime = int(stat[11]) / CLK_TCK
+    stime = int(stat[12]) / CLK_TCK
+    threads = int(stat[17])
+    rss = int(stat[21]) * PAGE_SIZE
+    io = _io_counters(pid)
+    voluntary_cs = 0
+    involuntary_cs = 0
+    run_delay_ns = 0
+    for task in glob(f'/proc/{pid}/task/*'):
+        try:
+            status = _status_fields(_read(f'{task}/status'))
+        except (FileNotFoundError, ProcessLookupError):
+            continue  # thread exited in between
+        voluntary_cs += int(status.get('voluntary_ctxt_switches', 0))
+        involuntary_cs += int(status.get('nonvoluntary_ctxt_switches', 0))
+        # Read separately, schedstat is missing if the thread exited since or
+        # the kernel lacks CONFIG_SCHEDSTATS; the context switches still count
+        try:
+            run_delay_ns += int(_read(f'{task}/schedstat').split()[1])
+        except (FileNotFoundError, ProcessLookupError):
+            continue
+    return ProcSample(
+        ts=ts,
+        rss=rss,
+        utime=utime,
+        stime=stime,
+        read_bytes=io.get('read_bytes', 0),
+        write_bytes=io.get('write_bytes', 0),
+        voluntary_cs=voluntary_cs,
+        involuntary_cs=involuntary_cs,
+        run_delay_ns=run_delay_ns,
+        threads=threads
+    )
+
+
+def read_samples(pids: List[int]) -> ProcSample:
+    """ Read a sample of each process and sum them up """
+    samples = [read_sample(pid) for pid in pids]
+    if len(samples) == 1:
+        return samples[0]
+    return ProcSample(max(s.ts for s in samples), *(sum(values) for values in list(zip(*samples))[1:]))
+
+
+class ProcSampler:
+    """ Collects samples of one or more processes in the background until stopped
+
+    The samples of several processes (the nodes of a cluster) are summed up.
+    """
+
+    def __init__(self, pids: List[int], interval: float = 0.1):
+        self.pids = pids
+        self.interval = interval
+        self.samples: List[ProcSample] = []
+        self._task: Optional[asyncio.Task] = None
+
+    async def _run(self):
+        while True:
+            try:
+                sample = await asyncio.to_thread(read_samples, self.pids)
+            except (FileNotFoundError, ProcessLookupError):
+                return  # process exited
+            self.samples.append(sample)
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        if all(os.path.exists(f'/proc/{pid}') for pid in self.pids):
+            self._task = asyncio.create_task(self._run())
+        return self
+
+    async def stop(self) -> List[ProcSample]:
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        return self.samples
+
+
+def window_series(samples: List[ProcSample], start: int, end: int) -> Optional[Dict[str, List[float]]]:
+    """ Derive time series for the samples within the window [start, end]
+
+    Counters are turned into per-interval deltas and CPU times into
+    utilization in percent of a single core. The last sample before the window
+    serves as starting point for the deltas.
+
+    >>> samples = [
+    ...     ProcSample(0, 100, 1.0, 0.5, 0, 0, 10, 1, 0, 5),
+    ...     ProcSample(100, 200, 1.05, 0.5, 4096, 0, 12, 1, 0, 6),
+    ...     ProcSample(200, 150, 1.15, 0.51, 4096, 8192, 15, 2, 0, 6),
+    ... ]
+    >>> series = window_series(samples, 50, 250)
+    >>> series['cpu_user']
+    [50.0, 100.0]
+    >>> series['rss'], series['voluntary_cs'], series['write_bytes']
+    ([200, 150], [2, 3], [0, 8192])
+    >>> window_series(samples, 300, 400) is None
+    True
+    """
+    window = [s for s in samples if start <= s.ts <= end]
+    if not window:
+        return None
+    before = [s for s in samples if s.ts < start]
+    if before:
+        window.insert(0, before[-1])
+    if len(window) < 2:
+        return None
+    series = {
+        'rss': [],
+        'threads': [],
+        'cpu_user': [],
+        'cpu_system': [],
+        'read_bytes': [],
+        'write_bytes': [],
+        'voluntary_cs': [],
+        'involuntary_cs': [],
+        'run_delay_ms': [],
+    }
+    for prev, cur in zip(window, window[1:]):
+        seconds = (cur.ts - prev.ts) / 1000 or 0.001
+        series['rss'].append(cur.rss)
+        series['threads'].append(cur.threads)
+        series['cpu_user'].append(round((cur.utime - prev.utime) / seconds * 100, 2))
+        series['cpu_system'].append(round((cur.stime - prev.stime) / seconds * 100, 2))
+        series['read_bytes'].append(cur.read_bytes - prev.read_bytes)
+        series['write_bytes'].append(cur.write_bytes - prev.write_bytes)
+        series['voluntary_cs'].append(cur.voluntary_cs - prev.voluntary_cs)
+        series['involuntary_cs'].append(cur.involuntary_cs - prev.involuntary_cs)
+        series['run_delay_ms'].append((cur.run_delay_ns - prev.run_delay_ns) / 1e6)
+    return series
+
+
+def run_series(samples: Optional[List[ProcSample]]) -> Optional[Dict[str, List[float]]]:
+    """ Time series of all samples of a run, None with less than two samples
+
+    >>> run_series([ProcSample(0, 100, 1.0, 0.5, 0, 0, 10, 1, 0, 5)]) is None
+    True
+    >>> run_series(None) is None
+    True
+    """
+    if not samples or len(samples) < 2:
+        return None
+    return window_series(samples, samples[0].ts, samples[-1].ts)
+
+
+def summarize(series: Dict[str, List[float]]) -> Dict[str, Any]:
+    """ Reduce the series of a window to a single value per metric
+
+    >>> summarize({'rss': [2e6, 3e6], 'threads': [5, 6], 'cpu_user': [50.0, 100.0],
+    ...            'cpu_system': [0.0, 10.0], 'read_bytes': [0, 1e6], 'write_bytes': [0, 0],
+    ...            'voluntary_cs': [2, 3], 'involuntary_cs': [0, 1], 'run_delay_ms': [0.5, 0.5]})
+    {'rss_max_mb': 3.0, 'cpu_user': 75.0, 'cpu_system': 5.0, 'read_mb': 1.0, 'write_mb': 0.0, 'voluntary_cs': 5, 'involuntary_cs': 1, 'run_delay_ms': 1.0, 'threads_max': 6}
+    """
+    n = len(series['cpu_user'])
+    return {
+        'rss_max_mb': max(series['rss']) / 1e6,
+        'cpu_user': sum(series['cpu_user']) / n,
+        'cpu_system': sum(series['cpu_system']) / n,
+        'read_mb': sum(series['read_bytes']) / 1e6,
+        'write_mb': sum(series['write_bytes']) / 1e6,
+        'voluntary_cs': sum(series['voluntary_cs']),
+        'involuntary_cs': sum(series['involuntary_cs']),
+        'run_delay_ms': sum(series['run_delay_ms']),
+        'threads_max': max(series['threads']),
+    }
+
+
+def sparkline(values: List[float], width: int = 30) -> str:
+    """ Render values as unicode sparkline, averaging buckets if there are more than `width`
+
+    >>> sparkline([1, 2, 3, 4, 5, 6, 7, 8])
+    '▁▂▃▄▅▆▇█'
+    >>> sparkline([1, 1, 8, 8], width=2)
+    '▁█'
+    >>> sparkline([3, 3])
+    '▁▁'
+    """
+    if len(values) > width:
+        size = len(values) / width
+        values = [
+            sum(chunk) / len(chunk)
+            for chunk in (values[int(i * size):int((i + 1) * size)] for i in range(width))
+        ]
+    lo = min(values)
+    span = max(values) - lo
+    if not span:
+        return SPARK_CHARS[0] * len(values)
+    top = len(SPARK_CHARS) - 1
+    return ''.join(SPARK_CHARS[round((v - lo) / span * top)] for v in values)
+
+
+def print_proc_stats(labels: List[str], series: List[Dict[str, List[float]]]):
+    """ Print a table with the summarized series of each version and sparklines for CPU and RSS """
+    rows = []
+    for label, values in zip(labels, series):
+        summary = summarize(values)
+        cpu = [usr + sys for usr, sys in zip(values['cpu_user'], values['cpu_system'])]
+        rows.append([
+            label,
+            summary['cpu_user'],
+            summary['cpu_system'],
+            summary['rss_max_mb'],
+            summary['read_mb'],
+            summary['write_mb'],
+            summary['voluntary_cs'],
+            summary['involuntary_cs'],
+            summary['run_delay_ms'],
+            summary['threads_max'],
+            sparkline(cpu, 20),
+            sparkline(values['rss'], 20),
+        ])
+    print(tabulate(
+        rows,
+        headers=['', 'CPU usr %', 'CPU sys %', 'RSS MB', 'Read MB', 'Write MB',
+                 'Vol CS', 'Invol CS', 'Run delay ms', 'Threads', 'CPU', 'RSS'],
+        floatfmt='.2f'
+    ))
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,488 @@
+# -*- coding: utf-8 -*-
+
+"""
+Helpers to profile CrateDB nodes using JFR and perf and to extract metrics
+from the recordings.
+"""
+
+import asyncio
+import hashlib
+import json
+import os
+import re
+import signal
+import subprocess
+import time
+from typing import Optional, Dict, Any, List, Tuple
+from uuid import uuid4
+
+
+JFR_OVERVIEW_SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'JfrOverview.java')
+METRICS_CACHE_DIR = os.path.join(
+    os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')),
+    'crate-benchmarks',
+    'jfr'
+)
+QUERY_PERF_EVENTS = 'cycles,instructions,cache-references,cache-misses,branches,branch-misses'
+
+
+def _java_bin(name: str) -> str:
+    java_home = os.environ.get('JAVA_HOME')
+    return java_home and os.path.join(java_home, 'bin', name) or name
+
+
+def jfr_start(pid, tmpdir):
+    filename = os.path.join(tmpdir, str(uuid4()) + '.jfr')
+    subprocess.check_call([
+        _java_bin('jcmd'),
+        str(pid),
+        'JFR.start',
+        f'filename="{filename}"',
+        'name=rec',
+        'settings=profile',
+        'maxsize=50m',
+        'maxage=10m'
+    ])
+    return filename
+
+
+def jfr_stop(pid):
+    subprocess.check_call([_java_bin('jcmd'), str(pid), 'JFR.stop', 'name=rec'])
+
+
+def jfr_overview_cmd(tmpdir: str) -> list[str]:
+    """ Compile JfrOverview once and return the command to run it
+
+    Falls back to the source launcher if `javac` isn't available. That
+    compiles the source again on every invocation.
+    """
+    try:
+        subprocess.check_call([_java_bin('javac'), '-d', tmpdir, JFR_OVERVIEW_SRC])
+        return [_java_bin('java'), '-cp', tmpdir, 'JfrOverview']
+    except (FileNotFoundError, subprocess.CalledProcessError):
+        return [_java_bin('java'), JFR_OVERVIEW_SRC]
+
+
+def _recording_digest(*filenames: Optional[str]) -> str:
+    h = hashlib.sha256()
+    with open(JFR_OVERVIEW_SRC, 'rb') as f:
+        h.update(f.read())
+    for filename in filenames:
+        if not filename:
+            continue
+        with open(filename, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                h.update(chunk)
+    return h.hexdigest()
+
+
+def jfr_write_windows(jfr_file: str, results: List[Any]) -> str:
+    """ Write the time windows of the query results next to a JFR recording
+
+    JfrOverview reports the metrics of each window separately, in the same
+    order as the results.
+    """
+    windows_file = jfr_file + '.windows'
+    with open(windows_file, 'w') as f:
+        for result in results:
+            f.write(f'{result.started} {result.ended}\n')
+    return windows_file
+
+
+def jfr_extract_metrics(filename,
+                        overview_cmd: Optional[list[str]] = None,
+                        windows_file: Optional[str] = None) -> Dict[str, Any]:
+    """ Extract metrics from a JFR recording using JfrOverview
+
+    The result is cached by the hash of the recording (and of JfrOverview
+    itself), re-reporting a recording doesn't need to parse it again.
+    If `windows_file` is given the result contains an additional `windows`
+    list with the metrics of each time window.
+    """
+    digest = _recording_digest(filename, windows_file)
+    cache_file = os.path.join(METRICS_CACHE_DIR, digest + '.json')
+    try:
+        with open(cache_file) as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        pass
+    cmd = (overview_cmd or [_java_bin('java'), JFR_OVERVIEW_SRC]) + [filename]
+    if windows_file:
+        cmd.append(windows_file)
+    output = subprocess.check_output(cmd, universal_newlines=True)
+    metrics = json.loads(output)
+    os.makedirs(METRICS_CACHE_DIR, exist_ok=True)
+    tmp_file = f'{cache_file}.{os.getpid()}'
+    with open(tmp_file, 'w') as f:
+        json.dump(metrics, f)
+    os.replace(tmp_file, cache_file)
+    return metrics
+
+
+def _merge_frames(frame_lists: List[List[str]], by: str) -> List[str]:
+    # frames are formatted as "<method> total=<n>, count=<n>"
+    merged = {}
+    for frames in frame_lists:
+        for frame in frames:
+            name, _, values = frame.rpartition(' total=')
+            total, _, count = values.partition(', count=')
+            t, c = merged.get(name, (0, 0))
+            merged[name] = (t + int(total), c + int(count))
+    top = sorted(merged.items(), key=lambda x: x[1][0 if by == 'total' else 1], reverse=True)[:10]
+    return [f'{name} total={total}, count={count}' for name, (total, count) in top]
+
+
+def _merge_gc(gcs: List[Dict[str, Any]]) -> Dict[str, Any]:
+    count = sum(gc['count'] for gc in gcs)
+    total = sum(gc.get('total_duration_ns', gc['avg_duration_ns'] * gc['count']) for gc in gcs)
+    return {
+        'count': count,
+        'max_duration_ns': max(gc['max_duration_ns'] for gc in gcs),
+        'avg_duration_ns': count and total / count,
+        'total_duration_ns': total
+    }
+
+
+def merge_jfr_metrics(node_metrics: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """ Aggregate the JfrOverview metrics of the nodes of a cluster
+
+    Counters and the CPU load of the JVMs are summed up, the machine CPU load
+    is averaged and GC pause averages are weighted by the GC count.
+
+    >>> m = {'gc': {'name': 'G1', 'young': {'count': 2, 'max_duration_ns': 5, 'avg_duration_ns': 4, 'total_duration_ns': 8},
+    ...             'old': {'count': 0, 'max_duration_ns': 0, 'avg_duration_ns': 0, 'total_duration_ns': 0}},
+    ...      'cpu': {'system': 0.5, 'jvm_user': 0.2, 'jvm_system': 0.1, 'top_frames': ['A.b() total=3, count=3']},
+    ...      'heap': {'initial': 100, 'used': 50},
+    ...      'alloc': {'rate': 10, 'total': 1000, 'top_frames_by_count': [], 'top_frames_by_alloc': ['A.c() total=10, count=1']},
+    ...      'threads': 30, 'classes': 100, 'windows': []}
+    >>> merged = merge_jfr_metrics([m, m])
+    >>> merged['gc']['young'], merged['cpu']['jvm_user'], merged['alloc']['top_frames_by_alloc']
+    ({'count': 4, 'max_duration_ns': 5, 'avg_duration_ns': 4.0, 'total_duration_ns': 16}, 0.4, ['A.c() total=20, count=2'])
+    """
+    if len(node_metrics) == 1:
+        return node_metrics[0]
+    cpus = [m['cpu'] for m in node_metrics]
+    allocs = [m['alloc'] for m in node_metrics]
+    return {
+        'gc': {
+            'name': node_metrics[0]['gc']['name'],
+            'young': _merge_gc([m['gc']['young'] for m in node_metrics]),
+            'old': _merge_gc([m['gc']['old'] for m in node_metrics]),
+        },
+        'cpu': {
+            'system': sum(c['system'] for c in cpus) / len(cpus),
+            'jvm_user': sum(c['jvm_user'] for c in cpus),
+            'jvm_system': sum(c['jvm_system'] for c in cpus),
+            'top_frames': _merge_frames([c.get('top_frames', []) for c in cpus], 'count'),
+        },
+        'heap': {
+            'initial': sum(m['heap']['initial'] for m in node_metrics),
+            'used': sum(m['heap']['used'] for m in node_metrics),
+        },
+        'alloc': {
+            'rate': sum(a['rate'] for a in allocs),
+            'total': sum(a['total'] for a in allocs),
+            'top_frames_by_count': _merge_frames([a['top_frames_by_count'] for a in allocs], 'count'),
+            'top_frames_by_alloc': _merge_frames([a['top_frames_by_alloc'] for a in allocs], 'total'),
+        },
+        'threads': sum(m['threads'] for m in node_metrics),
+        'classes': sum(m['classes'] for m in node_metrics),
+        'windows': [
+            merge_jfr_metrics(list(windows))
+            for windows in zip(*(m.get('windows', []) for m in node_metrics))
+        ],
+    }
+
+
+def jfr_diff(jfr_file1: str, jfr_file2: str, outfile: str):
+    subprocess.check_output(["jfrconv", "--diff", jfr_file1, jfr_file2, outfile])
+
+
+def perf_stat(pid: int) -> Optional[subprocess.Popen]:
+    cmd = [
+        "perf",
+        "stat",
+        "-j",
+        "-d",
+        "-e", "branches,cache-misses,instructions,faults,context-switches",
+        "-p", str(pid)
+    ]
+    try:
+        return subprocess.Popen(
+            cmd,
+            text=True,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE
+        )
+    except FileNotFoundError:
+        return None
+
+
+def perf_stat_output(proc: Optional[subprocess.Popen]) -> str:
+    """ Wait for perf to exit and return its raw output """
+    if not proc:
+        return ''
+    stdout, stderr = proc.communicate()
+    return stderr
+
+
+def parse_perf_stat(output: str) -> Dict[str, Any]:
+    """ Parse the output of `perf stat -j`
+
+    perf stat -j returns json lines like:
+
+    >>> parse_perf_stat(
+    ...     '{"counter-value" : "0.445654", "unit" : "msec", "event" : "task-clock", '
+    ...     '"event-runtime" : 445654, "pcnt-running" : 100.00, "metric-value" : "0.575812", '
+    ...     '"metric-unit" : "CPUs utilized"}\\n')
+    {'task-clock': {'counter-value': '0.445654', 'unit': 'msec', 'event': 'task-clock', 'event-runtime': 445654, 'pcnt-running': 100.0, 'metric-value': '0.575812', 'metric-unit': 'CPUs utilized'}}
+    """
+    metrics = {}
+    for line in output.split("\n"):
+        # Output written to a file (-o) starts with a "# started on" comment
+        if line.startswith('{'):
+            event_metrics = json.loads(line)
+            metrics[event_metrics["event"]] = event_metrics
+    return metrics
+
+
+def merge_perf_stats(perf_stats: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """ Sum up the counter values of several `perf stat` results
+
+    >>> merge_perf_stats([
+    ...     {'instructions': {'counter-value': '100.0', 'unit': '', 'event': 'instructions'}},
+    ...     {'instructions': {'counter-value': '50.0', 'unit': '', 'event': 'instructions'},
+    ...      'cycles': {'counter-value': '<not counted>', 'unit': '', 'event': 'cycles'}},
+    ... ])
+    {'instructions': {'counter-value': '150.0', 'unit': '', 'event': 'instructions'}}
+    """
+    merged = {}
+    for stats in perf_stats:
+        for event, v in stats.items():
+            value = perf_counter(stats, event)
+            if value is None:
+                continue
+            m = merged.setdefault(event, {'counter-value': '0', 'unit': v.get('unit', ''), 'event': event})
+            m['counter-value'] = str(float(m['counter-value']) + value)
+    return merged
+
+
+def perf_counter(stats: Dict[str, Any], event: str) -> Optional[float]:
+    """ Counter value of an event, None if it wasn't counted or isn't supported """
+    try:
+        return float(stats[event]['counter-value'])
+    except (KeyError, ValueError):
+        return None
+
+
+def sum_perf_intervals(output: str) -> Dict[str, Any]:
+    """ Sum up the intervals printed by `perf stat -j -I <ms>`
+
+    >>> sum_perf_intervals(
+    ...     '{"interval" : 0.1, "counter-value" : "100", "unit" : "", "event" : "cycles"}\\n'
+    ...     '{"interval" : 0.2, "counter-value" : "<not counted>", "unit" : "", "event" : "cycles"}\\n'
+    ...     '{"interval" : 0.3, "counter-value" : "50", "unit" : "", "event" : "cycles"}\\n')
+    {'cycles': {'counter-value': '150.0', 'unit': '', 'event': 'cycles'}}
+    """
+    intervals = []
+    for line in output.split('\n'):
+        if line.startswith('{'):
+            event_metrics = json.loads(line)
+            intervals.append({event_metrics['event']: event_metrics})
+    return merge_perf_stats(intervals)
+
+
+class PerfQueryStat:
+    """ Counts perf events separately for each query of a spec
+
+    A single `perf stat` process in interval mode is attached (disabled) to
+    all node processes. Hooked into the cr8 logger it is enabled via its
+    control FIFO when a query is announced and disabled once the result of the
+    query is logged; the intervals printed in between are the counts of the
+    query. The counts include warm-up iterations.
+
+    The commands are sent by a task on the event loop, so that the benchmarks
+    of other versions running in parallel aren't stalled.
+    """
+
+    def __init__(self, pids: List[int], tmpdir: str, warmups: Dict[Tuple[str, int], int], interval_ms: int = 100):
+        self.pids = pids
+        self.tmpdir = tmpdir
+        self.warmups = warmups
+        self.interval_ms = interval_ms
+        self.queries: Dict[Tuple[str, int], Dict[str, Any]] = {}
+        self._proc = None
+        self._ctl_fd = None
+        self._ack_fd = None
+        self._offset = 0
+        self._iterations = None
+        self._commands: asyncio.Queue = asyncio.Queue()
+        self._task: Optional[asyncio.Task] = None
+
+    def hook(self, log):
+        info, result = log.info, log.result
+
+        def on_info(msg):
+            info(msg)
+            if msg.lstrip().startswith('## Running Query'):
+                # Last line is either "Iterations: <n>" or "Duration: <seconds>"
+                m = re.search(r'Iterations: (\d+)\s*$', msg)
+                self._iterations = m and int(m.group(1))
+                self._commands.put_nowait(('enable', None, None))
+
+        def on_result(r):
+            key = (r.statement, r.concurrency)
+            self._commands.put_nowait(('disable', key, self._executions(r)))
+            result(r)
+
+        log.info = on_info
+        log.result = on_result
+
+    def _executions(self, result) -> int:
+        if self._iterations:
+            executions = self._iterations
+        else:
+            # Duration based queries: estimate from throughput
+            stats = result.runtime_stats
+            duration = result.ended - result.started
+            executions = stats.get('mean') and duration * result.concurrency / stats['mean'] or stats.get('n', 0)
+        return executions + self.warmups.get((result.statement, result.concurrency), 0)
+
+    async def start(self):
+        """ Launch perf; the hooked queries aren't counted if that fails """
+        prefix = os.path.join(self.tmpdir, str(uuid4()))
+        self._ctl, self._ack, self._out = prefix + '.ctl', prefix + '.ack', prefix + '.perf'
+        os.mkfifo(self._ctl)
+        os.mkfifo(self._ack)
+        self._ack_fd = os.open(self._ack, os.O_RDONLY | os.O_NONBLOCK)
+        cmd = [
+            'perf', 'stat', '-j',
+            '-D', '-1',
+            '-I', str(self.interval_ms),
+            '--control', f'fifo:{self._ctl},{self._ack}',
+            '-o', self._out,
+            '-e', QUERY_PERF_EVENTS,
+            '-p', ','.join(str(pid) for pid in self.pids)
+        ]
+        try:
+            self._proc = await asyncio.create_subprocess_exec(
+                *cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        except FileNotFoundError:
+            self._close()
+            return self
+        # Opening the write end only succeeds once perf opened the FIFO
+        deadline = time.monotonic() + 5
+        while self._ctl_fd is None:
+            try:
+                self._ctl_fd = os.open(self._ctl, os.O_WRONLY | os.O_NONBLOCK)
+            except OSError:
+                if self._proc.returncode is not None or time.monotonic() > deadline:
+                    await self._kill()
+                    return self
+                await asyncio.sleep(0.01)
+        self._task = asyncio.create_task(self._run())
+        return self
+
+    async def stop(self) -> Dict[Tuple[str, int], Dict[str, Any]]:
+        """ Wait for the counts of the pending queries and stop perf """
+        if self._task:
+            self._commands.put_nowait((None, None, None))
+            await self._task
+            self._task = None
+        if self._proc:
+            self._proc.send_signal(signal.SIGINT)
+            try:
+                await asyncio.wait_for(self._proc.wait(), 10)
+            except asyncio.TimeoutError:
+                await self._kill()
+            self._close()
+        return self.queries
+
+    async def _run(self):
+        while True:
+            cmd, key, executions = await self._commands.get()
+            if cmd is None:
+                return
+            if not await self._command(cmd):
+                await self._kill()
+                return
+            if cmd == 'disable':
+                events = await self._read_until_next_interval()
+                self.queries[key] = {'events': events, 'executions': executions}
+
+    async def _command(self, cmd: str, timeout: float = 5) -> bool:
+        loop = asyncio.get_running_loop()
+        acked = loop.create_future()
+
+        def on_ack():
+            if b'ack' in os.read(self._ack_fd, 64) and not acked.done():
+                acked.set_result(True)
+
+        loop.add_reader(self._ack_fd, on_ack)
+        try:
+            os.write(self._ctl_fd, cmd.encode('utf-8') + b'\n')
+            await asyncio.wait_for(acked, timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            loop.remove_reader(self._ack_fd)
+
+    def _read_lines(self) -> List[str]:
+        """ Complete lines written to the perf output since the last read """
+        try:
+            with open(self._out) as f:
+                f.seek(self._offset)
+                output = f.read()
+        except FileNotFoundError:
+            return []
+        complete = output[:output.rfind('\n') + 1]
+        self._offset += len(complete.encode('utf-8'))
+        return complete.splitlines()
+
+    async def _read_until_next_interval(self) -> Dict[str, Any]:
+        """ Sum up the intervals since the last query
+
+        The counters are disabled, but the last counts of the query are only
+        complete once perf printed the interval that follows the command. perf
+        prints it right after the command; older versions with the next tick.
+        """
+        lines = self._read_lines()
+        printed = [json.loads(line)['interval'] for line in lines if line.startswith('{')]
+        last = max(printed, default=-1)
+        deadline = time.monotonic() + 2 * self.interval_ms / 1000 + 1
+        while time.monotonic() < deadline:
+            await asyncio.sleep(0.01)
+            new_lines = self._read_lines()
+            lines.extend(new_lines)
+            if any(json.loads(line)['interval'] > last for line in new_lines if line.startswith('{')):
+                # perf prints all events of an interval at once, pick up a split write
+                await asyncio.sleep(0.01)
+                lines.extend(self._read_lines())
+                break
+        return sum_perf_intervals('\n'.join(lines))
+
+    async def _kill(self):
+        if self._proc and self._proc.returncode is None:
+            self._proc.kill()
+            await self._proc.wait()
+        self._close()
+
+    def _close(self):
+        for fd in (self._ctl_fd, self._ack_fd):
+            if fd is not None:
+                os.close(fd)
+        for path in (self._ctl, self._ack, self._out):
+            if os.path.exists(path):
+                os.remove(path)
+        self._ctl_fd = self._ack_fd = None
+        self._proc = None
+
+
+def init_worker():
+    """ Initializer for extraction worker processes
+
+    Lowers the priority of the workers (and the java processes they spawn) so
+    that they interfere as little as possible with a running benchmark.
+    """
+    os.nice(10)
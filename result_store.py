@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+
+"""
+Local columnar copy of a benchmark results table.
+
+Results are synced incrementally into a Parquet dataset: every sync only
+fetches the results that ended since the newest stored result (or before
+the oldest one, if a longer history is requested), skips those already
+stored by their `_id` and adds the others as a new part file. Samples are stored as float32 arrays and are only read if
+needed, so that months of results can be analysed offline within seconds.
+"""
+
+import os
+import shutil
+from typing import Any, List, Optional, Sequence, Set
+
+import fastparquet
+import numpy as np
+import pandas as pd
+
+
+COLUMNS = ('stmt', 'version', 'concurrency', 'bulk_size', 'meta_name', 'ended', 'samples', 'minimum', 'p50',
+           'started', 'iterations', 'id')
+PAGE_SIZE = 10_000
+MAX_ENDED = 2 ** 63 - 1
+FETCH_STMT = '''
+select
+    statement,
+    version_info['number'] || '-' || substr(version_info['hash'], 0, 9) as version,
+    concurrency,
+    bulk_size,
+    meta['name'] as meta_name,
+    ended,
+    runtime_stats['samples'],
+    runtime_stats['min'] as minimum,
+    runtime_stats['percentile']['50'] as p50,
+    started,
+    runtime_stats['n'] as iterations,
+    _id as id
+from
+    {table}
+where
+    ended >= ? and ended < ?
+order by
+    ended
+limit ?
+'''
+
+
+def pack_samples(samples: Optional[Sequence[float]]) -> Optional[bytes]:
+    """
+    >>> unpack_samples(pack_samples([1.5, 2.0]))
+    array([1.5, 2. ], dtype=float32)
+    >>> pack_samples(None) is None
+    True
+    """
+    if samples is None:
+        return None
+    return np.asarray(samples, dtype='<f4').tobytes()
+
+
+def unpack_samples(data: Optional[bytes]) -> Optional[np.ndarray]:
+    if data is None:
+        return None
+    return np.frombuffer(data, dtype='<f4')
+
+
+def _page_end(ended: List[int]) -> int:
+    """ Number of rows of a full page which can be stored
+
+    Rows with the `ended` of the last row may continue on the next page, they
+    are fetched again with the next page.
+
+    >>> _page_end([1, 2, 2])
+    1
+    >>> _page_end([2, 2])
+    2
+    """
+    end = len(ended)
+    while end > 0 and ended[end - 1] == ended[-1]:
+        end -= 1
+    return end or len(ended)
+
+
+class ResultStore:
+    """ Parquet dataset with the results of a results table """
+
+    def __init__(self, root: str):
+        self.root = root
+
+    def _file(self) -> Optional[fastparquet.ParquetFile]:
+        if not os.path.exists(os.path.join(self.root, '_metadata')):
+            return None
+        return fastparquet.ParquetFile(self.root)
+
+    def bounds(self):
+        """ `ended` of the oldest and the newest stored result, (None, None) if the store is empty """
+        pf = self._file()
+        if pf is None:
+            return None, None
+        stats = pf.statistics
+        return int(min(stats['min']['ended'])), int(max(stats['max']['ended']))
+
+    def append(self, rows: List[Sequence[Any]]):
+        """ Store rows in the column order of COLUMNS """
+        if not rows:
+            return
+        df = pd.DataFrame(rows, columns=COLUMNS)
+        df['samples'] = df['samples'].map(pack_samples)
+        for column in ('concurrency', 'bulk_size', 'started', 'iterations'):
+            df[column] = df[column].astype('Int64')
+        df['ended'] = df['ended'].astype('int64')
+        df['minimum'] = df['minimum'].astype('float64')
+        df['p50'] = df['p50'].astype('float64')
+        fastparquet.write(
+            self.root,
+            df,
+            file_scheme='hive',
+            append=self._file() is not None,
+            object_encoding={'stmt': 'utf8', 'version': 'utf8', 'meta_name': 'utf8', 'samples': 'bytes', 'id': 'utf8'},
+            compression='ZSTD'
+        )
+
+    def _ids(self, ended: int) -> Set[str]:
+        """ Ids of the stored results which ended at `ended` """
+        pf = self._file()
+        if pf is None:
+            return set()
+        df = pf.to_pandas(columns=['ended', 'id'], filters=[('ended', '==', ended)])
+        return set(df.loc[df['ended'] == ended, 'id'])
+
+    def _fetch(self, cursor, table: str, lower: int, upper: int, stored: Set[str] = frozenset()) -> int:
+        """ Fetch the results with lower <= ended < upper, except the `stored` ids """
+        # Paged by `ended` so that big syncs don't have to fit into a single response
+        count = 0
+        stmt = FETCH_STMT.format(table=table)
+        while True:
+            cursor.execute(stmt, (lower, upper, PAGE_SIZE))
+            rows = cursor.fetchall()
+            full = len(rows) == PAGE_SIZE
+            if full:
+                rows = rows[:_page_end([r[5] for r in rows])]
+            self.append([r for r in rows if r[-1] not in stored])
+            count += sum(r[-1] not in stored for r in rows)
+            if not full:
+                return count
+            lower = rows[-1][5] + 1
+
+    def sync(self, cursor, table: str, since: int) -> int:
+        """ Fetch the results that ended after `since` and aren't stored yet
+
+        Returns the number of new results.
+        """
+        pf = self._file()
+        if pf is not None and set(pf.columns) != set(COLUMNS):
+            # Written with other columns, the store is rebuilt
+            shutil.rmtree(self.root)
+        first, last = self.bounds()
+        if first is None:
+            return self._fetch(cursor, table, since, MAX_ENDED)
+        count = 0
+        if since < first:
+            count += self._fetch(cursor, table, since, first)
+        # Results which ended in the same millisecond as the newest stored
+        # one may have been written after the last sync
+        return count + self._fetch(cursor, table, last, MAX_ENDED, self._ids(last))
+
+    def load(self, start: int, end: Optional[int] = None, samples: bool = False) -> pd.DataFrame:
+        """ Results with start <= ended < end """
+        pf = self._file()
+        columns = [c for c in COLUMNS if samples or c != 'samples']
+        if pf is None:
+            return pd.DataFrame(columns=columns)
+        filters = [('ended', '>=', start)] + (end is not None and [('ended', '<', end)] or [])
+        # Stores synced before a column was added lack it until the next sync
+        df = pf.to_pandas(columns=[c for c in columns if c in pf.columns], filters=filters).reindex(columns=columns)
+        # Filters only skip whole row groups
+        df = df[(df['ended'] >= start) & (df['ended'] < (end if end is not None else MAX_ENDED))]
+        if samples:
+            df['samples'] = df['samples'].map(unpack_samples)
+        return df.reset_index(drop=True)
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
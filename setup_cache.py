@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+
+"""
+Cache for the data directory of a CrateDB node after the `setup` phase of a
+spec ran.
+
+Forks of a compare run can start from a copy of the cached data directory
+instead of re-running the (often expensive) setup instructions.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+from glob import glob
+from typing import Any, Dict, Optional
+
+from cr8.bench_spec import load_spec
+from crate.client import connect
+
+
+UNFINISHED_SHARDS_STMT = '''
+SELECT
+    count(*)
+FROM
+    sys.shards
+WHERE
+    "primary" = true
+  AND
+    state <> 'STARTED'
+'''
+
+# Settings which are different for every run and don't influence the data
+VOLATILE_SETTINGS = {'path.data', 'cluster.name'}
+
+
+def _file_digest(h, path: str):
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(chunk)
+
+
+def spec_digest(spec_path: str) -> str:
+    """ Hash the spec file and the local files referenced by its setup """
+    h = hashlib.sha256()
+    _file_digest(h, spec_path)
+    spec_dir = os.path.dirname(spec_path)
+    setup = load_spec(spec_path).setup
+    for filename in setup.statement_files:
+        _file_digest(h, os.path.join(spec_dir, filename))
+    for data_file in setup.data_files:
+        source = data_file['source']
+        if source.startswith(('http://', 'https://')):
+            h.update(source.encode('utf-8'))
+        else:
+            _file_digest(h, os.path.join(spec_dir, source))
+    for data_cmd in setup.data_cmds:
+        h.update(json.dumps(data_cmd['cmd']).encode('utf-8'))
+    return h.hexdigest()
+
+
+def build_digest(crate_dir: str) -> str:
+    """ Identify a CrateDB build by the name, size and modification time of its jars
+
+    Unpacked tarballs keep the modification times of the archive, so the same
+    build yields the same digest no matter where it's unpacked. Without jars
+    the directory itself identifies the build.
+    """
+    h = hashlib.sha256()
+    jars = sorted(glob(os.path.join(crate_dir, 'lib', '*.jar')))
+    if not jars:
+        h.update(os.path.abspath(crate_dir).encode('utf-8'))
+    for jar in jars:
+        stat = os.stat(jar)
+        h.update(f'{os.path.basename(jar)}:{stat.st_size}:{stat.st_mtime_ns}\n'.encode('utf-8'))
+    return h.hexdigest()
+
+
+def _link_or_copy(src: str, dst: str):
+    # Lucene files are write-once and only ever deleted by the node, so they
+    # can be shared via hardlinks. Everything else (translog, checkpoints,
+    # node state) is modified in place and must be copied.
+    if os.path.basename(os.path.dirname(src)) == 'index':
+        try:
+            os.link(src, dst)
+            return dst
+        except OSError:
+            pass
+    return shutil.copy2(src, dst)
+
+
+class SetupCache:
+    """ Stores data directories keyed by spec content, CrateDB build and settings """
+
+    def __init__(self, root: str):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def key(self, spec_path: str, crate_dir: str, settings: Dict[str, Any], slot: str) -> str:
+        h = hashlib.sha256()
+        h.update(spec_digest(spec_path).encode('utf-8'))
+        h.update(build_digest(crate_dir).encode('utf-8'))
+        stable_settings = {k: str(v) for k, v in settings.items() if k not in VOLATILE_SETTINGS}
+        h.update(json.dumps(stable_settings, sort_keys=True).encode('utf-8'))
+        # Nodes running at the same time must not share cluster name and node id
+        h.update(slot.encode('utf-8'))
+        return h.hexdigest()[:24]
+
+    def contains(self, key: str) -> bool:
+        return os.path.exists(os.path.join(self.root, key, 'meta.json'))
+
+    def restore(self, key: str, data_path: str) -> Optional[Dict[str, Any]]:
+        """ Populate `data_path` from the cache
+
+        Returns the metadata of the cache entry or None if there is no entry.
+        """
+        entry = os.path.join(self.root, key)
+        try:
+            with open(os.path.join(entry, 'meta.json')) as f:
+                meta = json.load(f)
+        except FileNotFoundError:
+            return None
+        shutil.copytree(os.path.join(entry, 'data'),
+                        data_path,
+                        dirs_exist_ok=True,
+                        copy_function=_link_or_copy)
+        return meta
+
+    def store(self, key: str, data_path: str, cluster_name: str):
+        """ Store the data directory of a stopped node """
+        entry = os.path.join(self.root, key)
+        if os.path.exists(entry):
+            return
+        tmp_entry = tempfile.mkdtemp(dir=self.root, prefix='.tmp-')
+        try:
+            shutil.copytree(data_path, os.path.join(tmp_entry, 'data'), copy_function=_link_or_copy)
+            with open(os.path.join(tmp_entry, 'meta.json'), 'w') as f:
+                json.dump({'cluster_name': cluster_name, 'created': int(time.time())}, f)
+            os.rename(tmp_entry, entry)
+        except OSError:
+            shutil.rmtree(tmp_entry, True)
+            if not os.path.exists(entry):
+                raise
+
+
+def wait_for_recovery(http_url: str, timeout: int = 600):
+    """ Wait until all primary shards are started and refresh table statistics
+
+    Table statistics aren't persisted, so ANALYZE is run again after a node
+    started from an existing data directory.
+    """
+    deadline = time.monotonic() + timeout
+    with connect(http_url) as conn:
+        cursor = conn.cursor()
+        while True:
+            cursor.execute(UNFINISHED_SHARDS_STMT)
+            if cursor.fetchone()[0] == 0:
+                break
+            if time.monotonic() > deadline:
+                raise TimeoutError('Shards did not recover in time after restoring the setup cache')
+            time.sleep(0.5)
+        try:
+            cursor.execute('ANALYZE')
+        except Exception:
+            pass  # ANALYZE requires CrateDB 4.1.0+
+        cursor.close()
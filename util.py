@@ -13,6 +13,19 @@ def dict_from_kw_args(args: list[str]) -> dict[str, str]:
         return {}
 
 
+def indexed_kw_args(args: list[str]) -> dict[int, dict[str, str]]:
+    """ Return dictionaries keyed by index based on ['index:key=val'] entries
+
+    >>> indexed_kw_args(['1:x=10', '3:y=foo', '1:z=a:b'])
+    {1: {'x': '10', 'z': 'a:b'}, 3: {'y': 'foo'}}
+    """
+    result = {}
+    for arg in args or []:
+        index, kw = arg.split(':', maxsplit=1)
+        result.setdefault(int(index), {}).update(dict_from_kw_args([kw]))
+    return result
+
+
 def perc_diff(v1, v2):
     """ Return the difference between two number as percentage
 